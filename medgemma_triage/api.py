@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import contextlib
+import hmac
+import json
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from . import consultation_store
+from . import jobs
+from . import log_writer
+from . import telemetry
+from . import uploads
+from .utils import get_secret
+
+# How often an event stream checks its job for new output
+POLL_SECONDS = float(get_secret("API_POLL_SECONDS", 0.1))
+MAX_FILES = int(get_secret("API_MAX_FILES", 20))
+
+def _limit(params, default=20, maximum=200):
+    try:
+        return max(1, min(int(params.get("limit", default)), maximum))
+    except ValueError:
+        return default
+
+def _authorized(request, token):
+    supplied = request.headers.get("authorization", "")
+    return hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode())
+
+def _sse(kind, payload):
+    return f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+
+async def job_events(engine, job_id, poll_interval=POLL_SECONDS):
+    """
+    Follows a job and yields `(kind, payload)` events until it finishes.
+
+    The first event is a `snapshot` of the whole job; after it come the
+    pipeline's own event kinds (`stage`, `progress`, `pretriage`,
+    `raw_data`, `turn`, `token`, `search`) as they change, and a final
+    `status` with the outcome and result. A job run by another worker is
+    re-read from the shared job store on every poll.
+    """
+    job = await run_in_threadpool(engine.get, job_id)
+    if job is None:
+        return
+    snapshot = job.snapshot()
+    yield "snapshot", snapshot
+    turn, offset = snapshot["turn"], len(snapshot["turn_text"])
+    seen = {key: snapshot[key] for key in ("stage", "pretriage", "raw_data")}
+    progress, searches = job.progress, len(snapshot["searches"])
+
+    while True:
+        finished = job.finished  # Read before draining so the final tokens are not missed
+        current_turn, text, offset = job.read_turn(turn, offset)
+        if current_turn != turn:
+            turn = current_turn
+            yield "turn", turn
+        if text:
+            yield "token", text
+        for key in seen:
+            value = getattr(job, key)
+            if value != seen[key]:
+                seen[key] = value
+                yield key, value
+        if job.progress != progress:
+            progress = job.progress
+            yield "progress", progress
+        if len(job.searches) > searches:
+            yield "search", job.searches[searches:]
+            searches = len(job.searches)
+        if finished:
+            yield "status", {"status": job.status, "error": job.error, "result": job.result}
+            return
+        await asyncio.sleep(poll_interval)
+        job = await run_in_threadpool(engine.get, job_id) or job
+
+async def _read_submission(request):
+    """
+    Returns `(patient_id, notes, files)` from a multipart form (fields plus
+    any number of `files` parts) or a JSON body without files.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        body = await request.json()
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        return str(body.get("patient_id") or ""), str(body.get("notes") or ""), []
+    form = await request.form(max_files=MAX_FILES)
+    files = []
+    try:
+        for part in form.getlist("files"):
+            if not hasattr(part, "filename"):
+                continue
+            files.append(await run_in_threadpool(
+                uploads.FileRef.from_stream, part.filename, part.content_type or "application/octet-stream", part.file, part.size,
+            ))
+    except BaseException:
+        uploads.release_all(files)
+        raise
+    finally:
+        await form.close()
+    return str(form.get("patient_id") or ""), str(form.get("notes") or ""), files
+
+def create_app(engine=None, token=None):
+    """
+    Builds the consultation API.
+
+    Routes:
+        POST /consultations: Submit (multipart `patient_id`, `notes`,
+            `files`, or JSON); answers 202 with `{"id": ...}` at once.
+        GET /consultations/{id}: The job snapshot, including `result` when done.
+        GET /consultations/{id}/events: Server-sent events, see `job_events`.
+        GET /consultations/search?q=&patient_id=: Full-text search of stored
+            consultations.
+        GET /patients/{patient_id}/consultations[/latest]: A patient's stored
+            consultations, newest first, or the last one in full.
+        GET /healthz, GET /metrics: Liveness and Prometheus metrics.
+
+    Every route but /healthz and /metrics serves patient data and, when a
+    token is set, answers 401 unless sent `Authorization: Bearer <token>`.
+
+    Args:
+        engine (JobEngine): Defaults to the process-wide engine, created on
+            the first request. Point JOBS_DIR at shared storage when running
+            several workers so any of them can serve any job.
+        token (str): Defaults to API_TOKEN; no check when neither is set.
+    """
+    token = token if token is not None else get_secret("API_TOKEN")
+
+    def get_engine():
+        return engine or jobs.get_engine()
+
+    def protected(handler):
+        async def endpoint(request):
+            if token and not _authorized(request, token):
+                return JSONResponse({"error": "Missing or invalid API token."}, status_code=401,
+                                    headers={"WWW-Authenticate": "Bearer"})
+            return await handler(request)
+        return endpoint
+
+    async def submit(request):
+        try:
+            patient_id, notes, files = await _read_submission(request)
+        except ValueError as e:
+            return JSONResponse({"error": f"Malformed request: {e}"}, status_code=400)
+        if not patient_id and not notes and not files:
+            return JSONResponse({"error": "Provide a patient_id, notes, or at least one file."}, status_code=400)
+        # Persisting the new job writes to the job store; keep file I/O off the event loop
+        job_id = await run_in_threadpool(get_engine().submit, patient_id, notes, files, release=True)
+        return JSONResponse({"id": job_id}, status_code=202, headers={"Location": f"/consultations/{job_id}"})
+
+    async def status(request):
+        job = await run_in_threadpool(get_engine().get, request.path_params["job_id"])
+        if job is None:
+            return JSONResponse({"error": "Unknown consultation."}, status_code=404)
+        return JSONResponse(job.snapshot())
+
+    async def events(request):
+        job_id = request.path_params["job_id"]
+        if await run_in_threadpool(get_engine().get, job_id) is None:
+            return JSONResponse({"error": "Unknown consultation."}, status_code=404)
+
+        async def stream():
+            async for kind, payload in job_events(get_engine(), job_id):
+                yield _sse(kind, payload)
+        return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def get_store():
+        store = consultation_store.get_store()
+        if store is None:
+            return None, JSONResponse({"error": "The consultation store is disabled."}, status_code=404)
+        return store, None
+
+    async def search(request):
+        store, error = get_store()
+        if error:
+            return error
+        params = request.query_params
+        rows = await run_in_threadpool(store.search, params.get("q", ""), params.get("patient_id"), _limit(params))
+        return JSONResponse(rows)
+
+    async def patient_consultations(request):
+        store, error = get_store()
+        if error:
+            return error
+        rows = await run_in_threadpool(store.consultations, request.path_params["patient_id"], _limit(request.query_params))
+        return JSONResponse(rows)
+
+    async def latest_consultation(request):
+        store, error = get_store()
+        if error:
+            return error
+        record = await run_in_threadpool(store.latest, request.path_params["patient_id"])
+        if record is None:
+            return JSONResponse({"error": "No stored consultation for this patient."}, status_code=404)
+        return JSONResponse(record)
+
+    async def healthz(request):
+        return JSONResponse({"status": "ok"})
+
+    async def metrics(request):
+        return PlainTextResponse(telemetry.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        # Deliver queued consultation logs before the worker exits
+        await run_in_threadpool(log_writer.close_writer)
+
+    return Starlette(
+        routes=[
+            Route("/consultations", protected(submit), methods=["POST"]),
+            Route("/consultations/search", protected(search)),
+            Route("/consultations/{job_id}", protected(status)),
+            Route("/consultations/{job_id}/events", protected(events)),
+            Route("/patients/{patient_id}/consultations", protected(patient_consultations)),
+            Route("/patients/{patient_id}/consultations/latest", protected(latest_consultation)),
+            Route("/healthz", healthz),
+            Route("/metrics", metrics),
+        ],
+        lifespan=lifespan,
+    )
+
+app = create_app()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the consultation API.")
+    parser.add_argument("--host", default=get_secret("API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(get_secret("API_PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(get_secret("API_WORKERS", 1)), help="Worker processes")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    uvicorn.run("medgemma_triage.api:app", host=args.host, port=args.port, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+from urllib.parse import quote
+from . import consultation_store
+from . import jobs
+from .utils import get_secret
+
+# Reconnect attempts for an event stream before the job is reported as lost
+MAX_RECONNECTS = 5
+RECONNECT_BACKOFF_SECONDS = 0.5
+
+def api_url():
+    """
+    Base URL of the consultation API (CONSULTATION_API_URL), or None to run
+    consultations in this process.
+    """
+    url = get_secret("CONSULTATION_API_URL")
+    return url.rstrip("/") if url else None
+
+def iter_sse(lines):
+    """
+    Parses server-sent events from an iterator of text lines.
+
+    Yields:
+        tuple: `(event, data)` with `data` decoded from JSON.
+    """
+    event, data = "message", []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].lstrip())
+
+class RemoteJob:
+    """
+    Local mirror of a job running behind the API, kept current by a
+    background thread reading its event stream. Reads like a `jobs.Job`.
+    """
+
+    def __init__(self, client, job_id, snapshot):
+        self.id = job_id
+        self._client = client
+        self._job = jobs.Job.from_snapshot(snapshot)
+        if not self._job.finished:
+            threading.Thread(target=self._follow, name=f"job-events-{job_id[:8]}", daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def _apply(self, kind, payload):
+        if kind == "snapshot":
+            # Sent on every (re)connect; replaces whatever was mirrored so far
+            self._job = jobs.Job.from_snapshot(payload)
+        elif kind == "status":
+            job = self._job
+            job.result = payload["result"]
+            job.error = payload["error"]
+            job.status = payload["status"]
+        else:
+            self._job.apply(kind, payload)
+
+    def _follow(self):
+        failures = 0
+        while not self._job.finished:
+            try:
+                with self._client.stream("GET", f"/consultations/{self.id}/events", timeout=None) as response:
+                    response.raise_for_status()
+                    for kind, payload in iter_sse(response.iter_lines()):
+                        self._apply(kind, payload)
+                        failures = 0
+            except Exception as e:
+                failures += 1
+                if failures > MAX_RECONNECTS:
+                    self._job.error = f"Lost connection to the consultation service: {e}"
+                    self._job.stage = "Failed."
+                    self._job.status = jobs.FAILED
+                    return
+                time.sleep(RECONNECT_BACKOFF_SECONDS * failures)
+
+def _file_part(file, opened):
+    """
+    Multipart entry for an upload; spooled `FileRef`s are streamed from disk
+    (the opened file is added to `opened`).
+    """
+    path = getattr(file, "path", None)
+    if path:
+        opened.append(open(path, "rb"))
+        return file.name, opened[-1], file.type
+    if hasattr(file, "seek"):
+        file.seek(0)
+        return file.name, file, file.type
+    return file.name, file.getvalue(), file.type
+
+class RemoteEngine:
+    """
+    Client for the consultation API with the `JobEngine` interface
+    (`submit`, `get`), so the Streamlit page can use either.
+    """
+
+    def __init__(self, base_url=None, client=None, token=None):
+        import httpx
+        token = token or get_secret("API_TOKEN")
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self._client = client or httpx.Client(base_url=base_url, timeout=httpx.Timeout(30.0, connect=5.0))
+        self._client.headers.update(headers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, patient_id, notes, files, budget=None):
+        """
+        Uploads the consultation and returns its job id. `budget` is unused:
+        the server detaches the uploads itself.
+        """
+        opened = []
+        try:
+            parts = [("files", _file_part(f, opened)) for f in files or []]
+            response = self._client.post("/consultations", data={"patient_id": patient_id or "", "notes": notes or ""}, files=parts or None)
+        finally:
+            for f in opened:
+                f.close()
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished:
+                # Final state has been read; a later get refetches it
+                del self._jobs[job_id]
+        if job is not None:
+            return job
+        response = self._client.get(f"/consultations/{job_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        job = RemoteJob(self._client, job_id, response.json())
+        with self._lock:
+            return self._jobs.setdefault(job_id, job)
+
+    def latest_consultation(self, patient_id):
+        response = self._client.get(f"/patients/{quote(patient_id, safe='')}/consultations/latest")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+_remote = None
+_remote_lock = threading.Lock()
+
+def get_engine():
+    """
+    Returns the engine the UI talks to: a client of the consultation API
+    when CONSULTATION_API_URL is set, otherwise the in-process job engine.
+    """
+    global _remote
+    url = api_url()
+    if not url:
+        return jobs.get_engine()
+    with _remote_lock:
+        if _remote is None:
+            _remote = RemoteEngine(url)
+        return _remote
+
+def latest_consultation(patient_id):
+    """
+    The patient's most recent stored consultation (see
+    `ConsultationStore.latest`), from the API or the local store, or None.
+    """
+    if api_url():
+        return get_engine().latest_consultation(patient_id)
+    store = consultation_store.get_store()
+    return store.latest(patient_id) if store is not None else None
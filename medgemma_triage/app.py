@@ -21,69 +21,130 @@ ui.setup_styles()
 
 # --- Main Dashboard Application ---
 
-from medgemma_triage import mcp_client
-from medgemma_triage import utils
-from groq import Groq
+import threading
+import time
+from medgemma_triage import api_client
+from medgemma_triage import jobs
+from medgemma_triage import pretriage
+from medgemma_triage import streaming
+from medgemma_triage import telemetry
+from medgemma_triage import uploads
+
+POLL_SECONDS = 0.1
+
+def _load_heavy_dependencies():
+    from medgemma_triage import embeddings, mcp_client
+    if not mcp_client.use_http_transport():
+        mcp_client.tools.Client  # Imports fastmcp
+    embeddings.get_model()
+
+@st.cache_resource(show_spinner=False)
+def warm_up_resources():
+    """
+    Once per server process: starts the job engine and the metrics endpoint
+    (when METRICS_PORT is set), and loads fastmcp and the embedding model on
+    a background thread, so neither the first page render nor the first
+    consultation waits for them. Reruns return immediately.
+
+    With CONSULTATION_API_URL set, consultations run in the API service and
+    this page is only its client, so nothing heavy is loaded here.
+    """
+    engine = api_client.get_engine()
+    if api_client.api_url():
+        return engine
+    telemetry.start_metrics_server()
+    threading.Thread(target=_load_heavy_dependencies, name="warm-up", daemon=True).start()
+    return engine
+
+warm_up_resources()
 
 def run_consultation(patient_id, notes, files):
-    """Orchestrates the entire consultation process, including the agentic workflow."""
-
-    with st.spinner("Compiling patient data..."):
-        history = mcp_client.call_backend_tool("get_patient_history", {"patient_id": patient_id}) or "No patient history found."
-        doc_texts, image_files = utils.process_uploaded_files(files)
-
-        initial_prompt = f"""
-        **Patient ID:** {patient_id}
-        **Physician's Notes:** {notes}
-        **Patient History:** {history}
-        **Uploaded Document Contents:** {doc_texts}
-        **Instructions:**
-        Based on all available data, provide a clinical analysis. If you need more information, use the [SEARCH: query] tool.
-        Structure your final response with the headings: ### Executive Summary, ### Detailed Reasoning, and ### Sources & Search Data.
-        """
-        st.session_state.raw_data = initial_prompt
-
-    try:
-        client = Groq(api_key=utils.get_secret("GROQ_API_KEY"))
-        messages = [{"role": "user", "content": initial_prompt}]
-
-        for _ in range(3): # Allow up to 3 turns for the agentic loop
-            with st.spinner("AI is analyzing..."):
-                response_stream = client.chat.completions.create(
-                    messages=messages,
-                    model="llama3-70b-8192",
-                    temperature=0.2,
-                    stream=True
-                )
-
-                full_response = ""
-                placeholder = st.empty()
-                for chunk in response_stream:
-                    full_response += chunk.choices[0].delta.content or ""
-                    placeholder.markdown(full_response + "...")
-
-            search_query = utils.extract_search_command(full_response)
-            if search_query:
-                messages.append({"role": "assistant", "content": full_response})
-                with st.spinner(f"Searching for: {search_query}..."):
-                    search_results = mcp_client.call_backend_tool("search_medical_web", {"query": search_query})
-                messages.append({"role": "user", "content": f"Search results for '{search_query}':\n{search_results}"})
+    """Submits the consultation as a background job and follows its progress."""
+    if "upload_budget" not in st.session_state:
+        # Caps the upload bytes this session keeps in memory; the rest is spooled to disk
+        st.session_state.upload_budget = uploads.MemoryBudget()
+    st.session_state.pretriage = None
+    st.session_state.restored_patient = patient_id  # This run's result supersedes the stored one
+    st.session_state.restored_at = None
+    job_id = api_client.get_engine().submit(patient_id, notes, files, budget=st.session_state.upload_budget)
+    st.session_state.job_id = job_id
+    follow_job(job_id)
+
+def show_pretriage(result):
+    """Shows a provisional pre-triage level at the top of the Executive Summary tab."""
+    st.session_state.pretriage = result
+    placeholder = st.session_state.get("pretriage_placeholder")
+    if placeholder is not None and result:
+        placeholder.info(pretriage.format_summary(result))
+
+def follow_job(job_id):
+    """
+    Streams a consultation job into the page until it finishes.
+    The job keeps running if the script is rerun, so this can be called again
+    to reattach to it.
+    """
+    job = api_client.get_engine().get(job_id)
+    if job is None:
+        st.session_state.job_id = None
+        return
+
+    with st.status(job.stage, expanded=True) as status:
+        progress = st.empty()
+        renderer, turn, offset = None, None, 0
+        shown_pretriage = None
+        while True:
+            finished = job.finished # Read before draining so the final tokens are not missed
+            if job.pretriage is not None and job.pretriage is not shown_pretriage:
+                shown_pretriage = job.pretriage
+                show_pretriage(shown_pretriage)
+            current_turn, text, offset = job.read_turn(turn, offset)
+            if current_turn != turn:
+                if renderer is not None:
+                    renderer.close()
+                renderer, turn = streaming.StreamRenderer(st.empty()), current_turn
+            renderer.write(text)
+            if job.progress and job.status == jobs.RUNNING and not job.raw_data:
+                name, done, total = job.progress
+                progress.progress(done / total if total else 1.0, text=f"Extracting {name}: page {done} of {total}")
             else:
-                break # No search command found, so we're done.
-
-        # Parse and display the final response
-        parsed_response = utils.parse_dashboard_response(full_response)
-        st.session_state.summary = parsed_response["summary"]
-        st.session_state.reasoning = parsed_response["reasoning"]
-        st.session_state.summary_placeholder.markdown(st.session_state.summary)
-        st.session_state.reasoning_placeholder.markdown(st.session_state.reasoning)
-
-        # Save the log
-        mcp_client.call_backend_tool("save_consultation_log", {"patient_id": patient_id, "log_entry": full_response})
-        st.success("Consultation complete and log saved.")
-
-    except Exception as e:
-        st.error(f"An error occurred during the AI analysis: {e}")
+                progress.empty()
+            status.update(label=job.stage)
+            if finished:
+                break
+            time.sleep(POLL_SECONDS)
+        renderer.close()
+        status.update(label=job.stage, state="error" if job.status != jobs.DONE else "complete", expanded=False)
+
+    st.session_state.job_id = None
+    if job.raw_data:
+        st.session_state.raw_data = job.raw_data
+    if job.status == jobs.DONE:
+        st.session_state.summary = job.result["summary"]
+        st.session_state.reasoning = job.result["reasoning"]
+        st.session_state.timings = job.result.get("timings") or []
+        st.success("Consultation complete; log queued for saving.")
+    else:
+        st.error(f"An error occurred during the AI analysis: {job.error or job.stage}")
+
+def restore_last_analysis(patient_id):
+    """
+    Fills the result panes with the patient's last stored consultation, if
+    any; a refresh or a return to the patient needs no new consultation.
+    """
+    st.session_state.restored_patient = patient_id
+    st.session_state.restored_at = None
+    try:
+        last = api_client.latest_consultation(patient_id)
+    except Exception:
+        return  # Restoring is a convenience; the page works without it
+    if last is None:
+        return
+    st.session_state.summary = last.get("summary") or st.session_state.summary
+    st.session_state.reasoning = last.get("reasoning") or st.session_state.reasoning
+    st.session_state.raw_data = last.get("raw_data") or st.session_state.raw_data
+    st.session_state.pretriage = last.get("pretriage")
+    st.session_state.timings = []
+    st.session_state.restored_at = last["created_at"]
 
 def main_dashboard():
     """Renders the main dashboard UI and orchestrates the logic."""
@@ -95,6 +156,15 @@ def main_dashboard():
         st.session_state.reasoning = "Waiting for analysis..."
     if "raw_data" not in st.session_state:
         st.session_state.raw_data = "Input data will be displayed here."
+    if "job_id" not in st.session_state:
+        st.session_state.job_id = None
+    if "timings" not in st.session_state:
+        st.session_state.timings = []
+    if "pretriage" not in st.session_state:
+        st.session_state.pretriage = None
+    if "restored_patient" not in st.session_state:
+        st.session_state.restored_patient = None
+        st.session_state.restored_at = None
 
     # --- Sidebar ---
     with st.sidebar:
@@ -109,10 +179,24 @@ def main_dashboard():
 
     col1, col2 = st.columns([2, 3])
 
+    with col2:
+        # --- Intelligence Zone ---
+        st.header("Analysis & Results")
+
+        tab1, tab2, tab3 = st.tabs(["📊 Executive Summary", "🧠 Reasoning Trace", "🗃️ Raw Data"])
+        with tab1:
+            st.markdown("### High-Level Assessment")
+            # Created before the control panel so a running consultation can show its pre-triage here
+            st.session_state.pretriage_placeholder = st.empty()
+
     with col1:
         # --- Input Zone ---
         st.header("Control Panel")
         patient_id = st.text_input("Patient ID", placeholder="e.g., Patient-001")
+        if patient_id and patient_id != st.session_state.restored_patient and not st.session_state.job_id:
+            restore_last_analysis(patient_id)
+        if patient_id and st.session_state.restored_at:
+            st.caption(f"Showing the last analysis for this patient, from {time.strftime('%Y-%m-%d %H:%M', time.localtime(st.session_state.restored_at))}.")
 
         physician_notes = st.text_area(
             "Physician Notes / Clinical Context",
@@ -130,15 +214,14 @@ def main_dashboard():
                 st.warning("Please provide a Patient ID, notes, or at least one document.")
             else:
                 run_consultation(patient_id, physician_notes, uploaded_files)
+        elif st.session_state.job_id:
+            # A rerun interrupted the page while a job was running; pick it back up
+            follow_job(st.session_state.job_id)
 
     with col2:
-        # --- Intelligence Zone ---
-        st.header("Analysis & Results")
-
-        tab1, tab2, tab3 = st.tabs(["📊 Executive Summary", "🧠 Reasoning Trace", "🗃️ Raw Data"])
-
         with tab1:
-            st.markdown("### High-Level Assessment")
+            if st.session_state.pretriage:
+                st.session_state.pretriage_placeholder.info(pretriage.format_summary(st.session_state.pretriage))
             st.session_state.summary_placeholder = st.empty()
             st.session_state.summary_placeholder.markdown(st.session_state.summary)
 
@@ -150,6 +233,9 @@ def main_dashboard():
         with tab3:
             st.markdown("### Supporting Data & Citations")
             st.text_area("Compiled Input Data", st.session_state.raw_data, height=400, disabled=True)
+            if st.session_state.timings:
+                with st.expander("Timing breakdown"):
+                    st.dataframe(st.session_state.timings, use_container_width=True, hide_index=True)
 
 if __name__ == "__main__":
     main_dashboard()
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import csv
+import json
+import mimetypes
+import os
+import sys
+import threading
+import time
+import uuid
+from . import extraction
+from . import log_writer
+from . import pipeline
+from . import pretriage
+from .utils import get_secret
+
+BATCH_CONCURRENCY = int(get_secret("BATCH_CONCURRENCY", 16))
+# Separators accepted between file paths in a CSV `files` column
+FILE_SEPARATORS = (";", "|")
+# Results kept in memory for the UI; everything is in the output file
+RECENT_RESULTS = 50
+
+mimetypes.add_type(extraction.DOCX_MIME, ".docx")
+
+def _split_files(value):
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    value = value or ""
+    for separator in FILE_SEPARATORS:
+        value = value.replace(separator, "\n")
+    return [part.strip() for part in value.splitlines() if part.strip()]
+
+def _row(record):
+    return {
+        "patient_id": str(record.get("patient_id") or "").strip(),
+        "notes": record.get("notes") or "",
+        "files": _split_files(record.get("files")),
+    }
+
+def parse_batch(text, format):
+    """
+    Parses batch input rows.
+
+    Args:
+        text (str): CSV with a header row, or JSON lines.
+        format (str): "csv" or "jsonl".
+
+    Returns:
+        list: Dicts with `patient_id`, `notes` and `files` (a list of paths).
+    """
+    if format == "jsonl":
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        records = list(csv.DictReader(text.splitlines()))
+    return [_row(record) for record in records]
+
+def read_batch(path):
+    """
+    Reads a `.csv` or `.jsonl` batch file; see `parse_batch`.
+    """
+    format = "jsonl" if path.lower().endswith((".jsonl", ".ndjson")) else "csv"
+    with open(path, "r", encoding="utf-8-sig") as f:
+        return parse_batch(f.read(), format)
+
+def file_loader(base_dir):
+    """
+    Returns a resolver that references a row's file path (relative to
+    `base_dir`) as a `FileRef`. Nothing is read up front: extraction maps the
+    file and its workers open it by path.
+    """
+    def load(name):
+        path = name if os.path.isabs(name) else os.path.join(base_dir, name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return pipeline.FileRef.from_path(path, mimetypes.guess_type(path)[0] or "application/octet-stream")
+    return load
+
+class BatchRun:
+    """
+    Progress of one batch; updated on the batch's event loop and read from
+    Streamlit script threads.
+    """
+
+    def __init__(self, total, output_path):
+        self.id = uuid.uuid4().hex
+        self.total = total
+        self.output_path = output_path
+        self.done = 0
+        self.failed = 0
+        self.recent = []
+        self.finished = False
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def record(self, result):
+        with self._lock:
+            self.done += 1
+            if result["status"] != "ok":
+                self.failed += 1
+            self.recent = (self.recent + [result])[-RECENT_RESULTS:]
+
+    def progress(self):
+        """
+        Returns `(done, failed, total, recent_results)`.
+        """
+        with self._lock:
+            return self.done, self.failed, self.total, list(self.recent)
+
+async def _consult(index, row, resolve_file, runner):
+    started = time.perf_counter()
+    entry = {"row": index, "patient_id": row["patient_id"]}
+    try:
+        # Files are loaded per consultation so at most `concurrency` rows are held in memory
+        files = [await asyncio.to_thread(resolve_file, name) for name in row["files"]]
+        result = await runner(row["patient_id"], row["notes"], files)
+        entry.update(
+            status="ok",
+            summary=result["summary"],
+            reasoning=result["reasoning"],
+            sources=result.get("sources"),
+            full_response=result["full_response"],
+            pretriage=result.get("pretriage"),
+        )
+    except Exception as e:
+        entry.update(status="error", error=f"{type(e).__name__}: {e}")
+    entry["duration_seconds"] = round(time.perf_counter() - started, 3)
+    return entry
+
+async def run_batch_async(rows, output_path, concurrency=BATCH_CONCURRENCY, resolve_file=None, runner=None, run=None):
+    """
+    Runs a consultation per row with at most `concurrency` in flight.
+
+    All consultations share this event loop, so they share the LLM clients,
+    MCP connections, tool caches and per-provider rate limits. Each result
+    is appended to `output_path` (JSON lines, in completion order) as soon as
+    it finishes; a failed row is recorded and does not stop the batch.
+
+    Args:
+        rows (list): Rows from `read_batch` / `parse_batch`.
+        output_path (str): JSONL file to write; truncated first.
+        concurrency (int): Maximum consultations in flight.
+        resolve_file (callable): Maps a row's file entry to a `FileRef`;
+            defaults to reading paths relative to the working directory.
+        runner (coroutine function): Consultation runner, for tests.
+        run (BatchRun): Progress object to update; created if omitted.
+
+    Returns:
+        BatchRun: The finished batch.
+    """
+    resolve_file = resolve_file or file_loader(os.getcwd())
+    runner = runner or pipeline.run_consultation_async
+    run = run or BatchRun(len(rows), output_path)
+    pending = iter(enumerate(rows))
+
+    with open(output_path, "w", encoding="utf-8") as output:
+        async def worker():
+            # Workers share the iterator, so each row is taken exactly once
+            for index, row in pending:
+                entry = await _consult(index, row, resolve_file, runner)
+                output.write(json.dumps(entry) + "\n")
+                output.flush()
+                run.record(entry)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(rows))))))
+        finally:
+            run.finished = True
+            run.finished_at = time.time()
+    return run
+
+def pretriage_rows(rows):
+    """
+    Scores every row's notes with the local pre-triage in one pass, without
+    calling the model or the backend.
+
+    Returns:
+        list: `{"row", "patient_id", "level", "red_flags", "source"}` per row,
+        in input order.
+    """
+    results = pretriage.pretriage_batch([(row["notes"], "") for row in rows])
+    return [
+        {"row": index, "patient_id": row["patient_id"], "level": result["level"],
+         "red_flags": result["red_flags"], "source": result["source"]}
+        for index, (row, result) in enumerate(zip(rows, results))
+    ]
+
+def start_batch(rows, output_path, concurrency=BATCH_CONCURRENCY, resolve_file=None, on_finish=None):
+    """
+    Runs a batch on a background thread and returns its `BatchRun` at once.
+    `on_finish()` is called when the batch ends, however it ends (e.g. to
+    release the uploads it read).
+    """
+    run = BatchRun(len(rows), output_path)
+
+    def target():
+        try:
+            asyncio.run(run_batch_async(rows, output_path, concurrency, resolve_file, run=run))
+        except Exception as e:
+            run.error = str(e)
+            run.finished = True
+        finally:
+            if on_finish:
+                on_finish()
+
+    threading.Thread(target=target, name=f"batch-{run.id[:8]}", daemon=True).start()
+    return run
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run triage consultations for every row of a CSV or JSONL file.")
+    parser.add_argument("input", help="CSV (patient_id,notes,files) or JSONL batch file")
+    parser.add_argument("-o", "--output", default="triage_results.jsonl", help="JSONL file for results")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY, help="Consultations in flight")
+    parser.add_argument("--pretriage-only", action="store_true", help="Only score notes with the local pre-triage")
+    args = parser.parse_args(argv)
+
+    rows = read_batch(args.input)
+    if args.pretriage_only:
+        started = time.perf_counter()
+        with open(args.output, "w", encoding="utf-8") as output:
+            for entry in pretriage_rows(rows):
+                output.write(json.dumps(entry) + "\n")
+        print(f"{len(rows)} rows pre-triaged in {time.perf_counter() - started:.2f}s -> {args.output}", file=sys.stderr)
+        return 0
+    resolve_file = file_loader(os.path.dirname(os.path.abspath(args.input)))
+    run = BatchRun(len(rows), args.output)
+    started = time.perf_counter()
+
+    async def report():
+        task = asyncio.ensure_future(run_batch_async(rows, args.output, args.concurrency, resolve_file, run=run))
+        while not task.done():
+            done, failed, total, _ = run.progress()
+            print(f"\r{done}/{total} done, {failed} failed", end="", file=sys.stderr, flush=True)
+            await asyncio.wait([task], timeout=1.0)
+        return task.result()
+
+    asyncio.run(report())
+    print(f"\r{run.done}/{run.total} done, {run.failed} failed in {time.perf_counter() - started:.1f}s -> {args.output}", file=sys.stderr)
+    log_writer.get_writer().flush()
+    return 1 if run.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from .utils import get_secret
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fetched patient history is served locally before it is refetched
+HISTORY_TTL_SECONDS = float(get_secret("LOCAL_HISTORY_TTL_SECONDS", 3600))
+# Local consultations newer than the cached history that are appended to it
+RECENT_IN_HISTORY = 3
+# Result fields not worth keeping (per-run timings)
+_DROPPED_FIELDS = ("timings",)
+_LEVEL = re.compile(r"\b(EMERGENCY|URGENT|STABLE)\b")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consultations (
+    id TEXT PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    triage_level TEXT,
+    notes TEXT,
+    summary TEXT,
+    reasoning TEXT,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS consultations_by_patient ON consultations (patient_id, created_at DESC);
+CREATE TABLE IF NOT EXISTS patient_history (
+    patient_id TEXT PRIMARY KEY,
+    history TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+# External-content FTS5 index over the searchable columns, kept in step by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS consultations_fts USING fts5(
+    notes, summary, reasoning, content='consultations', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS consultations_fts_insert AFTER INSERT ON consultations BEGIN
+    INSERT INTO consultations_fts (rowid, notes, summary, reasoning) VALUES (new.rowid, new.notes, new.summary, new.reasoning);
+END;
+CREATE TRIGGER IF NOT EXISTS consultations_fts_delete AFTER DELETE ON consultations BEGIN
+    INSERT INTO consultations_fts (consultations_fts, rowid, notes, summary, reasoning)
+    VALUES ('delete', old.rowid, old.notes, old.summary, old.reasoning);
+END;
+CREATE TRIGGER IF NOT EXISTS consultations_fts_update AFTER UPDATE ON consultations BEGIN
+    INSERT INTO consultations_fts (consultations_fts, rowid, notes, summary, reasoning)
+    VALUES ('delete', old.rowid, old.notes, old.summary, old.reasoning);
+    INSERT INTO consultations_fts (rowid, notes, summary, reasoning) VALUES (new.rowid, new.notes, new.summary, new.reasoning);
+END;
+"""
+
+_LISTED = "id, patient_id, created_at, triage_level, notes, summary"
+
+def triage_level(result):
+    """
+    The triage level a result settled on: the first level named in its
+    summary, else the provisional pre-triage level.
+    """
+    match = _LEVEL.search(result.get("summary") or "")
+    if match:
+        return match.group(1)
+    return (result.get("pretriage") or {}).get("level")
+
+def _fts_query(text):
+    # Quote every term so user input cannot be read as FTS syntax
+    return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+class ConsultationStore:
+    """
+    SQLite file of past consultations, keyed by patient and time, plus the
+    last patient history fetched from the backend.
+
+    WAL mode lets readers (page renders, other API workers on the same
+    host) proceed while a consultation is being written. Each thread gets
+    its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Holds notes and prompts: owner-only before SQLite first opens it
+        # (its -wal and -shm files take the same permissions)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self._local = threading.local()
+        connection = self._connection()
+        connection.executescript(SCHEMA)
+        try:
+            connection.executescript(FTS_SCHEMA)
+            self.full_text = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5; search falls back to LIKE
+            self.full_text = False
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def save(self, patient_id, notes, result, consultation_id=None, created_at=None):
+        """
+        Stores a finished consultation's result and returns its id.
+        """
+        consultation_id = consultation_id or uuid.uuid4().hex
+        kept = {key: value for key, value in result.items() if key not in _DROPPED_FIELDS}
+        self._connection().execute(
+            "INSERT OR REPLACE INTO consultations (id, patient_id, created_at, triage_level, notes, summary, reasoning, result)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (consultation_id, patient_id or "", created_at or time.time(), triage_level(result), notes or "",
+             result.get("summary") or "", result.get("reasoning") or "", json.dumps(kept)),
+        )
+        return consultation_id
+
+    def latest(self, patient_id):
+        """
+        Returns the patient's most recent consultation with its full result
+        (`summary`, `reasoning`, `raw_data`, `pretriage`, ...), or None.
+        """
+        row = self._connection().execute(
+            "SELECT id, patient_id, created_at, triage_level, notes, result FROM consultations"
+            " WHERE patient_id = ? ORDER BY created_at DESC LIMIT 1",
+            (patient_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row["result"])
+        record.update(id=row["id"], patient_id=row["patient_id"], created_at=row["created_at"],
+                      triage_level=row["triage_level"], notes=row["notes"])
+        return record
+
+    def consultations(self, patient_id, limit=20, since=None):
+        """
+        Lists a patient's consultations, newest first, without the full results.
+        """
+        rows = self._connection().execute(
+            f"SELECT {_LISTED} FROM consultations WHERE patient_id = ? AND created_at > ?"
+            " ORDER BY created_at DESC LIMIT ?",
+            (patient_id, since or 0.0, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def search(self, text, patient_id=None, limit=20):
+        """
+        Full-text search over notes, summaries and reasoning, best match first.
+        """
+        if not text or not text.strip():
+            return []
+        if self.full_text:
+            query = (f"SELECT {', '.join('c.' + c for c in _LISTED.split(', '))} FROM consultations_fts"
+                     " JOIN consultations c ON c.rowid = consultations_fts.rowid WHERE consultations_fts MATCH ?")
+            params = [_fts_query(text)]
+            order = " ORDER BY bm25(consultations_fts)"
+        else:
+            query = f"SELECT {_LISTED} FROM consultations c WHERE (c.notes LIKE ? OR c.summary LIKE ? OR c.reasoning LIKE ?)"
+            params = [f"%{text}%"] * 3
+            order = " ORDER BY c.created_at DESC"
+        if patient_id:
+            query += " AND c.patient_id = ?"
+            params.append(patient_id)
+        rows = self._connection().execute(query + order + " LIMIT ?", params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def store_history(self, patient_id, history):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO patient_history (patient_id, history, fetched_at) VALUES (?, ?, ?)",
+            (patient_id, history, time.time()),
+        )
+
+    def cached_history(self, patient_id, max_age=HISTORY_TTL_SECONDS):
+        """
+        Returns the patient's locally cached backend history, extended with
+        consultations run here since it was fetched, or None when there is
+        none younger than `max_age` seconds.
+        """
+        row = self._connection().execute(
+            "SELECT history, fetched_at FROM patient_history WHERE patient_id = ?", (patient_id,)
+        ).fetchone()
+        if row is None or time.time() - row["fetched_at"] > max_age:
+            return None
+        recent = self.consultations(patient_id, limit=RECENT_IN_HISTORY, since=row["fetched_at"])
+        if not recent:
+            return row["history"]
+        lines = [
+            f"- {time.strftime('%Y-%m-%d %H:%M', time.localtime(c['created_at']))} ({c['triage_level'] or 'no level'}): "
+            f"{' '.join((c['summary'] or '').split())[:300]}"
+            for c in recent
+        ]
+        return row["history"] + "\n\nRecent consultations (not yet in the record above):\n" + "\n".join(lines)
+
+def default_path():
+    """
+    `consultations.db` in the user's private app-data directory
+    (LOCALAPPDATA on Windows, else XDG_DATA_HOME or ~/.local/share).
+    """
+    base = os.environ.get("LOCALAPPDATA") if os.name == "nt" else None
+    base = base or os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "medgemma_triage", "consultations.db")
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    Returns the process-wide store at CONSULTATION_DB_PATH, or None when
+    CONSULTATION_STORE=off or the database cannot be opened (the store is
+    then disabled for the process with a warning).
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            if (get_secret("CONSULTATION_STORE") or "on").lower() == "off":
+                _store = False
+            else:
+                path = get_secret("CONSULTATION_DB_PATH") or default_path()
+                try:
+                    _store = ConsultationStore(path)
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning("Consultation store disabled: cannot open %s: %s", path, e)
+                    _store = False
+        return _store or None
+
+def record_consultation(patient_id, notes, result):
+    """
+    Saves a finished consultation if the store is enabled. A failed write
+    is logged and dropped rather than failing the consultation.
+    """
+    try:
+        store = get_store()
+        return store.save(patient_id, notes, result) if store is not None else None
+    except Exception:
+        logger.warning("Could not store the consultation for %s", patient_id, exc_info=True)
+        return None
@@ -0,0 +1,176 @@
+import math
+import re
+from collections import Counter
+from . import embeddings
+from . import streaming
+from .utils import get_secret
+
+# Budgets are in estimated tokens. The default total leaves ~1.7k of an 8k
+# context window for the model's answer.
+CONTEXT_TOKEN_BUDGET = int(get_secret("CONTEXT_TOKEN_BUDGET", 6500))
+DOCUMENT_TOKEN_BUDGET = int(get_secret("DOCUMENT_TOKEN_BUDGET", 2500))
+HISTORY_TOKEN_BUDGET = int(get_secret("HISTORY_TOKEN_BUDGET", 800))
+SEARCH_RESULT_TOKEN_BUDGET = int(get_secret("SEARCH_RESULT_TOKEN_BUDGET", 600))
+CHUNK_TOKENS = 200
+
+_DOCUMENT = re.compile(r"--- Document: (.*?) ---\n(.*?)\n--- End Document ---", re.DOTALL)
+_WORD = re.compile(r"[a-z0-9]+")
+
+def estimate_tokens(text):
+    """
+    Cheap token estimate (~4 characters per token for English clinical text).
+    """
+    return (len(text) + 3) // 4 if text else 0
+
+def message_tokens(message):
+    """
+    Estimated prompt cost of a chat message, including attached images.
+    """
+    content = message["content"]
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    from . import images
+    return sum(estimate_tokens(part["text"]) if part["type"] == "text" else images.TOKENS_PER_IMAGE for part in content)
+
+def truncate(text, max_tokens, note="truncated"):
+    """
+    Cuts `text` to about `max_tokens`, preferring a line or sentence boundary.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens * 4
+    cut = max(text.rfind("\n", 0, limit), text.rfind(". ", 0, limit))
+    if cut < limit // 2:
+        cut = limit
+    return text[:cut].rstrip() + f"\n[... {note}: {estimate_tokens(text[cut:])} more tokens omitted ...]"
+
+def chunk_text(text, chunk_tokens=CHUNK_TOKENS):
+    """
+    Packs paragraphs into chunks of roughly `chunk_tokens`; oversized
+    paragraphs are split on character boundaries.
+    """
+    chunks = []
+    current = []
+    size = 0
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        while estimate_tokens(paragraph) > chunk_tokens:
+            chunks.append(paragraph[:chunk_tokens * 4])
+            paragraph = paragraph[chunk_tokens * 4:]
+        tokens = estimate_tokens(paragraph)
+        if current and size + tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(paragraph)
+        size += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def _lexical_scores(chunks, query):
+    query_terms = Counter(_WORD.findall(query.lower()))
+    scores = []
+    for chunk in chunks:
+        terms = Counter(_WORD.findall(chunk.lower()))
+        overlap = sum(min(count, terms[term]) for term, count in query_terms.items())
+        scores.append(overlap / math.sqrt(sum(terms.values()) + 1))
+    return scores
+
+def score_chunks(chunks, query, encode=None):
+    """
+    Relevance of each chunk to `query`: cosine similarity of sentence
+    embeddings when the model is loaded, lexical overlap otherwise (a
+    consultation never waits for the model to load).
+    """
+    if not chunks or not query:
+        return [0.0] * len(chunks)
+    vectors = (encode or embeddings.encode_if_ready)([query] + chunks)
+    if vectors is None:
+        return _lexical_scores(chunks, query)
+    return [float(score) for score in vectors[1:] @ vectors[0]]
+
+def fit_documents(doc_texts, query, budget=DOCUMENT_TOKEN_BUDGET, encode=None):
+    """
+    Shrinks the compiled document block to `budget` tokens.
+
+    Documents are chunked, the chunks most relevant to `query` (the
+    physician's notes) are kept, and kept chunks are shown in their original
+    order with a marker where text was dropped.
+    """
+    if estimate_tokens(doc_texts) <= budget:
+        return doc_texts
+    documents = _DOCUMENT.findall(doc_texts) or [("uploaded documents", doc_texts)]
+    chunks = [(d, i, chunk) for d, (_, body) in enumerate(documents) for i, chunk in enumerate(chunk_text(body))]
+    scores = score_chunks([chunk for _, _, chunk in chunks], query, encode)
+
+    # Every document's opening chunk is kept: it usually names the document type and date
+    keep = {(d, i) for d, i, _ in chunks if i == 0}
+    used = sum(estimate_tokens(chunk) for d, i, chunk in chunks if (d, i) in keep)
+    for index in sorted(range(len(chunks)), key=lambda k: scores[k], reverse=True):
+        d, i, chunk = chunks[index]
+        if (d, i) in keep:
+            continue
+        tokens = estimate_tokens(chunk)
+        if used + tokens > budget:
+            continue
+        keep.add((d, i))
+        used += tokens
+
+    rendered = []
+    for d, (name, _) in enumerate(documents):
+        parts = []
+        skipped = 0
+        for doc_index, i, chunk in chunks:
+            if doc_index != d:
+                continue
+            if (d, i) in keep:
+                if skipped:
+                    parts.append(f"[... {skipped} less relevant section(s) omitted ...]")
+                    skipped = 0
+                parts.append(chunk)
+            else:
+                skipped += 1
+        if skipped:
+            parts.append(f"[... {skipped} less relevant section(s) omitted ...]")
+        rendered.append(f"--- Document: {name} ---\n" + "\n".join(parts) + "\n--- End Document ---")
+    return "\n\n".join(rendered)
+
+def _compact_assistant_turn(content):
+    """
+    Older assistant turns only matter for the searches they issued.
+    """
+    parser = streaming.SearchCommandParser()
+    parser.feed(content)
+    if not parser.queries:
+        return truncate(content, 200, note="earlier reasoning")
+    return "\n".join(f"[SEARCH: {query}]" for query in parser.queries)
+
+def fit_messages(messages, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Returns a copy of the chat history that fits `budget` tokens.
+
+    The system prompt, the initial case prompt and the latest exchange are
+    kept verbatim. Earlier assistant turns are reduced to their search
+    commands first; if that is not enough, earlier search results are cut
+    back to a short excerpt.
+    """
+    def total(items):
+        return sum(message_tokens(m) for m in items)
+
+    fitted = [dict(m) for m in messages]
+    if total(fitted) <= budget:
+        return fitted
+    # Leading system/user messages and the final two messages are protected
+    first_mutable = next((i for i, m in enumerate(fitted) if m["role"] == "assistant"), len(fitted))
+    mutable = range(first_mutable, max(first_mutable, len(fitted) - 2))
+    for i in mutable:
+        if fitted[i]["role"] == "assistant":
+            fitted[i]["content"] = _compact_assistant_turn(fitted[i]["content"])
+    for i in mutable:
+        if total(fitted) <= budget:
+            break
+        if fitted[i]["role"] == "user":
+            fitted[i]["content"] = truncate(fitted[i]["content"], 120, note="earlier search results")
+    return fitted
@@ -0,0 +1,61 @@
+import threading
+from .utils import get_secret
+
+DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """
+    Loads the sentence-transformers model on first use.
+
+    Returns:
+        SentenceTransformer or None: None when the package or model is
+        unavailable; callers fall back to non-semantic behaviour.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(get_secret("EMBEDDING_MODEL", DEFAULT_MODEL), device="cpu")
+            except Exception:
+                _model = False
+        return _model or None
+
+def encode(texts):
+    """
+    Embeds `texts` into L2-normalized float32 vectors (one row per text).
+
+    Returns:
+        numpy.ndarray or None: None when no embedding model is available.
+    """
+    model = get_model()
+    if model is None:
+        return None
+    return model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True).astype("float32")
+
+def warm_up():
+    """
+    Loads the model on a background thread so the first real query doesn't pay for it.
+    """
+    global _warming
+    with _warming_lock:
+        if _warming:
+            return
+        _warming = True
+    threading.Thread(target=get_model, name="embedding-warmup", daemon=True).start()
+
+_warming = False
+_warming_lock = threading.Lock()
+
+def encode_if_ready(texts):
+    """
+    Like `encode`, but never waits for the model: while it is still loading
+    this starts the load in the background and returns None.
+    """
+    if _model is None:
+        warm_up()
+        return None
+    return encode(texts)
@@ -0,0 +1,273 @@
+import contextlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from . import telemetry
+from . import uploads
+from .cache import DiskCache, LRUCache, TieredCache, content_key
+from .utils import get_secret
+
+PDF_MIME = "application/pdf"
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+PAGES_PER_CHUNK = int(get_secret("EXTRACT_PAGES_PER_CHUNK", 16))
+MAX_FILE_BYTES = int(float(get_secret("EXTRACT_MAX_FILE_MB", 100)) * 1024 * 1024)
+FILE_TIMEOUT_SECONDS = float(get_secret("EXTRACT_FILE_TIMEOUT_SECONDS", 60))
+# Files below this size are parsed in the calling thread; the process pool
+# round trip costs more than it saves on small documents.
+INLINE_MAX_BYTES = int(get_secret("EXTRACT_INLINE_MAX_BYTES", 512 * 1024))
+
+# Bump when extractor output changes so stale cache entries are ignored
+EXTRACTOR_VERSION = 1
+
+_pool = None
+_pool_lock = threading.Lock()
+_document_cache = None
+_document_cache_lock = threading.Lock()
+
+def get_document_cache():
+    """
+    Returns the process-wide extracted-text cache.
+
+    Entries are keyed by the SHA-256 of the file bytes, so re-uploading the same
+    document under any name skips parsing. DOC_CACHE_DIR enables a disk tier
+    shared across processes and restarts.
+    """
+    global _document_cache
+    with _document_cache_lock:
+        if _document_cache is None:
+            memory = LRUCache(int(float(get_secret("DOC_CACHE_MAX_MB", 64)) * 1024 * 1024))
+            directory = get_secret("DOC_CACHE_DIR")
+            _document_cache = TieredCache(memory, DiskCache(directory) if directory else None)
+        return _document_cache
+
+def document_cache_stats():
+    return get_document_cache().stats()
+
+def get_process_pool():
+    """
+    Returns the shared extraction process pool, creating it on first use.
+
+    Workers are spawned rather than forked because the Streamlit server and
+    the MCP session manager already run background threads.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = int(get_secret("EXTRACT_WORKERS", os.cpu_count() or 2))
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def shutdown_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+# --- Worker functions (must stay top-level so they pickle) ---
+
+def _open_source(source):
+    """
+    Workers get small documents as bytes and large ones as a file path,
+    which they map read-only instead of receiving a pickled copy per task.
+    """
+    if isinstance(source, str):
+        return io.BytesIO() if os.path.getsize(source) == 0 else _MappedFile(source)
+    return io.BytesIO(source)
+
+class _MappedFile:
+    """
+    Minimal seekable reader over a read-only memory map.
+    """
+
+    def __init__(self, path):
+        import mmap
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getattr__(self, name):
+        return getattr(self._map, name)
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+def pdf_page_count(source):
+    from pypdf import PdfReader
+    return len(PdfReader(_open_source(source)).pages)
+
+def extract_pdf_pages(source, start, stop):
+    """
+    Extracts the text of pages [start, stop) of a PDF.
+    """
+    from pypdf import PdfReader
+    reader = PdfReader(_open_source(source))
+    return "\n".join(reader.pages[i].extract_text() or "" for i in range(start, stop))
+
+def extract_docx(source):
+    """
+    Extracts paragraphs and tables from a DOCX in document order.
+    Table rows are flattened to `cell | cell | ...` lines.
+    """
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+
+    document = docx.Document(_open_source(source))
+    lines = []
+    for block in document.iter_inner_content():
+        if isinstance(block, Paragraph):
+            lines.append(block.text)
+        elif isinstance(block, Table):
+            for row in block.rows:
+                lines.append(" | ".join(cell.text.strip() for cell in row.cells))
+    return "\n".join(lines)
+
+# --- Engine ---
+
+def page_ranges(total_pages, pages_per_chunk=PAGES_PER_CHUNK):
+    return [(start, min(start + pages_per_chunk, total_pages)) for start in range(0, total_pages, pages_per_chunk)]
+
+def _is_inline(source):
+    return not isinstance(source, str) and len(source) <= INLINE_MAX_BYTES
+
+@contextlib.contextmanager
+def _worker_path(source):
+    """
+    Yields a path the pool workers can map: `source` itself when it is one,
+    otherwise a temp file holding the bytes, written once rather than
+    pickled into every task.
+    """
+    if isinstance(source, str):
+        yield source
+        return
+    fd, path = tempfile.mkstemp(prefix="extract-", dir=uploads.spool_dir())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(source)
+        yield path
+    finally:
+        try:
+            os.unlink(path)  # Workers still reading keep their open mapping
+        except OSError:
+            pass
+
+def iter_pdf_text(source, timeout=FILE_TIMEOUT_SECONDS, pages_per_chunk=PAGES_PER_CHUNK):
+    """
+    Extracts a PDF in page ranges across the process pool.
+
+    Args:
+        source: The PDF as a bytes-like object, or the path of a file holding it.
+
+    Yields:
+        tuple: `(pages_done, total_pages, text)` for each range, in page order,
+        as soon as that range and all earlier ones are finished.
+
+    Raises:
+        TimeoutError: If the file's time budget runs out; text already
+        yielded stays valid.
+    """
+    if _is_inline(source):
+        source = bytes(source)
+        total = pdf_page_count(source)
+        yield total, total, extract_pdf_pages(source, 0, total)
+        return
+
+    deadline = time.monotonic() + timeout
+    pool = get_process_pool()
+    with _worker_path(source) as path:
+        total = pool.submit(pdf_page_count, path).result(timeout=timeout)
+        ranges = page_ranges(total, pages_per_chunk)
+        futures = [pool.submit(extract_pdf_pages, path, start, stop) for start, stop in ranges]
+        try:
+            for (_, stop), future in zip(ranges, futures):
+                yield stop, total, future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            raise TimeoutError(f"PDF extraction exceeded {timeout:.0f}s") from None
+        finally:
+            for future in futures:
+                future.cancel()
+
+def extract_docx_text(source, timeout=FILE_TIMEOUT_SECONDS):
+    if _is_inline(source):
+        return extract_docx(bytes(source))
+    with _worker_path(source) as path:
+        future = get_process_pool().submit(extract_docx, path)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f"DOCX extraction exceeded {timeout:.0f}s") from None
+
+def _wrap(name, body):
+    return f"--- Document: {name} ---\n{body}\n--- End Document ---"
+
+def extract_document(file, on_progress=None, timeout=None, max_bytes=None):
+    """
+    Extracts text from one uploaded PDF or DOCX within its time and size budget.
+
+    Args:
+        file: A Streamlit UploadedFile, a `FileRef`, or anything with name,
+            type and getvalue(). Its bytes are read through a zero-copy view;
+            large files reach the extraction workers as a path, not a copy.
+        on_progress (callable): Called as `on_progress(name, done, total)` while
+            a PDF is extracted.
+        timeout (float): Per-file time budget in seconds.
+        max_bytes (int): Per-file size budget.
+
+    Returns:
+        str or None: The document wrapped in document markers, or None for
+        unsupported types.
+    """
+    timeout = FILE_TIMEOUT_SECONDS if timeout is None else timeout
+    max_bytes = MAX_FILE_BYTES if max_bytes is None else max_bytes
+    if file.type not in (PDF_MIME, DOCX_MIME):
+        return None
+
+    size = uploads.upload_size(file)
+    if size > max_bytes:
+        return _wrap(file.name, f"Skipped: file is {size // (1024 * 1024)} MB, over the {max_bytes // (1024 * 1024)} MB limit.")
+
+    with telemetry.span("document_extraction", kind="pdf" if file.type == PDF_MIME else "docx") as span, \
+            uploads.data_view(file) as view:
+        span.annotate(file=file.name, bytes=size)
+        # A spooled upload is already a file the workers can map
+        source = getattr(file, "path", None) or view
+        return _extract(file, view, source, on_progress, timeout, span)
+
+def _extract(file, view, source, on_progress, timeout, span):
+    cache = get_document_cache()
+    key = content_key(view, file.type, EXTRACTOR_VERSION)
+    cached = cache.get(key)
+    span.annotate(cached=cached is not None)
+    if cached is not None:
+        return _wrap(file.name, cached)
+
+    if file.type == PDF_MIME:
+        parts = []
+        try:
+            for done, total, text in iter_pdf_text(source, timeout):
+                parts.append(text)
+                if on_progress:
+                    on_progress(file.name, done, total)
+        except TimeoutError as e:
+            # Partial text is returned but never cached
+            parts.append(f"[Extraction truncated: {e}]")
+            return _wrap(file.name, "\n".join(parts))
+        except Exception as e:
+            return _wrap(file.name, f"Error reading PDF: {e}")
+        body = "\n".join(parts)
+    else:
+        try:
+            body = extract_docx_text(source, timeout)
+        except Exception as e:
+            return _wrap(file.name, f"Error reading DOCX: {e}")
+
+    cache.put(key, body)
+    return _wrap(file.name, body)
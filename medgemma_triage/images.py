@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import contextvars
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import telemetry
+from . import uploads
+from .cache import DiskCache, LRUCache, TieredCache, content_key
+from .utils import get_secret
+
+# Longest side sent to the model. Vision endpoints downscale to roughly this
+# anyway, so anything larger only costs upload time and request size.
+MAX_SIDE = int(get_secret("IMAGE_MAX_SIDE", 1024))
+JPEG_QUALITY = int(get_secret("IMAGE_JPEG_QUALITY", 85))
+MAX_IMAGES_PER_REQUEST = int(get_secret("IMAGE_MAX_PER_REQUEST", 4))
+# Files above this are rejected before decoding (decompression bombs, raw scans)
+MAX_INPUT_BYTES = int(float(get_secret("IMAGE_MAX_INPUT_MB", 50)) * 1024 * 1024)
+# Rough prompt cost of one image at MAX_SIDE, used for context budgeting
+TOKENS_PER_IMAGE = int(get_secret("IMAGE_TOKENS_PER_IMAGE", 800))
+
+# Bump when the output encoding changes so stale cache entries are ignored
+PREPROCESSOR_VERSION = 1
+
+_executor = None
+_executor_lock = threading.Lock()
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+# Model configurations (see `llm.targets_key`) that rejected image input in this process
+_text_only_models = set()
+
+def images_enabled(model=None):
+    """
+    Images are attached to the model request unless IMAGE_INPUT=off (for
+    text-only models) or `model` has already rejected them.
+    """
+    if (get_secret("IMAGE_INPUT") or "on").lower() == "off":
+        return False
+    return model is None or model not in _text_only_models
+
+def mark_text_only(model):
+    """
+    Remembers that `model` rejects image input, so later consultations skip
+    preparing images for it and the request it would turn down.
+    """
+    _text_only_models.add(model)
+
+def get_executor():
+    """
+    Returns the image worker pool. Pillow releases the GIL while decoding,
+    resizing and encoding, so threads run in parallel without copying the
+    image bytes into worker processes.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(get_secret("IMAGE_WORKERS", 4)), thread_name_prefix="image")
+        return _executor
+
+def get_image_cache():
+    """
+    Returns the process-wide cache of prepared images (data URLs), keyed by
+    the SHA-256 of the uploaded bytes and the output settings. IMAGE_CACHE_DIR
+    adds a disk tier.
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            memory = LRUCache(int(float(get_secret("IMAGE_CACHE_MAX_MB", 64)) * 1024 * 1024))
+            directory = get_secret("IMAGE_CACHE_DIR")
+            _image_cache = TieredCache(memory, DiskCache(directory) if directory else None)
+        return _image_cache
+
+def _to_8bit(image):
+    """
+    Maps high-bit-depth images (16-bit PNG exports of DICOM, float TIFFs)
+    onto 8-bit grayscale, stretching their actual value range.
+    """
+    import numpy as np
+    pixels = np.asarray(image, dtype=np.float32)
+    low, high = float(pixels.min()), float(pixels.max())
+    scale = 255.0 / (high - low) if high > low else 0.0
+    from PIL import Image
+    return Image.fromarray(((pixels - low) * scale).astype(np.uint8), mode="L")
+
+def prepare_image(data, max_side=MAX_SIDE, quality=JPEG_QUALITY):
+    """
+    Decodes, downsizes and re-encodes one image for a vision request.
+
+    Grayscale images (most radiographs) stay single-channel, which roughly
+    thirds the JPEG size; transparency is flattened onto white.
+
+    Args:
+        data: The image bytes (or a buffer), or the path of a file on disk.
+
+    Returns:
+        tuple: `(mime_type, encoded_bytes, (width, height))`.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(data if isinstance(data, str) else io.BytesIO(data)) as image:
+        image.draft(image.mode, (max_side, max_side))  # JPEG only: decode at a reduced scale
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+            image = _to_8bit(image)
+        elif image.mode in ("RGBA", "LA", "P", "PA"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+        return "image/jpeg", out.getvalue(), image.size
+
+def _prepare_cached(file):
+    """
+    Prepares one upload on a worker thread. The size is checked before any
+    byte is read; a spooled `FileRef` is hashed through a memory map and
+    decoded straight from its file.
+    """
+    name = file.name
+    input_bytes = uploads.upload_size(file)
+    if input_bytes > MAX_INPUT_BYTES:
+        raise ValueError(f"{name} is {input_bytes // (1024 * 1024)} MB, over the {MAX_INPUT_BYTES // (1024 * 1024)} MB image limit")
+    cache = get_image_cache()
+    with uploads.data_view(file) as view:
+        key = content_key(view, MAX_SIDE, JPEG_QUALITY, PREPROCESSOR_VERSION)
+    data_url = cache.get(key)
+    if data_url is None:
+        with telemetry.span("image_preprocessing") as span:
+            mime, encoded, size = prepare_image(getattr(file, "path", None) or file.getvalue())
+            span.annotate(file=name, input_bytes=input_bytes, output_bytes=len(encoded), size=list(size))
+        data_url = f"data:{mime};base64,{base64.b64encode(encoded).decode('ascii')}"
+        cache.put(key, data_url)
+    return data_url
+
+async def prepare_images_async(files):
+    """
+    Prepares uploaded images concurrently on the image worker pool.
+
+    Args:
+        files (list): Image uploads or `FileRef`s; at most
+            MAX_IMAGES_PER_REQUEST are used.
+
+    Returns:
+        list: `{"name", "data_url"}` for each image that could be prepared,
+        or `{"name", "error"}` for one that could not.
+    """
+    loop = asyncio.get_running_loop()
+    files = list(files or [])[:MAX_IMAGES_PER_REQUEST]
+    futures = [
+        loop.run_in_executor(get_executor(), contextvars.copy_context().run, _prepare_cached, f)
+        for f in files
+    ]
+    prepared = []
+    for file, outcome in zip(files, await asyncio.gather(*futures, return_exceptions=True)):
+        if isinstance(outcome, Exception):
+            prepared.append({"name": file.name, "error": str(outcome)})
+        else:
+            prepared.append({"name": file.name, "data_url": outcome})
+    return prepared
+
+def user_content(text, prepared_images):
+    """
+    Builds a user message's content: plain text, or OpenAI-style multimodal
+    parts when there are images to attach.
+    """
+    parts = [{"type": "image_url", "image_url": {"url": image["data_url"]}} for image in prepared_images if "data_url" in image]
+    if not parts:
+        return text
+    return [{"type": "text", "text": text}] + parts
+
+def has_images(messages):
+    return any(not isinstance(m["content"], str) for m in messages)
+
+def without_images(messages):
+    """
+    Returns a copy of `messages` with image parts removed, for text-only models.
+    """
+    return [
+        m if isinstance(m["content"], str)
+        else dict(m, content="\n".join(part["text"] for part in m["content"] if part["type"] == "text"))
+        for m in messages
+    ]
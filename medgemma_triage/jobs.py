@@ -0,0 +1,320 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from . import pipeline
+from . import uploads
+from .utils import get_secret
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+INTERRUPTED = "interrupted"
+
+JOB_CONCURRENCY = int(get_secret("JOB_CONCURRENCY", 8))
+JOB_RETENTION_SECONDS = float(get_secret("JOB_RETENTION_SECONDS", 3600))
+# Running jobs are re-persisted this often so other processes sharing JOBS_DIR
+# can tell a live job from one whose worker died
+HEARTBEAT_SECONDS = float(get_secret("JOB_HEARTBEAT_SECONDS", 5))
+JOB_STALE_SECONDS = float(get_secret("JOB_STALE_SECONDS", 30))
+# Partial output is written to disk at most this often while tokens stream
+PERSIST_INTERVAL_SECONDS = 1.0
+# Stored snapshots (notes, history, results) are swept for expiry at most this often
+PURGE_INTERVAL_SECONDS = 60.0
+
+class Job:
+    """
+    State of one consultation job, updated from the engine's loop thread and
+    read from Streamlit script threads.
+    """
+
+    def __init__(self, job_id, patient_id, notes, file_names):
+        self.id = job_id
+        self.patient_id = patient_id
+        self.notes = notes
+        self.file_names = file_names
+        self.status = QUEUED
+        self.stage = "Queued..."
+        self.progress = None
+        self.pretriage = None
+        self.raw_data = ""
+        self.turn = 0
+        self.searches = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.heartbeat_at = None
+        self._turn_parts = []
+        self._turn_chars = 0
+        self._turn_text = ""
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, INTERRUPTED)
+
+    def apply(self, kind, payload):
+        """
+        Folds a pipeline event into the job state.
+        """
+        with self._lock:
+            if kind == "stage":
+                self.stage = payload
+            elif kind == "progress":
+                self.progress = payload
+            elif kind == "pretriage":
+                self.pretriage = payload
+            elif kind == "raw_data":
+                self.raw_data = payload
+            elif kind == "turn":
+                self.turn = payload
+                self._turn_parts = []
+                self._turn_chars = 0
+                self._turn_text = ""
+            elif kind == "token":
+                self._turn_parts.append(payload)
+                self._turn_chars += len(payload)
+            elif kind == "search":
+                self.searches.extend(payload)
+            elif kind == "result":
+                self.result = payload
+            self.updated_at = time.time()
+
+    def read_turn(self, turn, offset):
+        """
+        Returns `(turn, new_text, new_offset)` for a reader that has consumed
+        `offset` characters of `turn`. When the job has moved on to a later
+        turn, the new turn is read from its start.
+        """
+        with self._lock:
+            if turn != self.turn:
+                offset = 0
+            if len(self._turn_text) < self._turn_chars:
+                self._turn_text = "".join(self._turn_parts)
+                self._turn_parts = [self._turn_text]
+            return self.turn, self._turn_text[offset:], self._turn_chars
+
+    def snapshot(self):
+        with self._lock:
+            if len(self._turn_text) < self._turn_chars:
+                self._turn_text = "".join(self._turn_parts)
+                self._turn_parts = [self._turn_text]
+            return {
+                "id": self.id,
+                "patient_id": self.patient_id,
+                "notes": self.notes,
+                "file_names": self.file_names,
+                "status": self.status,
+                "stage": self.stage,
+                "pretriage": self.pretriage,
+                "raw_data": self.raw_data,
+                "turn": self.turn,
+                "turn_text": self._turn_text,
+                "searches": list(self.searches),
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+                "heartbeat_at": self.heartbeat_at,
+            }
+
+    @classmethod
+    def from_snapshot(cls, data):
+        job = cls(data["id"], data["patient_id"], data["notes"], data["file_names"])
+        job.status = data["status"]
+        job.stage = data["stage"]
+        job.pretriage = data.get("pretriage")
+        job.raw_data = data["raw_data"]
+        job.turn = data["turn"]
+        job._turn_parts = [data["turn_text"]]
+        job._turn_chars = len(data["turn_text"])
+        job._turn_text = data["turn_text"]
+        job.searches = data["searches"]
+        job.result = data["result"]
+        job.error = data["error"]
+        job.created_at = data["created_at"]
+        job.updated_at = data["updated_at"]
+        job.heartbeat_at = data.get("heartbeat_at")
+        return job
+
+class JobStore:
+    """
+    One JSON snapshot per job, written atomically.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def save(self, job):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(job.snapshot(), f)
+            os.replace(tmp, self._path(job.id))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def purge(self, cutoff):
+        """
+        Deletes snapshots (and stray temp files) last written before `cutoff`.
+        Running jobs are rewritten by their heartbeat, so only finished or
+        abandoned ones age out.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass  # Removed by another worker sharing the directory
+
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                job = Job.from_snapshot(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        stale = job.heartbeat_at is None or time.time() - job.heartbeat_at > JOB_STALE_SECONDS
+        if not job.finished and stale:
+            # Its worker died (a live one, possibly in another process, keeps the heartbeat fresh)
+            job.status = INTERRUPTED
+            job.stage = "Interrupted by a server restart."
+        return job
+
+class JobEngine:
+    """
+    Runs consultations on a shared background event loop.
+
+    At most `concurrency` jobs run at once (model requests additionally share
+    the per-provider rate limits in `llm`), and job progress, including
+    partial model output, is persisted so a Streamlit rerun or refresh can
+    reattach to it.
+    """
+
+    def __init__(self, concurrency=JOB_CONCURRENCY, store=None, runner=None):
+        self.store = store
+        self._runner = runner or pipeline.run_consultation_async
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="consultation-jobs", daemon=True)
+        self._thread.start()
+        if store is not None:
+            asyncio.run_coroutine_threadsafe(self._heartbeat(), self._loop)
+
+    def submit(self, patient_id, notes, files, budget=None, release=False):
+        """
+        Queues a consultation and returns its job id immediately.
+
+        Args:
+            files (list): Uploaded files; they are detached so the job does not
+                depend on the submitting Streamlit session.
+            budget (MemoryBudget): The session's in-memory upload allowance;
+                uploads that do not fit are spooled to disk.
+            release (bool): Also release `FileRef`s passed in when the job
+                ends; copies made here always are.
+        """
+        files = files or []
+        refs = [f if isinstance(f, pipeline.FileRef) else pipeline.FileRef.from_upload(f, budget) for f in files]
+        detached = refs if release else [ref for ref, f in zip(refs, files) if ref is not f]
+        files = refs
+        job = Job(uuid.uuid4().hex, patient_id, notes, [f.name for f in files])
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._persist(job)
+        asyncio.run_coroutine_threadsafe(self._run(job, files, detached), self._loop)
+        return job.id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id)
+        return job
+
+    def _prune(self):
+        now = time.time()
+        cutoff = now - JOB_RETENTION_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.updated_at < cutoff]:
+            del self._jobs[job_id]
+        if self.store is not None and now - self._last_purge >= PURGE_INTERVAL_SECONDS:
+            self._last_purge = now
+            self.store.purge(cutoff)
+
+    def _persist(self, job):
+        if self.store is not None:
+            job.heartbeat_at = time.time()
+            self.store.save(job)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            with self._lock:
+                running = [job for job in self._jobs.values() if not job.finished]
+            for job in running:
+                await asyncio.to_thread(self._persist, job)
+
+    async def _run(self, job, files, detached=()):
+        last_persist = [0.0]
+
+        def on_event(kind, payload=None):
+            job.apply(kind, payload)
+            now = time.monotonic()
+            if kind != "token" or now - last_persist[0] >= PERSIST_INTERVAL_SECONDS:
+                last_persist[0] = now
+                self._persist(job)
+
+        async with self._semaphore:
+            job.status = RUNNING
+            self._persist(job)
+            try:
+                job.result = await self._runner(job.patient_id, job.notes, files, on_event=on_event)
+                job.status = DONE
+                job.stage = "Consultation complete."
+            except asyncio.CancelledError:
+                # Shutdown or a cancelled runner; without this the job would look alive forever
+                job.error = "The consultation was cancelled."
+                job.status = FAILED
+                job.stage = "Cancelled."
+                raise
+            except Exception as e:
+                job.error = str(e)
+                job.status = FAILED
+                job.stage = "Failed."
+            finally:
+                uploads.release_all(detached)
+                job.updated_at = time.time()
+                self._persist(job)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """
+    Returns the process-wide job engine. Jobs are persisted under JOBS_DIR.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            directory = get_secret("JOBS_DIR", os.path.join(tempfile.gettempdir(), "medgemma_jobs"))
+            _engine = JobEngine(store=JobStore(directory))
+        return _engine
@@ -0,0 +1,225 @@
+import asyncio
+import collections
+import threading
+import time
+
+class RateLimiter:
+    """
+    Token-bucket limiter allowing `rate` acquisitions per `per` seconds with
+    bursts up to `burst`. Safe to share across threads and event loops.
+    """
+
+    def __init__(self, rate, per=60.0, burst=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.per = float(per)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Takes one token and returns how long the caller must wait for it.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate / self.per)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens * self.per / self.rate
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+_provider_limiters = {}
+_provider_limiters_lock = threading.Lock()
+
+def get_provider_limiter(provider, requests_per_minute):
+    """
+    Returns the process-wide limiter for an LLM provider.
+    """
+    with _provider_limiters_lock:
+        limiter = _provider_limiters.get(provider)
+        if limiter is None:
+            limiter = _provider_limiters[provider] = RateLimiter(requests_per_minute, per=60.0)
+        return limiter
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+class OverloadedError(RuntimeError):
+    """Raised when a call could not get a concurrency slot in time."""
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    Fails fast while a backend is unhealthy.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    `allow()` refuses calls for `reset_timeout` seconds. It then lets a
+    single trial call through (half-open): success closes the breaker,
+    failure opens it again. A trial that never reports back (cancelled,
+    abandoned) is given up on after another `reset_timeout`. Safe to share
+    across threads and event loops.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        Returns True if a call may go ahead now.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = HALF_OPEN
+            now = self._clock()
+            if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+                return False
+            self._trial_started = now
+            return True
+
+    def release_trial(self):
+        """
+        Gives back a half-open trial slot for a call that ended without
+        telling whether the backend is healthy (not configured, cancelled).
+        """
+        with self._lock:
+            self._trial_started = None
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_started = None
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = self._clock()
+
+class ConcurrencyLimiter:
+    """
+    Caps calls in flight across all threads and event loops.
+
+    Callers beyond `limit` queue in arrival order for at most
+    `max_queue_seconds`, then fail with `OverloadedError`, so overload sheds
+    work instead of stacking up waiting requests. Async waiters are parked
+    on their own loop, not on a thread.
+    """
+
+    def __init__(self, limit, max_queue_seconds=2.0):
+        self.limit = limit
+        self.max_queue_seconds = max_queue_seconds
+        self.active = 0
+        self.rejected = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        with self._lock:
+            return len(self._waiters)
+
+    def _try_acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    def _abandon(self, waiter):
+        """
+        Withdraws a waiter that gave up. Returns True if a slot was handed to
+        it in the meantime, in which case the caller now owns that slot.
+        """
+        with self._lock:
+            if waiter["granted"]:
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+
+    def _overloaded(self):
+        return OverloadedError(f"no capacity within {self.max_queue_seconds:g}s ({self.limit} calls in flight)")
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return
+            future = loop.create_future()
+            waiter = {"granted": False, "wake": lambda: loop.call_soon_threadsafe(_resolve, future)}
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, self.max_queue_seconds)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                raise self._overloaded() from None
+        except asyncio.CancelledError:
+            if self._abandon(waiter):
+                self.release()
+            raise
+
+    def acquire_sync(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            waiter = {"granted": False, "wake": event.set}
+            self._waiters.append(waiter)
+        if not event.wait(self.max_queue_seconds) and not self._abandon(waiter):
+            raise self._overloaded()
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # Hand the slot straight to the next waiter; `active` is unchanged
+                waiter = self._waiters.popleft()
+                waiter["granted"] = True
+                wake = waiter["wake"]
+            else:
+                self.active -= 1
+                return
+        try:
+            wake()
+        except RuntimeError:
+            # The waiter's loop is gone; pass the slot on
+            self.release()
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,199 @@
+import asyncio
+import threading
+import weakref
+from . import limits
+from .utils import get_secret
+
+# Provider name -> how to build its client. "openai" kinds talk to any
+# OpenAI-compatible endpoint (vLLM on Modal, a local stub server, ...).
+PROVIDERS = {
+    "groq": {"kind": "groq", "api_key": "GROQ_API_KEY", "base_url": None},
+    "modal": {"kind": "openai", "api_key": "MODAL_API_KEY", "base_url": "MODAL_API_URL"},
+    "openai": {"kind": "openai", "api_key": "OPENAI_API_KEY", "base_url": "OPENAI_BASE_URL"},
+}
+
+DEFAULT_PRIMARY = "groq:llama3-70b-8192"
+DEFAULT_REQUESTS_PER_MINUTE = 30
+TEMPERATURE = 0.2
+
+class Target:
+    """
+    A provider/model pair, parsed from `provider:model`.
+    """
+
+    def __init__(self, provider, model):
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown LLM provider '{provider}'")
+        self.provider = provider
+        self.model = model
+
+    @classmethod
+    def parse(cls, spec):
+        provider, _, model = spec.partition(":")
+        return cls(provider.strip(), model.strip())
+
+    def __repr__(self):
+        return f"{self.provider}:{self.model}"
+
+def configured_targets():
+    """
+    Returns `(primary, secondary)` from LLM_PRIMARY / LLM_SECONDARY; secondary may be None.
+    """
+    primary = Target.parse(get_secret("LLM_PRIMARY", DEFAULT_PRIMARY))
+    secondary = get_secret("LLM_SECONDARY")
+    return primary, Target.parse(secondary) if secondary else None
+
+def targets_key():
+    """
+    Names the configured targets, e.g. to remember what they accept.
+    """
+    return tuple(repr(target) for target in configured_targets())
+
+# Async clients hold connection pools bound to the loop that created them
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def get_client(provider):
+    """
+    Returns the shared async client for `provider` on the running event loop.
+
+    Clients are keyed by provider, key and endpoint, so their connection
+    pools outlive a single consultation; all jobs share the job engine's loop.
+    """
+    spec = PROVIDERS[provider]
+    api_key = get_secret(spec["api_key"])
+    base_url = get_secret(spec["base_url"]) if spec["base_url"] else None
+    key = (provider, api_key, base_url)
+    with _clients_lock:
+        clients = _clients.setdefault(asyncio.get_running_loop(), {})
+        client = clients.get(key)
+        if client is None:
+            if spec["kind"] == "groq":
+                from groq import AsyncGroq
+                client = AsyncGroq(api_key=api_key)
+            else:
+                from openai import AsyncOpenAI
+                client = AsyncOpenAI(api_key=api_key or "not-needed", base_url=base_url)
+            clients[key] = client
+        return client
+
+def get_rate_limiter(provider):
+    rpm = float(get_secret(f"LLM_RPM_{provider.upper()}", DEFAULT_REQUESTS_PER_MINUTE))
+    return limits.get_provider_limiter(provider, rpm)
+
+def _delta_text(chunk):
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+class ChatStream:
+    """
+    Text deltas of one streamed completion. The first delta has already been
+    received when the stream is handed out.
+    """
+
+    def __init__(self, target, response, iterator, first):
+        self.target = target
+        self._response = response
+        self._iterator = iterator
+        self._first = first
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if self._first:
+            yield self._first
+        async for chunk in self._iterator:
+            text = _delta_text(chunk)
+            if text:
+                yield text
+
+    async def aclose(self):
+        await self._response.close()
+
+async def open_stream(target, messages, temperature=TEMPERATURE):
+    """
+    Starts a streamed completion on `target` and waits for its first token.
+    """
+    await get_rate_limiter(target.provider).acquire()
+    response = await get_client(target.provider).chat.completions.create(
+        messages=messages,
+        model=target.model,
+        temperature=temperature,
+        stream=True
+    )
+    iterator = response.__aiter__()
+    try:
+        async for chunk in iterator:
+            first = _delta_text(chunk)
+            if first:
+                return ChatStream(target, response, iterator, first)
+    except BaseException:
+        await response.close()
+        raise
+    return ChatStream(target, response, iterator, "")
+
+async def _discard(task):
+    """
+    Cancels a losing attempt, closing its stream if it already opened.
+    """
+    if not task.done():
+        task.cancel()
+    try:
+        stream = await task
+    except BaseException:
+        return
+    await stream.aclose()
+
+async def _first_successful(tasks):
+    """
+    Returns the stream of the first task to succeed and discards the rest.
+    Raises the last error if every task fails.
+    """
+    pending = set(tasks)
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            await _discard(task)
+
+async def stream_chat(messages, strategy=None, hedge_after=None, primary=None, secondary=None):
+    """
+    Opens a streamed chat completion using the configured strategy.
+
+    Strategies (LLM_STRATEGY):
+        single: only the primary target.
+        race:   primary and secondary start together; the first to produce a
+                token wins and the other is cancelled.
+        hedge:  the secondary starts only if the primary has not produced a
+                token within `hedge_after` seconds (LLM_HEDGE_AFTER_MS), or
+                fails before then.
+
+    Returns:
+        ChatStream: Async iterator over text deltas; close with `aclose()`.
+    """
+    configured_primary, configured_secondary = configured_targets()
+    primary = primary or configured_primary
+    secondary = secondary or configured_secondary
+    strategy = strategy or get_secret("LLM_STRATEGY", "single")
+    if hedge_after is None:
+        hedge_after = float(get_secret("LLM_HEDGE_AFTER_MS", 2000)) / 1000.0
+
+    if secondary is None or strategy == "single":
+        return await open_stream(primary, messages)
+
+    first = asyncio.ensure_future(open_stream(primary, messages))
+    if strategy == "hedge":
+        done, _ = await asyncio.wait([first], timeout=hedge_after)
+        if done and first.exception() is None:
+            return first.result()
+    second = asyncio.ensure_future(open_stream(secondary, messages))
+    return await _first_successful([first, second])
@@ -0,0 +1,290 @@
+import asyncio
+import atexit
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+from . import mcp_client
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks; one process per write-ahead file is assumed
+    fcntl = None
+from .utils import get_secret
+
+BATCH_SIZE = int(get_secret("LOG_BATCH_SIZE", 20))
+FLUSH_INTERVAL_SECONDS = float(get_secret("LOG_FLUSH_INTERVAL_SECONDS", 0.5))
+MAX_QUEUE = int(get_secret("LOG_MAX_QUEUE", 1000))
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 1.0
+# Entries that ran out of attempts are tried again after this long, so an
+# outage longer than the backoff (e.g. an open circuit breaker) loses nothing
+PARK_SECONDS = float(get_secret("LOG_PARK_SECONDS", 60))
+# The write-ahead file is rewritten with only the pending entries above this size
+COMPACT_BYTES = 1024 * 1024
+ENQUEUE_TIMEOUT_SECONDS = 0.5
+# Write-ahead files per LOG_WAL_PATH: one per live process (the path, then path.1, path.2, ...)
+MAX_WAL_SLOTS = 64
+
+def _open_locked(path):
+    """
+    Opens (creating, owner-only) and exclusively locks a write-ahead file.
+    Returns None when another process holds it. The lock lasts until close.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+    try:
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, 0o600)  # Files from older versions were world-readable
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    except BaseException:
+        os.close(fd)
+        raise
+    return os.fdopen(fd, "a+", encoding="utf-8")
+
+def _read_entries(f):
+    """
+    Returns the entries of an open write-ahead file that have no ack.
+    """
+    entries = {}
+    f.seek(0)
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # Torn final line from a crash mid-write
+        if "ack" in record:
+            entries.pop(record["ack"], None)
+        else:
+            entries[record["id"]] = record
+    return list(entries.values())
+
+async def send_to_backend(entry):
+    await mcp_client.call_backend_tool_async(
+        "save_consultation_log",
+        {"patient_id": entry["patient_id"], "log_entry": entry["log_entry"]},
+        raise_errors=True,
+    )
+
+class ConsultationLogWriter:
+    """
+    Asynchronous, durable writer for `save_consultation_log`.
+
+    `enqueue` appends the entry to a write-ahead file and returns at once. A
+    background thread drains the queue in batches, sends each batch
+    concurrently over the shared MCP connections, and records an ack in the
+    write-ahead file for every entry the backend accepted. Entries without an
+    ack are replayed on the next start, so a crash loses nothing.
+
+    Each process locks its own file (`wal_path`, else `wal_path.1`, ...), so
+    API workers and the UI on one host never replay or truncate each
+    other's entries; files left by processes that have exited are adopted.
+    """
+
+    def __init__(self, wal_path, send=send_to_backend, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL_SECONDS, max_queue=MAX_QUEUE,
+                 max_attempts=MAX_ATTEMPTS, retry_backoff=RETRY_BACKOFF_SECONDS, park_seconds=PARK_SECONDS):
+        self.wal_path = wal_path
+        self._send = send
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.park_seconds = park_seconds
+        self._parked = []
+        self._queue = queue.Queue(max_queue)
+        self._retry = []
+        self._unacked = {}
+        self._wal_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.sent = 0
+        self.failed = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(wal_path)), exist_ok=True)
+        self._wal = None
+        for slot in range(MAX_WAL_SLOTS):
+            path = wal_path if slot == 0 else f"{wal_path}.{slot}"
+            if self._wal is None:
+                self._wal = _open_locked(path)
+                if self._wal is not None:
+                    self.wal_path = path
+                    replay = _read_entries(self._wal)
+            elif os.path.exists(path):
+                replay.extend(self._adopt(path))
+        if self._wal is None:
+            raise OSError(f"All {MAX_WAL_SLOTS} write-ahead files at {wal_path} are in use.")
+        for entry in replay:
+            self._unacked[entry["id"]] = entry
+            self._retry.append((0.0, entry))
+
+        self._thread = threading.Thread(target=self._run, name="consultation-log-writer", daemon=True)
+        self._thread.start()
+
+    def _adopt(self, path):
+        """
+        Moves the unacknowledged entries of an exited process's file into
+        this one and empties it. Files still locked by a live process are left alone.
+        """
+        orphan = _open_locked(path)
+        if orphan is None:
+            return []
+        with orphan:
+            entries = _read_entries(orphan)
+            for entry in entries:
+                self._wal.write(json.dumps(entry) + "\n")
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+            orphan.truncate(0)
+        return entries
+
+    def _append(self, record):
+        with self._wal_lock:
+            self._wal.write(json.dumps(record) + "\n")
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+
+    def _ack(self, entry):
+        with self._wal_lock:
+            self._unacked.pop(entry["id"], None)
+            if not self._unacked:
+                # Nothing is pending; empty the file (keeping its lock)
+                self._wal.flush()
+                self._wal.truncate(0)
+                return
+            if self._wal.tell() > COMPACT_BYTES:
+                # Keep only what is still pending, so a long outage cannot grow the file without bound
+                self._wal.flush()
+                self._wal.truncate(0)
+                for pending in self._unacked.values():
+                    self._wal.write(json.dumps(pending) + "\n")
+                self._wal.flush()
+                os.fsync(self._wal.fileno())
+                return
+        self._append({"ack": entry["id"]})
+
+    @property
+    def pending(self):
+        return len(self._unacked)
+
+    def enqueue(self, patient_id, log_entry):
+        """
+        Records a consultation log for delivery.
+
+        Returns:
+            bool: False if the queue is full; the entry is still in the
+            write-ahead file and will be delivered after the next restart.
+        """
+        entry = {"id": uuid.uuid4().hex, "patient_id": patient_id, "log_entry": log_entry, "created_at": time.time()}
+        with self._wal_lock:
+            self._unacked[entry["id"]] = entry
+        self._append(entry)
+        try:
+            self._queue.put(entry, timeout=ENQUEUE_TIMEOUT_SECONDS)
+        except queue.Full:
+            return False
+        return True
+
+    def _take_batch(self):
+        now = time.monotonic()
+        batch = []
+        for item in [item for item in self._parked if item[0] <= now]:
+            self._parked.remove(item)
+            self._retry.append((now, item[1]))
+            self.failed -= 1
+        due = [item for item in self._retry if item[0] <= now]
+        for item in due[:self.batch_size]:
+            self._retry.remove(item)
+            batch.append(item[1])
+        deadline = now + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if batch and timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=max(timeout, 0.01)))
+            except queue.Empty:
+                if batch or self._stopping.is_set() or self._retry or any(due <= time.monotonic() for due, _ in self._parked):
+                    break
+                deadline = time.monotonic() + self.flush_interval
+        return batch
+
+    async def _send_batch(self, batch):
+        return await asyncio.gather(*(self._send(entry) for entry in batch), return_exceptions=True)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        while not (self._stopping.is_set() and self._queue.empty() and not self._due_retries()):
+            batch = self._take_batch()
+            if not batch:
+                continue
+            results = loop.run_until_complete(self._send_batch(batch))
+            for entry, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    self._schedule_retry(entry)
+                else:
+                    self.sent += 1
+                    self._ack(entry)
+        loop.close()
+
+    def _due_retries(self):
+        now = time.monotonic()
+        return [item for item in self._retry if item[0] <= now]
+
+    def _schedule_retry(self, entry):
+        attempts = entry.get("_attempts", 0) + 1
+        if attempts >= self.max_attempts:
+            # Out of attempts for now: parked, and still replayed from the write-ahead file after a restart
+            self.failed += 1
+            entry["_attempts"] = 0
+            self._parked.append((time.monotonic() + self.park_seconds, entry))
+            return
+        entry["_attempts"] = attempts
+        self._retry.append((time.monotonic() + self.retry_backoff * (2 ** (attempts - 1)), entry))
+
+    def flush(self, timeout=5.0):
+        """
+        Waits until every queued entry was delivered or gave up; returns True if none are pending.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._queue.empty() and not self._retry and self.pending <= self.failed:
+                break
+            time.sleep(0.01)
+        return self.pending == 0
+
+    def close(self, timeout=5.0):
+        self._stopping.set()
+        self._thread.join(timeout)
+        with self._wal_lock:
+            self._wal.close()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """
+    Returns the process-wide log writer; the write-ahead file lives at LOG_WAL_PATH.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            path = get_secret("LOG_WAL_PATH", os.path.join(tempfile.gettempdir(), "medgemma_consultation_logs.wal"))
+            _writer = ConsultationLogWriter(path)
+        return _writer
+
+def enqueue_log(patient_id, log_entry):
+    """
+    Queues a consultation log on the process-wide writer. It fsyncs and may
+    wait on a full queue, so event-loop callers run it in a thread.
+    """
+    return get_writer().enqueue(patient_id, log_entry)
+
+@atexit.register
+def close_writer():
+    if _writer is not None:
+        _writer.close()
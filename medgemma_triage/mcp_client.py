@@ -1,47 +1,521 @@
 import asyncio
-import streamlit as st
-from fastmcp import Client
+import atexit
+import logging
+import threading
+from . import limits
+from . import telemetry
+from . import tool_cache
+from . import tools
+from .cache import LRUCache
 from .utils import get_secret # Using relative import
 
-async def call_backend_tool_async(tool_name, arguments={}):
+DEFAULT_POOL_SIZE = 4
+NOT_CONFIGURED = "MCP_SERVER_URL is not configured."
+
+logger = logging.getLogger(__name__)
+
+# Seconds a call to each tool may take before it is abandoned and counted as
+# a failure; MCP_DEADLINE_<TOOL_NAME> overrides one, MCP_DEADLINE_SECONDS the rest
+TOOL_DEADLINES = {
+    "get_patient_history": 5.0,
+    "search_medical_web": 15.0,
+    "save_consultation_log": 10.0,
+}
+DEFAULT_DEADLINE_SECONDS = float(get_secret("MCP_DEADLINE_SECONDS", 20))
+
+# Served for read-only tools that fail when no earlier result is at hand
+DEGRADED_RESULTS = {
+    "get_patient_history": "No patient history found.",
+    "search_medical_web": "Search is temporarily unavailable. Continue with the information already provided.",
+}
+
+# Tools with side effects; a call that failed mid-flight may have been applied,
+# so they are never re-sent automatically (the log writer owns their retries)
+WRITE_TOOLS = frozenset(tool_cache.INVALIDATES)
+
+def is_session_error(error):
+    """
+    True for failures of the connection or session (the call may never have
+    reached the tool), as opposed to errors the tool itself reported.
     """
-    Asynchronously calls a tool on the backend MCP server using SSE.
+    if isinstance(error, (OSError, EOFError)):
+        return True
+    import anyio
+    import httpx
+    return isinstance(error, (httpx.TransportError, anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream))
+
+def is_backend_failure(error):
+    """
+    True for errors that say the backend is unhealthy (unreachable, timed
+    out, overloaded or answering 5xx); only these count toward its circuit
+    breaker. Errors about the call itself (bad arguments, 4xx, a tool
+    reporting an error) do not.
+    """
+    if isinstance(error, (TimeoutError, limits.OverloadedError)) or is_session_error(error):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)  # httpx.HTTPStatusError
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+def __getattr__(name):
+    # fastmcp dominates this module's import time, so it is loaded on first connect
+    if name == "Client":
+        return tools.Client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _client_class():
+    return globals().get("Client") or __getattr__("Client")
+
+def _format_tool_result(result):
     """
-    mcp_url = get_secret("MCP_SERVER_URL")
+    Flattens an MCP tool result into plain text.
+    """
+    if hasattr(result, 'content'):
+        return "".join([c.text for c in result.content if c.type == 'text'])
+    return str(result)
+
+class MCPSessionManager:
+    """
+    Process-wide owner of long-lived MCP connections.
+
+    A dedicated event loop runs on a daemon thread and keeps a small pool of
+    connected `fastmcp.Client` instances, so tool calls reuse an open SSE
+    session instead of paying a connect/handshake per call. Clients that fail
+    are discarded and transparently replaced on the next acquire.
+    """
+
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE, retries=1):
+        self.url = url
+        self.pool_size = pool_size
+        self.retries = retries
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="mcp-session", daemon=True)
+        self._thread.start()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    async def _connect(self):
+        client = _client_class()(self.url)
+        await client.__aenter__()
+        return client
+
+    async def _discard(self, client):
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception:
+            pass
+
+    async def _acquire(self):
+        await self._slots.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            return await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, client):
+        self._idle.append(client)
+        self._slots.release()
+
+    async def _run(self, operation, retry=True):
+        """
+        Runs `operation(client)` on a pooled client. A broken session is
+        replaced and, when `retry` is set, the call re-sent on a new one;
+        errors reported by the tool leave the session pooled and are raised.
+        Must be awaited on the manager's own loop.
+        """
+        retries = self.retries if retry else 0
+        for attempt in range(retries + 1):
+            client = await self._acquire()
+            try:
+                result = await operation(client)
+            except asyncio.CancelledError:
+                # Abandoned mid-call (e.g. a deadline); the session's state is unknown
+                asyncio.ensure_future(self._discard(client))
+                self._slots.release()
+                raise
+            except Exception as e:
+                if not is_session_error(e):
+                    self._release(client)
+                    raise
+                await self._discard(client)
+                self._slots.release()
+                if attempt == retries:
+                    raise
+                continue
+            self._release(client)
+            return result
+
+    async def _dispatch(self, coro):
+        """
+        Awaits `coro` on the manager loop from any event loop.
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._loop))
+
+    async def call_tool_async(self, tool_name, arguments):
+        async def operation(client):
+            return await client.call_tool(tool_name, arguments=arguments)
+        retry = tool_name not in WRITE_TOOLS
+        return _format_tool_result(await self._dispatch(self._run(operation, retry)))
+
+    async def list_tools_async(self):
+        async def operation(client):
+            return await client.list_tools()
+        return await self._dispatch(self._run(operation))
+
+    def call_tool(self, tool_name, arguments, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(self.call_tool_async(tool_name, arguments), self._loop)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def list_tools(self):
+        return asyncio.run_coroutine_threadsafe(self.list_tools_async(), self._loop).result()
+
+    async def _close_all(self):
+        while self._idle:
+            await self._discard(self._idle.pop())
+
+    def close(self):
+        """
+        Disconnects pooled clients and stops the background loop.
+        """
+        if not self._loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_all(), self._loop).result(timeout=5)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+def use_http_transport():
+    """
+    True when MCP_TRANSPORT selects the direct HTTP tool layer instead of SSE.
+    """
+    return (get_secret("MCP_TRANSPORT") or "sse").lower() == "http"
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_session_manager(mcp_url=None):
+    """
+    Returns the shared session manager for `mcp_url` (defaults to MCP_SERVER_URL).
+    """
+    mcp_url = mcp_url or get_secret("MCP_SERVER_URL")
     if not mcp_url:
-        st.error("MCP_SERVER_URL is not configured in st.secrets.")
         return None
+    with _managers_lock:
+        manager = _managers.get(mcp_url)
+        if manager is None:
+            pool_size = int(get_secret("MCP_POOL_SIZE", DEFAULT_POOL_SIZE))
+            manager = _managers[mcp_url] = MCPSessionManager(mcp_url, pool_size=pool_size)
+        return manager
+
+@atexit.register
+def close_session_managers():
+    with _managers_lock:
+        managers = list(_managers.values())
+        _managers.clear()
+    for manager in managers:
+        manager.close()
+
+class MCPNotConfiguredError(RuntimeError):
+    """Raised when no MCP server URL is available."""
+
+def tool_deadline(tool_name):
+    return float(get_secret(f"MCP_DEADLINE_{tool_name.upper()}", TOOL_DEADLINES.get(tool_name, DEFAULT_DEADLINE_SECONDS)))
+
+_breakers = {}
+_limiter = None
+_limits_lock = threading.Lock()
+
+def get_breaker(tool_name):
+    """
+    Returns the process-wide circuit breaker for one tool, so a failing
+    search engine does not also cut off patient history.
+    """
+    with _limits_lock:
+        breaker = _breakers.get(tool_name)
+        if breaker is None:
+            breaker = _breakers[tool_name] = limits.CircuitBreaker(
+                failure_threshold=int(get_secret("MCP_BREAKER_FAILURES", 5)),
+                reset_timeout=float(get_secret("MCP_BREAKER_RESET_SECONDS", 30)),
+            )
+        return breaker
+
+def get_limiter():
+    """
+    Returns the process-wide limiter on backend calls in flight
+    (MCP_MAX_CONCURRENCY), shared by consultations, batches and log writes.
+    """
+    global _limiter
+    with _limits_lock:
+        if _limiter is None:
+            _limiter = limits.ConcurrencyLimiter(
+                int(get_secret("MCP_MAX_CONCURRENCY", 32)),
+                max_queue_seconds=float(get_secret("MCP_QUEUE_TIMEOUT_SECONDS", 2)),
+            )
+        return _limiter
+
+# Last good result of each degradable call, served while the tool is down
+_last_good = LRUCache(8 * 1024 * 1024, sizeof=lambda value: len(value.encode("utf-8")))
+
+def _remember(tool_name, arguments, result):
+    if tool_name in DEGRADED_RESULTS and isinstance(result, str):
+        _last_good.put(tool_cache.cache_key(tool_name, arguments), result)
+
+def degraded_result(tool_name, arguments):
+    """
+    Returns the stand-in for a failed read-only call: its last good result,
+    else the tool's fixed fallback, else None (the failure is surfaced).
+    """
+    if tool_name not in DEGRADED_RESULTS:
+        return None
+    return _last_good.get(tool_cache.cache_key(tool_name, arguments)) or DEGRADED_RESULTS[tool_name]
+
+def _circuit_open(tool_name):
+    return limits.CircuitOpenError(f"'{tool_name}' is failing; calls are paused while it recovers")
+
+_tool_cache = None
+_tool_cache_lock = threading.Lock()
+
+def get_tool_cache():
+    """
+    Returns the process-wide tool-result cache, or None when TOOL_CACHE_BACKEND=off.
+    """
+    global _tool_cache
+    with _tool_cache_lock:
+        if _tool_cache is None:
+            backend = tool_cache.create_backend()
+            _tool_cache = tool_cache.ToolResultCache(backend) if backend is not None else False
+        return _tool_cache or None
+
+# Tools whose free-text `query` may be answered by a semantically similar past query
+SEMANTIC_TOOLS = {"search_medical_web"}
+
+_semantic_cache = None
+
+def get_semantic_cache():
+    """
+    Returns the process-wide semantic search cache, or None when SEMANTIC_CACHE=off.
+    """
+    global _semantic_cache
+    with _tool_cache_lock:
+        if _semantic_cache is None:
+            enabled = (get_secret("SEMANTIC_CACHE") or "on").lower() != "off"
+            if enabled:
+                from . import semantic_cache  # Pulls in numpy; only needed once a search runs
+                _semantic_cache = semantic_cache.SemanticSearchCache()
+            else:
+                _semantic_cache = False
+        return _semantic_cache or None
+
+def _semantic_target(tool_name, arguments):
+    if tool_name not in SEMANTIC_TOOLS or not arguments or not arguments.get("query"):
+        return None
+    return get_semantic_cache()
+
+def _call_with_semantic_cache(tool_name, arguments, call):
+    semantic = _semantic_target(tool_name, arguments)
+    if semantic is None:
+        return call()
+    result, vector = semantic.lookup(arguments["query"])
+    if result is None:
+        result = call()
+        semantic.store(arguments["query"], result, vector)
+    return result
+
+async def _call_with_semantic_cache_async(tool_name, arguments, call):
+    semantic = _semantic_target(tool_name, arguments)
+    if semantic is None:
+        return await call()
+    # Embedding is CPU-bound; keep it off the event loop
+    result, vector = await asyncio.to_thread(semantic.lookup, arguments["query"])
+    if result is None:
+        result = await call()
+        await asyncio.to_thread(semantic.store, arguments["query"], result, vector)
+    return result
 
+def _http_retries(tool_name):
+    # A write that timed out may have been applied; re-sending it could save it twice
+    return 0 if tool_name in WRITE_TOOLS else tools.MAX_RETRIES
+
+async def _call_tool_async(tool_name, arguments):
+    if use_http_transport():
+        return await tools.call_tool_async(tool_name, arguments, retries=_http_retries(tool_name))
+    manager = get_session_manager()
+    if manager is None:
+        raise MCPNotConfiguredError(NOT_CONFIGURED)
+    return await manager.call_tool_async(tool_name, arguments)
+
+def _call_tool(tool_name, arguments):
+    if use_http_transport():
+        return tools.call_fastmcp_tool(tool_name, arguments, retries=_http_retries(tool_name))
+    manager = get_session_manager()
+    if manager is None:
+        raise MCPNotConfiguredError(NOT_CONFIGURED)
+    return manager.call_tool(tool_name, arguments, timeout=tool_deadline(tool_name))
+
+async def _guarded_call_async(tool_name, arguments):
+    """
+    Calls the backend behind the tool's circuit breaker, the shared
+    concurrency limiter and the tool's deadline.
+    """
+    breaker = get_breaker(tool_name)
+    if breaker.state == limits.OPEN:
+        raise _circuit_open(tool_name)  # Fail fast without queueing for a slot
+    limiter = get_limiter()
+    await limiter.acquire()
     try:
-        async with Client(mcp_url) as client:
-            result = await client.call_tool(tool_name, arguments=arguments)
-            if hasattr(result, 'content'):
-                return "".join([c.text for c in result.content if c.type == 'text'])
-            return str(result)
-    except Exception as e:
-        st.error(f"Error calling backend tool '{tool_name}': {e}")
+        # Only claimed once a slot is held, so an overload cannot strand a half-open trial
+        if not breaker.allow():
+            raise _circuit_open(tool_name)
+        deadline = tool_deadline(tool_name)
+        try:
+            result = await asyncio.wait_for(_call_tool_async(tool_name, arguments), deadline)
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            raise TimeoutError(f"'{tool_name}' did not answer within {deadline:g}s") from None
+        except MCPNotConfiguredError:
+            breaker.release_trial()
+            raise
+        except Exception as e:
+            if is_backend_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # The backend answered; the call itself was rejected
+            raise
+        except BaseException:
+            breaker.release_trial()  # Cancelled: says nothing about the backend
+            raise
+    finally:
+        limiter.release()
+    breaker.record_success()
+    _remember(tool_name, arguments, result)
+    return result
+
+def _guarded_call(tool_name, arguments):
+    """
+    Synchronous counterpart of `_guarded_call_async`. Over HTTP the deadline
+    is left to the client's own timeouts.
+    """
+    breaker = get_breaker(tool_name)
+    if breaker.state == limits.OPEN:
+        raise _circuit_open(tool_name)
+    limiter = get_limiter()
+    limiter.acquire_sync()
+    try:
+        if not breaker.allow():
+            raise _circuit_open(tool_name)
+        try:
+            result = _call_tool(tool_name, arguments)
+        except MCPNotConfiguredError:
+            breaker.release_trial()
+            raise
+        except Exception as e:
+            if is_backend_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # The backend answered; the call itself was rejected
+            raise
+        except BaseException:
+            breaker.release_trial()
+            raise
+    finally:
+        limiter.release()
+    breaker.record_success()
+    _remember(tool_name, arguments, result)
+    return result
+
+def _failed(tool_name, arguments, error, raise_errors):
+    if raise_errors:
+        raise error
+    if isinstance(error, MCPNotConfiguredError):
+        logger.error(str(error))
         return None
+    fallback = degraded_result(tool_name, arguments)
+    if fallback is not None:
+        telemetry.REGISTRY.increment("mcp_degraded_total", labels={"tool": tool_name, "reason": type(error).__name__})
+        return fallback
+    logger.error("Error calling backend tool '%s': %s", tool_name, error)
+    return None
 
-def call_backend_tool(tool_name, arguments={}):
+async def call_backend_tool_async(tool_name, arguments={}, raise_errors=False):
+    """
+    Asynchronously calls a tool on the backend MCP server over the pooled SSE
+    session, or over HTTP when MCP_TRANSPORT=http. Read-only tools are served
+    from the tool-result cache when possible.
+
+    Each call has a per-tool deadline, waits at most MCP_QUEUE_TIMEOUT_SECONDS
+    for a slot under MCP_MAX_CONCURRENCY, and fails fast while the tool's
+    circuit breaker is open. A failed read-only call returns its last good
+    result or a degraded placeholder (see `DEGRADED_RESULTS`); other errors
+    are logged and return None, unless `raise_errors` is set.
+    """
+    cache = get_tool_cache()
+    try:
+        with telemetry.span("mcp_tool_call", tool=tool_name):
+            if cache is not None and cache.cacheable(tool_name):
+                return await cache.call_async(tool_name, arguments, lambda: _call_with_semantic_cache_async(
+                    tool_name, arguments, lambda: _guarded_call_async(tool_name, arguments)))
+            result = await _guarded_call_async(tool_name, arguments)
+        if cache is not None:
+            cache.after_write(tool_name, arguments)
+        return result
+    except Exception as e:
+        return _failed(tool_name, arguments, e, raise_errors)
+
+def call_backend_tool(tool_name, arguments={}, raise_errors=False):
     """
     Synchronous wrapper for calling a backend tool.
     """
-    return asyncio.run(call_backend_tool_async(tool_name, arguments))
+    cache = get_tool_cache()
+    try:
+        with telemetry.span("mcp_tool_call", tool=tool_name):
+            if cache is not None and cache.cacheable(tool_name):
+                return cache.call(tool_name, arguments, lambda: _call_with_semantic_cache(
+                    tool_name, arguments, lambda: _guarded_call(tool_name, arguments)))
+            result = _guarded_call(tool_name, arguments)
+        if cache is not None:
+            cache.after_write(tool_name, arguments)
+        return result
+    except Exception as e:
+        return _failed(tool_name, arguments, e, raise_errors)
 
 async def list_backend_tools_async():
     """
     Asynchronously lists available tools from the MCP server.
     """
-    mcp_url = get_secret("MCP_SERVER_URL")
-    if not mcp_url:
-        st.error("MCP_SERVER_URL is not configured in st.secrets.")
+    manager = get_session_manager()
+    if manager is None:
+        logger.error(NOT_CONFIGURED)
         return None
 
-    async with Client(mcp_url) as client:
-        return await client.list_tools()
+    return await manager.list_tools_async()
 
 def list_backend_tools():
     """
     Synchronous wrapper for listing available backend tools.
     """
-    return asyncio.run(list_backend_tools_async())
+    manager = get_session_manager()
+    if manager is None:
+        logger.error(NOT_CONFIGURED)
+        return None
+
+    return manager.list_tools()
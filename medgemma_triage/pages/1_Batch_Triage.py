@@ -0,0 +1,132 @@
+import os
+import sys
+
+# Add the project root to the Python path (see app.py)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import contextlib
+import tempfile
+import time
+import weakref
+import streamlit as st
+from medgemma_triage import batch, pretriage, ui, uploads
+
+st.set_page_config(page_title="Batch Triage", page_icon="🩺", layout="wide")
+ui.setup_styles()
+
+POLL_SECONDS = 0.5
+
+def uploaded_file_resolver(files):
+    """
+    Resolves a row's file entries against the documents uploaded with the batch.
+
+    Returns:
+        tuple: `(resolve, release)`; call `release()` once the batch is done
+        to return the detached copies' memory and delete their spool files.
+    """
+    if "upload_budget" not in st.session_state:
+        st.session_state.upload_budget = uploads.MemoryBudget()
+    by_name = {upload.name: uploads.FileRef.from_upload(upload, st.session_state.upload_budget) for upload in files or []}
+
+    def resolve(name):
+        ref = by_name.get(os.path.basename(name))
+        if ref is None:
+            raise FileNotFoundError(f"'{name}' was not uploaded with the batch")
+        return ref
+    return resolve, lambda: uploads.release_all(by_name.values())
+
+def follow_batch(run):
+    """Shows batch progress until it finishes; safe to call again after a rerun."""
+    progress = st.progress(0.0)
+    table = st.empty()
+    while True:
+        finished = run.finished
+        done, failed, total, recent = run.progress()
+        progress.progress(done / total if total else 1.0, text=f"{done} of {total} consultations done, {failed} failed")
+        table.dataframe(
+            [
+                {"row": r["row"], "patient_id": r["patient_id"], "status": r["status"],
+                 "provisional": (r.get("pretriage") or {}).get("level"),
+                 **{k: r.get(k) for k in ("duration_seconds", "summary", "error")}}
+                for r in reversed(recent)
+            ],
+            use_container_width=True,
+            hide_index=True,
+        )
+        if finished:
+            break
+        time.sleep(POLL_SECONDS)
+    if run.error:
+        st.error(f"The batch stopped: {run.error}")
+    else:
+        st.success(f"Batch complete: {done - failed} succeeded, {failed} failed.")
+    st.download_button("Download results (JSONL)", collect_results(run), file_name="triage_results.jsonl", mime="application/x-ndjson")
+
+def remove_output(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+def collect_results(run):
+    """
+    Moves a finished batch's results from its output file into the session
+    and deletes the file, so patient data does not outlive the session on disk.
+    """
+    results_id, results = st.session_state.get("batch_results", (None, b""))
+    if results_id != run.id:
+        try:
+            with open(run.output_path, "rb") as f:
+                results = f.read()
+            remove_output(run.output_path)
+        except FileNotFoundError:
+            results = b""
+        st.session_state.batch_results = (run.id, results)
+    return results
+
+st.title("Batch Triage")
+st.markdown(
+    "Upload a CSV with `patient_id`, `notes` and `files` columns (file names separated by `;`), "
+    "or JSON lines with the same keys, plus the documents the rows refer to."
+)
+
+batch_file = st.file_uploader("Batch file (CSV or JSONL)", type=["csv", "jsonl", "ndjson"])
+documents = st.file_uploader("Documents referenced by the batch", accept_multiple_files=True)
+concurrency = st.slider("Consultations in parallel", 1, 64, min(batch.BATCH_CONCURRENCY, 64))
+
+def read_rows():
+    format = "csv" if batch_file.name.lower().endswith(".csv") else "jsonl"
+    try:
+        return batch.parse_batch(batch_file.getvalue().decode("utf-8-sig"), format)
+    except ValueError as e:
+        st.error(f"Could not read the batch file: {e}")
+        return None
+
+run_col, pretriage_col = st.columns(2)
+if run_col.button("Run Batch", type="primary", disabled=batch_file is None, use_container_width=True):
+    rows = read_rows()
+    if rows is not None:
+        # Private to this user (0600) and unique per batch; deleted once the results are read back
+        fd, output_path = tempfile.mkstemp(prefix="triage_batch_", suffix=".jsonl")
+        os.close(fd)
+        resolve, release = uploaded_file_resolver(documents)
+        previous = st.session_state.get("batch_run")
+        if previous is not None:
+            remove_output(previous.output_path)
+        run = batch.start_batch(rows, output_path, concurrency, resolve, on_finish=release)
+        # Also deleted when the session ends before the results were read back
+        weakref.finalize(run, remove_output, output_path)
+        st.session_state.batch_run = run
+
+if pretriage_col.button("Pre-triage Notes Only", disabled=batch_file is None, use_container_width=True):
+    rows = read_rows()
+    if rows is not None:
+        # Local rules and embeddings only: the whole list is scored in one pass, most severe first
+        scored = batch.pretriage_rows(rows)
+        scored.sort(key=lambda r: pretriage.LEVELS.index(r["level"]))
+        st.dataframe(
+            [dict(r, red_flags=", ".join(r["red_flags"])) for r in scored],
+            use_container_width=True,
+            hide_index=True,
+        )
+
+if st.session_state.get("batch_run") is not None:
+    follow_batch(st.session_state.batch_run)
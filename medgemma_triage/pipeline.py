@@ -0,0 +1,294 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import consultation_store
+from . import context
+from . import images
+from . import llm
+from . import log_writer
+from . import mcp_client
+from . import pretriage
+from . import prompts
+from . import speculation
+from . import streaming
+from . import telemetry
+from . import utils
+from .uploads import FileRef  # noqa: F401 (re-exported; jobs and batch build FileRefs)
+
+COMPILE_DEADLINE_SECONDS = float(utils.get_secret("COMPILE_DEADLINE_SECONDS", 20))
+NO_HISTORY = "No patient history found."
+
+# Worker pool for blocking document extraction during data compilation
+_EXECUTOR = ThreadPoolExecutor(max_workers=int(utils.get_secret("COMPILE_WORKERS", 8)), thread_name_prefix="compile")
+
+def _describe_images(prepared_images):
+    described = []
+    for image in prepared_images:
+        if "error" in image:
+            described.append(f"{image['name']} (could not be processed: {image['error']})")
+        else:
+            described.append(f"{image['name']} (attached)")
+    return ", ".join(described)
+
+def build_initial_prompt(patient_id, notes, history, doc_texts, prepared_images=None):
+    """
+    Builds the first user message of the consultation from the compiled data.
+    """
+    attached = f"\n        **Attached Images:** {_describe_images(prepared_images)}" if prepared_images else ""
+    return f"""
+        **Patient ID:** {patient_id}
+        **Physician's Notes:** {notes}
+        **Patient History:** {history}
+        **Uploaded Document Contents:** {doc_texts}{attached}
+        **Instructions:**
+        Based on all available data, provide a clinical analysis. If you need more information, use the [SEARCH: query] tool.
+        Structure your final response with the headings: ### Executive Summary, ### Detailed Reasoning, and ### Sources & Search Data.
+        """
+
+async def fetch_patient_history_async(patient_id):
+    """
+    Patient history, read through the local consultation store: a copy
+    fetched within LOCAL_HISTORY_TTL_SECONDS is served without a backend
+    call. Degraded stand-ins for a failed fetch are not cached.
+    """
+    store = consultation_store.get_store()
+    if store is not None and patient_id:
+        try:
+            cached = await asyncio.to_thread(store.cached_history, patient_id)
+        except Exception:
+            cached = None  # A broken store only costs the cache
+        if cached is not None:
+            telemetry.REGISTRY.increment("patient_history_lookups_total", labels={"source": "local"})
+            return cached
+    telemetry.REGISTRY.increment("patient_history_lookups_total", labels={"source": "backend"})
+    history = await mcp_client.call_backend_tool_async("get_patient_history", {"patient_id": patient_id})
+    if store is not None and patient_id and history and history not in mcp_client.DEGRADED_RESULTS.values():
+        try:
+            await asyncio.to_thread(store.store_history, patient_id, str(history))
+        except Exception:
+            pass
+    return history
+
+def _timed_out_document(file):
+    return f"--- Document: {file.name} ---\nExtraction did not finish before the deadline.\n--- End Document ---"
+
+@telemetry.timed("compile_patient_data")
+async def compile_patient_data_async(patient_id, files, tool_calls=None, deadline=None, on_progress=None):
+    """
+    Gathers all pre-LLM inputs concurrently.
+
+    The patient history fetch, any extra backend tool calls and per-file
+    document extraction all run in parallel. Whatever has not finished when
+    the deadline hits is replaced by a placeholder so the consultation can
+    start anyway.
+
+    Args:
+        patient_id (str): The patient whose history is fetched.
+        files (list): Uploaded files; images are passed through untouched.
+        tool_calls (dict): Optional extra calls, `{key: (tool_name, arguments)}`.
+        deadline (float): Seconds to wait before giving up on slow inputs.
+        on_progress (callable): `on_progress(name, done, total)` for PDF pages,
+            always invoked on the calling event loop's thread.
+
+    Returns:
+        dict: `history`, `doc_texts`, `image_files`, `images` (prepared for the
+        model, see `images.prepare_images_async`) and `tool_results` (by key).
+    """
+    deadline = COMPILE_DEADLINE_SECONDS if deadline is None else deadline
+    loop = asyncio.get_running_loop()
+    files = files or []
+    tool_calls = tool_calls or {}
+
+    history_task = asyncio.ensure_future(fetch_patient_history_async(patient_id))
+    tool_tasks = {
+        key: asyncio.ensure_future(mcp_client.call_backend_tool_async(name, args))
+        for key, (name, args) in tool_calls.items()
+    }
+    image_files = [f for f in files if utils.is_image_file(f)]
+    documents = [f for f in files if not utils.is_image_file(f)]
+    report = None
+    if on_progress:
+        def report(*args):
+            try:
+                loop.call_soon_threadsafe(on_progress, *args)
+            except RuntimeError:
+                pass  # Loop already closed after the deadline
+    # Each worker runs in a copy of this context so its spans land in the consultation's trace
+    doc_futures = [
+        loop.run_in_executor(_EXECUTOR, contextvars.copy_context().run, utils.extract_document_text, f, report)
+        for f in documents
+    ]
+
+    image_task = None
+    if image_files and images.images_enabled(llm.targets_key()):
+        image_task = asyncio.ensure_future(images.prepare_images_async(image_files))
+
+    pending_all = [history_task, *tool_tasks.values(), *doc_futures, *([image_task] if image_task else [])]
+    _, pending = await asyncio.wait(pending_all, timeout=deadline)
+    for task in pending:
+        task.cancel()
+
+    def result_of(task, default):
+        if task in pending or task.cancelled() or task.exception() is not None:
+            return default
+        return task.result()
+
+    doc_texts = []
+    for file, future in zip(documents, doc_futures):
+        text = result_of(future, _timed_out_document(file))
+        if text is not None:
+            doc_texts.append(text)
+
+    return {
+        "history": result_of(history_task, None) or NO_HISTORY,
+        "doc_texts": "\n\n".join(doc_texts),
+        "image_files": image_files,
+        "images": result_of(image_task, []) if image_task else [],
+        "tool_results": {key: result_of(task, None) for key, task in tool_tasks.items()},
+    }
+
+def compile_patient_data(patient_id, files, tool_calls=None, deadline=None, on_progress=None):
+    """
+    Synchronous wrapper for `compile_patient_data_async`.
+    """
+    return asyncio.run(compile_patient_data_async(patient_id, files, tool_calls, deadline, on_progress))
+
+MAX_AGENT_TURNS = 3 # Allow up to 3 turns for the agentic loop
+
+def _emit_nothing(kind, payload=None):
+    pass
+
+async def run_consultation_async(patient_id, notes, files, on_event=None):
+    """
+    Runs the full consultation without touching Streamlit.
+
+    Progress is reported through `on_event(kind, payload)` with kinds
+    `pretriage` (provisional level, see `pretriage.pretriage`), `stage`,
+    `progress`, `raw_data`, `turn` (new model turn), `token`, `search` and
+    `result`.
+
+    Args:
+        patient_id (str): Patient identifier.
+        notes (str): Physician notes.
+        files (list): Uploaded files or `FileRef`s.
+        on_event (callable): Event sink; called on the running loop's thread.
+
+    Returns:
+        dict: `summary`, `reasoning`, `sources`, `raw_data`, `full_response`,
+        `pretriage` and `timings` (the consultation's spans, see
+        `telemetry.Trace`).
+    """
+    emit = on_event or _emit_nothing
+    trace = telemetry.start_trace()
+
+    # Local rules and embeddings give a provisional level long before the model answers
+    with telemetry.span("pretriage"):
+        provisional = await asyncio.to_thread(pretriage.pretriage, notes)
+    emit("pretriage", provisional)
+    # Searches the red flags make likely run while data is compiled and the first turn streams
+    speculative = speculation.SpeculativeSearch()
+    speculative.start(speculation.likely_queries(provisional))
+    try:
+        return await _consult(patient_id, notes, files, emit, trace, provisional, speculative)
+    finally:
+        speculative.finish()
+
+async def _consult(patient_id, notes, files, emit, trace, provisional, speculative):
+    emit("stage", "Compiling patient data...")
+    compiled = await compile_patient_data_async(
+        patient_id, files, on_progress=lambda name, done, total: emit("progress", (name, done, total))
+    )
+    if compiled["doc_texts"]:
+        with telemetry.span("pretriage", stage="documents"):
+            provisional = await asyncio.to_thread(pretriage.pretriage, notes, compiled["doc_texts"])
+        emit("pretriage", provisional)
+        speculative.start(speculation.likely_queries(provisional))
+    # Ranking chunks may run the embedding model; keep it off the event loop
+    with telemetry.span("fit_documents"):
+        doc_texts = await asyncio.to_thread(context.fit_documents, compiled["doc_texts"], notes or "")
+    history = context.truncate(compiled["history"], context.HISTORY_TOKEN_BUDGET, note="older history")
+    initial_prompt = build_initial_prompt(patient_id, notes, history, doc_texts, compiled["images"])
+    emit("raw_data", initial_prompt)
+
+    messages = [
+        {"role": "system", "content": prompts.SYSTEM_PROMPT},
+        {"role": "user", "content": images.user_content(initial_prompt, compiled["images"])},
+    ]
+    full_response = ""
+    for turn in range(MAX_AGENT_TURNS):
+        emit("stage", "AI is analyzing...")
+        emit("turn", turn)
+        with telemetry.span("llm_time_to_first_token") as first_token:
+            first_token.annotate(turn=turn)
+            try:
+                response_stream = await llm.stream_chat(context.fit_messages(messages))
+            except Exception as e:
+                if getattr(e, "status_code", None) != 400 or not images.has_images(messages):
+                    raise
+                # The model rejected image input; continue text-only, and skip images for it from now on
+                images.mark_text_only(llm.targets_key())
+                messages = images.without_images(messages)
+                response_stream = await llm.stream_chat(context.fit_messages(messages))
+
+        parts = []
+        parser = streaming.SearchCommandParser()
+        searches = {}
+        ran = {}  # Model query -> the speculative query whose results answer it
+        # No turn is left to answer a search on the last one, so its whole answer is kept
+        can_search = turn < MAX_AGENT_TURNS - 1
+        generation_started = time.perf_counter()
+        try:
+            async for content in response_stream:
+                parts.append(content)
+                emit("token", content)
+                if not can_search:
+                    continue
+                # Start each search the moment its command closes
+                for query in parser.feed(content):
+                    if query in searches:
+                        continue
+                    # A search started speculatively for the same question is reused, often already finished
+                    claimed = await speculative.claim(query)
+                    if claimed:
+                        ran[query], searches[query] = claimed
+                    else:
+                        searches[query] = asyncio.ensure_future(
+                            mcp_client.call_backend_tool_async("search_medical_web", {"query": query})
+                        )
+                if parser.should_stop():
+                    break # Cancel the rest of the generation; it would be discarded anyway
+        finally:
+            await response_stream.aclose()
+        full_response = "".join(parts)
+        generation_seconds = time.perf_counter() - generation_started
+        tokens = context.estimate_tokens(full_response)
+        telemetry.record("llm_generation", generation_seconds, start=generation_started, attributes={"turn": turn, "tokens": tokens})
+        telemetry.record_throughput("llm_output", tokens, generation_seconds)
+
+        if not searches:
+            break # No search command found, so we're done.
+        messages.append({"role": "assistant", "content": full_response})
+        emit("stage", f"Searching for: {', '.join(searches)}...")
+        emit("search", list(searches))
+        with telemetry.span("search_wait"):
+            results = await asyncio.gather(*searches.values())
+        messages.append({"role": "user", "content": "\n\n".join(
+            f"Search results for '{ran.get(query, query)}':\n{context.truncate(str(result), context.SEARCH_RESULT_TOKEN_BUDGET)}"
+            for query, result in zip(searches, results)
+        )})
+
+    parsed_response = utils.parse_dashboard_response(full_response)
+    telemetry.record("consultation", trace.elapsed(), start=trace.started)
+    result = dict(parsed_response, raw_data=initial_prompt, full_response=full_response,
+                  pretriage=provisional, timings=trace.breakdown())
+    emit("result", result)
+
+    # Delivered in the background; the consultation doesn't wait on the backend write
+    with telemetry.span("log_enqueue"):
+        await asyncio.to_thread(log_writer.enqueue_log, patient_id, full_response)
+
+    # Kept locally so the analysis can be restored and repeat history lookups stay local (optional; never fails the consultation)
+    with telemetry.span("store_save"):
+        await asyncio.to_thread(consultation_store.record_consultation, patient_id, notes, result)
+    return result
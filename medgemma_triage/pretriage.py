@@ -0,0 +1,255 @@
+import re
+import threading
+import time
+from . import embeddings
+from .utils import get_secret
+
+EMERGENCY = "EMERGENCY"
+URGENT = "URGENT"
+STABLE = "STABLE"
+# Most severe first; a case takes the most severe level any signal gives it
+LEVELS = (EMERGENCY, URGENT, STABLE)
+
+# Characters of document text considered; the opening pages carry the presenting complaint
+DOCUMENT_CHARS = int(get_secret("PRETRIAGE_DOCUMENT_CHARS", 2000))
+# Minimum lead of the best centroid over the runner-up before the classifier's level is used
+MIN_MARGIN = float(get_secret("PRETRIAGE_MIN_MARGIN", 0.02))
+
+# (level, flag, pattern). Patterns run on lower-cased text.
+RED_FLAG_RULES = [
+    (EMERGENCY, "chest pain", r"chest (pain|pressure|tightness)|crushing pain|pain radiating to (the )?(left )?(arm|jaw)"),
+    (EMERGENCY, "breathing difficulty", r"(severe|acute) (shortness of breath|dyspnea|dyspnoea|respiratory distress)|can(no|')t breathe|unable to breathe|struggling to breathe|stridor|cyanosis|cyanotic"),
+    (EMERGENCY, "stroke signs", r"facial droop|slurred speech|(one|left|right)[- ]sided weakness|hemiparesis|sudden (loss of vision|confusion)|aphasia"),
+    (EMERGENCY, "reduced consciousness", r"unresponsive|unconscious|loss of consciousness|gcs (of )?([3-8])\b"),
+    (EMERGENCY, "seizure", r"seizure|convulsion|status epilepticus"),
+    (EMERGENCY, "anaphylaxis", r"anaphyla|throat (swelling|closing)|swollen tongue"),
+    (EMERGENCY, "major bleeding", r"(severe|uncontrolled|massive) (bleeding|hemorrhage|haemorrhage)|vomiting blood|hematemesis|haematemesis|coughing (up )?blood|melena"),
+    (EMERGENCY, "suicide risk", r"suicid|overdose|self[- ]harm"),
+    (EMERGENCY, "worst headache", r"worst headache|thunderclap"),
+    (EMERGENCY, "sepsis signs", r"septic|sepsis|mottled skin"),
+    (URGENT, "high fever", r"high fever|fever of (39|4[0-2])|\b(39|40|41)(\.\d)? ?(°|deg|c\b)"),
+    (URGENT, "severe pain", r"severe (abdominal |back |flank )?pain|pain (score |of )?(8|9|10)/10"),
+    (URGENT, "infection signs", r"spreading redness|cellulitis|\bpus\b|abscess|purulent"),
+    (URGENT, "persistent vomiting", r"persistent vomiting|unable to keep (fluids|anything) down|dehydrat"),
+    (URGENT, "fracture", r"fracture|deformity|dislocat"),
+    (URGENT, "pregnancy concern", r"pregnan\w* (with|and) (bleeding|pain)|reduced fetal movement"),
+]
+
+# Vital-sign thresholds: (level, flag, pattern, test on the captured numbers).
+# "hr" after a number is the hours unit ("for 24 hr"), and a number with
+# another unit ("150 ml") is not a rate, so neither counts as a heart rate.
+VITAL_RULES = [
+    (EMERGENCY, "low oxygen saturation", r"\b(?:spo2|sats?|o2 sat\w*|oxygen saturation)\D{0,12}(\d{2,3})\s*%", lambda v: v < 90),
+    (EMERGENCY, "hypotension", r"\b(?:bp|blood pressure)\D{0,12}(\d{2,3})\s*/\s*\d{2,3}", lambda v: v < 90),
+    (EMERGENCY, "severe tachycardia", r"(?:(?<![\d.]\s)(?<![\d.])\bhr|\bheart rate|\bpulse)\b\D{0,12}(\d{2,3})\b(?!\s*(?:ml|mg|mcg|min|hr|h\b|%))", lambda v: v >= 140),
+    (URGENT, "tachycardia", r"(?:(?<![\d.]\s)(?<![\d.])\bhr|\bheart rate|\bpulse)\b\D{0,12}(\d{2,3})\b(?!\s*(?:ml|mg|mcg|min|hr|h\b|%))", lambda v: 110 <= v < 140),
+    (URGENT, "hypoxia", r"\b(?:spo2|sats?|o2 sat\w*|oxygen saturation)\D{0,12}(\d{2,3})\s*%", lambda v: 90 <= v < 94),
+    (URGENT, "fever", r"\b(?:temp\w*|t)\b\D{0,6}(\d{2}(?:\.\d)?)\s*(?:°|deg|c\b)", lambda v: v >= 39),
+]
+
+# A finding directly after one of these (at most two words between) is not
+# counted. Punctuation and clause words end the cue's reach, so "no fever,
+# now chest pain" or "no history but reports chest pain" still flag.
+_NEGATION = re.compile(
+    r"\b(no|denies|denied|without|negative for|not|nor|absent)\s+"
+    r"(?:(?!(?:but|now|reports?|presents?|presenting|with|and|then|however)\b)[a-z0-9'-]+\s+){0,2}$"
+)
+
+_RED_FLAGS = [(level, flag, re.compile(pattern)) for level, flag, pattern in RED_FLAG_RULES]
+_VITALS = [(level, flag, re.compile(pattern), test) for level, flag, pattern, test in VITAL_RULES]
+
+# Short example presentations per level; the classifier compares cases to
+# the mean embedding of each level's examples.
+PROTOTYPES = {
+    EMERGENCY: [
+        "sudden crushing chest pain radiating to the left arm with sweating",
+        "severe difficulty breathing, cannot speak in full sentences, lips turning blue",
+        "sudden facial droop, slurred speech and weakness on one side of the body",
+        "patient unresponsive after collapsing, barely breathing",
+        "anaphylactic reaction with throat swelling after a bee sting",
+        "major trauma with heavy uncontrolled bleeding",
+        "high fever, confusion, low blood pressure and mottled skin, suspected sepsis",
+        "continuous seizure lasting more than five minutes",
+    ],
+    URGENT: [
+        "high fever of 39.5 for three days with productive cough",
+        "severe abdominal pain in the right lower quadrant with vomiting",
+        "suspected broken wrist after a fall, swollen and painful",
+        "painful spreading redness and swelling around a wound",
+        "persistent vomiting and diarrhea, unable to keep fluids down",
+        "kidney stone pain, severe flank pain coming in waves",
+        "asthma flare not settling with the usual inhaler",
+        "worsening urinary infection symptoms with fever and back pain",
+    ],
+    STABLE: [
+        "mild cold with runny nose and sore throat for two days",
+        "routine follow-up for well controlled hypertension",
+        "small superficial cut on the finger, bleeding stopped",
+        "mild seasonal allergies with sneezing and itchy eyes",
+        "medication refill request, no new symptoms",
+        "minor muscle ache after exercise, walking normally",
+        "skin rash without fever, not spreading, mildly itchy",
+        "annual check-up, patient feels well",
+    ],
+}
+
+def _negated(text, start):
+    return _NEGATION.search(text, max(0, start - 40), start) is not None
+
+def red_flags(text):
+    """
+    Finds red flags and abnormal vitals in clinical text.
+
+    Returns:
+        list: `(level, flag)` pairs, most severe first, each flag once.
+    """
+    text = (text or "").lower()
+    found = {}
+    for level, flag, pattern in _RED_FLAGS:
+        if flag in found:
+            continue
+        for match in pattern.finditer(text):
+            if not _negated(text, match.start()):
+                found[flag] = level
+                break
+    for level, flag, pattern, test in _VITALS:
+        if flag in found:
+            continue
+        for match in pattern.finditer(text):
+            try:
+                value = float(match.group(1))
+            except ValueError:
+                continue
+            if test(value):
+                found[flag] = level
+                break
+    return sorted(((level, flag) for flag, level in found.items()), key=lambda item: LEVELS.index(item[0]))
+
+def most_severe(levels):
+    levels = [level for level in levels if level]
+    return min(levels, key=LEVELS.index) if levels else None
+
+class CentroidClassifier:
+    """
+    Nearest-centroid classifier over sentence embeddings.
+
+    Each level's centroid is the normalized mean embedding of its
+    prototype presentations; a batch of cases is scored with one matrix
+    product. Without an embedding model it abstains (returns None).
+    """
+
+    def __init__(self, prototypes=PROTOTYPES, encode=embeddings.encode_if_ready):
+        self.prototypes = prototypes
+        self._encode = encode
+        self._centroids = None
+        self._lock = threading.Lock()
+
+    def _get_centroids(self):
+        with self._lock:
+            if self._centroids is None:
+                import numpy as np
+                rows = []
+                for level in LEVELS:
+                    vectors = self._encode(self.prototypes[level])
+                    if vectors is None:
+                        return None
+                    centroid = np.asarray(vectors, dtype=np.float32).mean(axis=0)
+                    rows.append(centroid / (np.linalg.norm(centroid) or 1.0))
+                self._centroids = np.stack(rows)
+            return self._centroids
+
+    def classify(self, texts):
+        """
+        Returns, per text, `{level: cosine similarity}`, or None when no
+        embedding model is available yet.
+        """
+        centroids = self._get_centroids()
+        if centroids is None or not texts:
+            return None
+        vectors = self._encode(texts)
+        if vectors is None:
+            return None
+        scores = vectors @ centroids.T
+        return [{level: float(row[i]) for i, level in enumerate(LEVELS)} for row in scores]
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+def get_classifier():
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            _classifier = CentroidClassifier()
+        return _classifier
+
+def _case_text(notes, doc_text):
+    return f"{notes or ''}\n{(doc_text or '')[:DOCUMENT_CHARS]}".strip()
+
+def _classifier_level(scores):
+    if not scores:
+        return None
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return ranked[0] if scores[ranked[0]] - scores[ranked[1]] >= MIN_MARGIN else None
+
+def pretriage_batch(cases, classifier=None):
+    """
+    Scores many cases at once: rules per case, one embedding call for all.
+
+    Args:
+        cases (list): `(notes, document_text)` pairs.
+        classifier (CentroidClassifier): Defaults to the shared one.
+
+    Returns:
+        list: One result per case (see `pretriage`).
+    """
+    started = time.perf_counter()
+    texts = [_case_text(notes, doc_text) for notes, doc_text in cases]
+    classifier = classifier or get_classifier()
+    all_scores = classifier.classify([text for text in texts if text]) if any(texts) else None
+    scores_iter = iter(all_scores or [])
+
+    results = []
+    for text in texts:
+        flags = red_flags(text)
+        scores = next(scores_iter, None) if text and all_scores else None
+        rule_level = flags[0][0] if flags else None
+        model_level = _classifier_level(scores)
+        level = most_severe([rule_level, model_level]) or STABLE
+        sources = [name for name, found in (("rules", rule_level == level), ("embedding", model_level == level)) if found]
+        results.append({
+            "level": level,
+            "red_flags": [flag for _, flag in flags],
+            "source": "+".join(sources) or "default",
+            "scores": {k: round(v, 4) for k, v in scores.items()} if scores else None,
+        })
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    for result in results:
+        result["elapsed_ms"] = elapsed_ms
+    return results
+
+def pretriage(notes, doc_text="", classifier=None):
+    """
+    Provisional triage level for one case, computed locally in milliseconds.
+
+    Red-flag rules and vital-sign thresholds run on the notes and the start
+    of the documents; the embedding classifier adds a level when its model
+    is loaded. The most severe signal wins, so a rule hit is never
+    downgraded by the classifier.
+
+    Returns:
+        dict: `level`, `red_flags`, `source` ("rules", "embedding", both, or
+        "default" when nothing fired), `scores` (per-level similarity or
+        None) and `elapsed_ms`.
+    """
+    return pretriage_batch([(notes, doc_text)], classifier)[0]
+
+def format_summary(result):
+    """
+    Renders a pre-triage result as a short markdown block for the summary tab.
+    """
+    if not result:
+        return ""
+    lines = [f"**Provisional triage: {result['level']}** _(local pre-triage, pending the full analysis)_"]
+    if result["red_flags"]:
+        lines.append("Red flags: " + ", ".join(result["red_flags"]))
+    return "\n\n".join(lines)
@@ -0,0 +1,104 @@
+import threading
+import time
+import numpy as np
+from . import embeddings
+from .utils import get_secret
+
+SIMILARITY_THRESHOLD = float(get_secret("SEMANTIC_CACHE_THRESHOLD", 0.92))
+CAPACITY = int(get_secret("SEMANTIC_CACHE_CAPACITY", 4096))
+TTL_SECONDS = float(get_secret("SEMANTIC_CACHE_TTL_SECONDS", 6 * 3600))
+
+class VectorIndex:
+    """
+    Fixed-capacity ring buffer of normalized vectors with brute-force cosine
+    search. At a few thousand 384-d float32 rows a single matrix-vector
+    product is faster than any ANN structure.
+    """
+
+    def __init__(self, dim, capacity=CAPACITY):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.capacity = capacity
+        self.count = 0
+        self._next = 0
+
+    def add(self, vector):
+        """
+        Stores `vector` and returns its slot; the oldest slot is reused when full.
+        """
+        slot = self._next
+        self.vectors[slot] = vector
+        self._next = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return slot
+
+    def nearest(self, vector):
+        """
+        Returns `(slot, similarity)` of the closest stored vector, or `(None, -1.0)`.
+        """
+        if self.count == 0:
+            return None, -1.0
+        scores = self.vectors[:self.count] @ vector
+        slot = int(np.argmax(scores))
+        return slot, float(scores[slot])
+
+class SemanticSearchCache:
+    """
+    Reuses search results for paraphrased queries.
+
+    Each query is embedded and compared against previously answered queries;
+    a hit above `threshold` cosine similarity returns the stored result. The
+    embedding model loads in the background; until it is ready (or if it is
+    missing) every lookup is a miss, so no search waits on the load.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, capacity=CAPACITY, ttl=TTL_SECONDS,
+                 encode=None, clock=time.monotonic):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self._encode = encode or embeddings.encode_if_ready
+        self._clock = clock
+        self._index = None
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, query):
+        vectors = self._encode([query])
+        return None if vectors is None else np.asarray(vectors[0], dtype=np.float32)
+
+    def lookup(self, query):
+        """
+        Returns `(result, vector)`; `result` is None on a miss. Pass `vector`
+        back to `store` to avoid embedding the query twice.
+        """
+        vector = self._embed(query)
+        if vector is None:
+            with self._lock:
+                self.misses += 1
+            return None, None
+        with self._lock:
+            if self._index is not None:
+                slot, score = self._index.nearest(vector)
+                entry = self._entries.get(slot)
+                if entry and score >= self.threshold and entry[0] > self._clock():
+                    self.hits += 1
+                    return entry[2], vector
+            self.misses += 1
+        return None, vector
+
+    def store(self, query, result, vector=None):
+        if result is None:
+            return
+        vector = self._embed(query) if vector is None else vector
+        if vector is None:
+            return
+        with self._lock:
+            if self._index is None:
+                self._index = VectorIndex(vector.shape[0], self.capacity)
+            slot = self._index.add(vector)
+            self._entries[slot] = (self._clock() + self.ttl, query, result)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
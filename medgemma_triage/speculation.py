@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import re
+import threading
+from . import embeddings
+from . import limits
+from . import mcp_client
+from . import telemetry
+from .tool_cache import normalize_query
+from .utils import get_secret
+
+SEARCH_TOOL = "search_medical_web"
+# Speculative searches started per consultation
+MAX_SPECULATIVE_SEARCHES = int(get_secret("SPECULATIVE_SEARCHES", 2))
+# A model query reuses a speculative result at this embedding similarity...
+MATCH_SIMILARITY = float(get_secret("SPECULATIVE_MATCH_SIMILARITY", 0.8))
+# ...or, without the embedding model, at this word overlap (Jaccard)
+MATCH_OVERLAP = float(get_secret("SPECULATIVE_MATCH_OVERLAP", 0.6))
+# Below this share of used speculative searches, only one is started per consultation
+MIN_HIT_RATE = float(get_secret("SPECULATIVE_MIN_HIT_RATE", 0.25))
+OUTCOME_WINDOW = 50
+
+# Likely searches per red flag (see `pretriage.RED_FLAG_RULES` and `VITAL_RULES`)
+FLAG_QUERIES = {
+    "chest pain": "acute chest pain emergency evaluation acute coronary syndrome guidelines",
+    "breathing difficulty": "acute respiratory distress emergency management guidelines",
+    "stroke signs": "acute stroke recognition and thrombolysis window guidelines",
+    "reduced consciousness": "altered level of consciousness emergency assessment causes",
+    "seizure": "acute seizure and status epilepticus management guidelines",
+    "anaphylaxis": "anaphylaxis emergency treatment epinephrine guidelines",
+    "major bleeding": "major hemorrhage emergency management guidelines",
+    "suicide risk": "suicide risk assessment and overdose emergency management",
+    "worst headache": "thunderclap headache subarachnoid hemorrhage evaluation",
+    "sepsis signs": "sepsis recognition and initial management guidelines",
+    "high fever": "high fever in adults causes and urgent evaluation",
+    "severe pain": "severe acute pain differential diagnosis and evaluation",
+    "infection signs": "cellulitis and abscess treatment guidelines",
+    "persistent vomiting": "persistent vomiting dehydration assessment and management",
+    "fracture": "suspected fracture initial assessment and management",
+    "pregnancy concern": "bleeding or pain in pregnancy urgent evaluation",
+    "low oxygen saturation": "hypoxemia low oxygen saturation emergency management",
+    "hypotension": "hypotension shock emergency assessment causes",
+    "severe tachycardia": "severe tachycardia emergency evaluation and management",
+    "tachycardia": "tachycardia causes and evaluation",
+    "hypoxia": "mild hypoxia causes and evaluation",
+    "fever": "fever in adults causes and evaluation",
+}
+
+_WORD = re.compile(r"[a-z0-9]+")
+_FILLER = frozenset("a an and the of for in on to with or vs what how is are guidelines management treatment evaluation".split())
+
+def likely_queries(pretriage_result, limit=MAX_SPECULATIVE_SEARCHES):
+    """
+    Searches the model is likely to ask for, from the red flags local
+    pre-triage found in the notes and documents (most severe first).
+    """
+    queries = [FLAG_QUERIES[flag] for flag in (pretriage_result or {}).get("red_flags", []) if flag in FLAG_QUERIES]
+    return queries[:limit]
+
+def _words(query):
+    return {word for word in _WORD.findall(normalize_query(query)) if word not in _FILLER}
+
+def word_overlap(a, b):
+    """
+    Jaccard similarity of two queries' content words. Symmetric, so a short
+    query sharing a few words with a long one does not count as a match.
+    """
+    a, b = _words(a), _words(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class _Outcomes:
+    """
+    Recent speculative searches, used or wasted, across consultations.
+    """
+
+    def __init__(self, size=OUTCOME_WINDOW):
+        self._recent = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, used):
+        with self._lock:
+            self._recent.append(bool(used))
+
+    def hit_rate(self):
+        with self._lock:
+            if len(self._recent) < self._recent.maxlen // 2:
+                return None  # Too few to judge
+            return sum(self._recent) / len(self._recent)
+
+OUTCOMES = _Outcomes()
+
+def allowance(limit=MAX_SPECULATIVE_SEARCHES, outcomes=OUTCOMES):
+    """
+    Speculative searches this consultation may start: none while the search
+    backend's breaker is not closed, one while most recent ones went unused.
+    """
+    if limit <= 0 or mcp_client.get_breaker(SEARCH_TOOL).state != limits.CLOSED:
+        return 0
+    rate = outcomes.hit_rate()
+    return 1 if rate is not None and rate < MIN_HIT_RATE else limit
+
+class SpeculativeSearch:
+    """
+    Searches started before the model asks for them.
+
+    `start` fires queries at the search tool in the background; `claim`
+    hands a matching one's task to the agent loop in place of a new call;
+    `finish` cancels whatever is still running unclaimed and records which
+    searches were used. Each speculative search is claimed at most once.
+    """
+
+    def __init__(self, limit=None, encode=None, outcomes=OUTCOMES):
+        self.limit = allowance(outcomes=outcomes) if limit is None else limit
+        self._encode = encode or embeddings.encode_if_ready
+        self._outcomes = outcomes
+        self._tasks = {}
+        self._claimed = set()
+
+    def start(self, queries):
+        for query in queries:
+            if len(self._tasks) >= self.limit:
+                break
+            if query not in self._tasks:
+                self._tasks[query] = asyncio.ensure_future(mcp_client.call_backend_tool_async(SEARCH_TOOL, {"query": query}))
+                telemetry.REGISTRY.increment("speculative_searches_total", labels={"outcome": "started"})
+
+    def _best_match(self, query, candidates):
+        wanted = normalize_query(query)
+        for candidate in candidates:
+            if normalize_query(candidate) == wanted:
+                return candidate
+        vectors = self._encode([query] + candidates)
+        if vectors is not None:
+            scores = [float(vectors[0] @ vector) for vector in vectors[1:]]
+            best = max(range(len(candidates)), key=scores.__getitem__)
+            return candidates[best] if scores[best] >= MATCH_SIMILARITY else None
+        overlaps = [word_overlap(query, candidate) for candidate in candidates]
+        best = max(range(len(candidates)), key=overlaps.__getitem__)
+        return candidates[best] if overlaps[best] >= MATCH_OVERLAP else None
+
+    async def claim(self, query):
+        """
+        Returns `(speculative_query, task)` for a started search matching
+        `query`, or None when the model's search has to run itself.
+        """
+        candidates = [q for q in self._tasks if q not in self._claimed]
+        if not candidates:
+            return None
+        # Matching may run the embedding model; keep it off the event loop
+        match = await asyncio.to_thread(self._best_match, query, candidates)
+        if match is None or match in self._claimed:
+            return None  # Claimed by another query while matching
+        self._claimed.add(match)
+        telemetry.REGISTRY.increment("speculative_searches_total", labels={"outcome": "used"})
+        return match, self._tasks[match]
+
+    def finish(self):
+        """
+        Cancels unclaimed searches still in flight. Finished ones are left in
+        the search caches, where a later paraphrase may still find them.
+        """
+        for query, task in self._tasks.items():
+            used = query in self._claimed
+            self._outcomes.record(used)
+            if not used:
+                if task.done() and not task.cancelled():
+                    task.exception()  # Retrieved so a failure is not reported as unhandled
+                task.cancel()
+                telemetry.REGISTRY.increment("speculative_searches_total", labels={"outcome": "wasted"})
+        self._tasks = {}
@@ -0,0 +1,112 @@
+import re
+import time
+from .utils import get_secret
+
+STREAM_FLUSH_MS = float(get_secret("STREAM_FLUSH_MS", 75))
+STREAM_FLUSH_CHARS = int(get_secret("STREAM_FLUSH_CHARS", 2000))
+
+class StreamRenderer:
+    """
+    Buffers streamed chunks and re-renders a Streamlit placeholder on a cadence.
+
+    Rendering every token re-sends the whole growing response over the
+    websocket, which is quadratic in output length. Chunks are collected in a
+    list instead and the placeholder is updated at most once per `interval_ms`
+    (or once `flush_chars` new characters are pending), plus one final render
+    on `close()`.
+    """
+
+    def __init__(self, placeholder, interval_ms=None, flush_chars=None, cursor="...", clock=time.monotonic):
+        self.placeholder = placeholder
+        self.interval = (STREAM_FLUSH_MS if interval_ms is None else interval_ms) / 1000.0
+        self.flush_chars = STREAM_FLUSH_CHARS if flush_chars is None else flush_chars
+        self.cursor = cursor
+        self._clock = clock
+        self._text = ""
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = clock()
+        self.renders = 0
+
+    @property
+    def text(self):
+        """The full response so far, including chunks not yet rendered."""
+        self._merge()
+        return self._text
+
+    def _merge(self):
+        if self._pending:
+            self._text += "".join(self._pending)
+            self._pending.clear()
+            self._pending_chars = 0
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self._pending.append(chunk)
+        self._pending_chars += len(chunk)
+        if self._pending_chars >= self.flush_chars or self._clock() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self, final=False):
+        self._merge()
+        self.placeholder.markdown(self._text if final else self._text + self.cursor)
+        self._last_flush = self._clock()
+        self.renders += 1
+
+    def close(self):
+        """
+        Renders the complete response once without the cursor and returns it.
+        """
+        self.flush(final=True)
+        return self._text
+
+# Same grammar as utils.extract_search_command
+_SEARCH_COMMAND = re.compile(r"\[SEARCH:\s*(.*?)\]", re.IGNORECASE)
+# A command that has started but not closed yet, running to the end of the text
+_PARTIAL_COMMAND = re.compile(r"\[(?:S(?:E(?:A(?:R(?:C(?:H(?::\s*[^\]\n]*)?)?)?)?)?)?)?$", re.IGNORECASE)
+
+class SearchCommandParser:
+    """
+    Detects `[SEARCH: query]` commands incrementally while a response streams.
+
+    Only the unmatched tail of the stream is kept, so each chunk is scanned
+    once. After the first command closes, further back-to-back commands are
+    still collected; `should_stop()` turns true as soon as anything other
+    than whitespace or another command follows, which is the point where the
+    rest of the generation can be cancelled.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._tail = ""
+        self._text_after_command = False
+
+    def feed(self, chunk):
+        """
+        Consumes a chunk and returns the queries completed by it.
+        """
+        if not chunk:
+            return []
+        tail = self._tail + chunk
+        found = []
+        end = 0
+        for match in _SEARCH_COMMAND.finditer(tail):
+            query = match.group(1).strip()
+            if query:
+                found.append(query)
+            end = match.end()
+        tail = tail[end:]
+        partial = _PARTIAL_COMMAND.search(tail)
+        start = partial.start() if partial else len(tail)
+        has_text = bool(tail[:start].strip())
+        self._text_after_command = has_text if found else (self._text_after_command or has_text)
+        self._tail = tail[start:]
+        self.queries.extend(found)
+        return found
+
+    def should_stop(self):
+        """
+        True once a command has been seen and non-command text follows it.
+        """
+        return bool(self.queries) and self._text_after_command
@@ -0,0 +1,293 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .utils import get_secret
+
+METRIC_PREFIX = "medgemma_"
+# Upper bounds in seconds; wide enough for sub-millisecond cache hits and minute-long extractions
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus sense.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+class MetricsRegistry:
+    """
+    Process-wide histograms and counters, keyed by metric name and labels.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """
+        Returns all metrics as JSON-serializable dicts.
+        """
+        with self._lock:
+            histograms = [
+                {
+                    "name": METRIC_PREFIX + name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum,
+                    "max": h.max,
+                    "mean": h.sum / h.count if h.count else 0.0,
+                    "buckets": {_format_bound(bound): total for bound, total in h.cumulative()},
+                }
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+            counters = [
+                {"name": METRIC_PREFIX + name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+        return {"histograms": histograms, "counters": counters}
+
+    def prometheus_text(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), h in sorted(self._histograms.items()):
+                metric = METRIC_PREFIX + name
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} histogram")
+                for bound, total in h.cumulative():
+                    lines.append(f"{metric}_bucket{_format_labels(labels + (('le', _format_bound(bound)),))} {total}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {h.sum}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {h.count}")
+            for (name, labels), value in sorted(self._counters.items()):
+                metric = METRIC_PREFIX + name
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+class Trace:
+    """
+    The spans recorded while handling one consultation, for the per-request
+    timing breakdown. Spans from concurrent tasks and worker threads append
+    under a lock.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self.started = clock()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        return self._clock() - self.started
+
+    def add(self, name, start, duration, attributes):
+        with self._lock:
+            self.spans.append({
+                "span": name,
+                "start_ms": round((start - self.started) * 1000, 1),
+                "duration_ms": round(duration * 1000, 1),
+                **attributes,
+            })
+
+    def breakdown(self):
+        """
+        Returns the recorded spans ordered by start time, enclosing spans first.
+        """
+        with self._lock:
+            return sorted(self.spans, key=lambda s: (s["start_ms"], -s["duration_ms"]))
+
+_current_trace = contextvars.ContextVar("medgemma_trace", default=None)
+
+def start_trace():
+    """
+    Starts a trace for the current task; tasks it creates afterwards inherit it.
+    """
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+def record(name, seconds, start=None, attributes=None, **labels):
+    """
+    Records one timing into the `<name>_seconds` histogram and, when a trace
+    is active, into the trace. `attributes` go to the trace only, so they may
+    have high cardinality (queries, token counts).
+    """
+    REGISTRY.observe(f"{name}_seconds", seconds, labels)
+    trace = current_trace()
+    if trace is not None:
+        start = time.perf_counter() - seconds if start is None else start
+        trace.add(name, start, seconds, {**labels, **(attributes or {})})
+
+class Span:
+    """
+    Times a block: `with telemetry.span("mcp_tool_call", tool=name): ...`.
+    Failed blocks are recorded with `outcome="error"`.
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.attributes = {}
+        self.start = None
+
+    def annotate(self, **attributes):
+        """
+        Adds trace-only details to the span.
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        labels = dict(self.labels)
+        if exc_type is not None and not issubclass(exc_type, (asyncio.CancelledError, GeneratorExit)):
+            labels["outcome"] = "error"
+        record(self.name, duration, start=self.start, attributes=self.attributes, **labels)
+        return False
+
+def span(name, **labels):
+    return Span(name, **labels)
+
+def timed(name, **labels):
+    """
+    Decorator form of `span` for sync and async functions.
+    """
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with Span(name, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def record_throughput(name, tokens, seconds, **labels):
+    """
+    Counts generated tokens and records the tokens-per-second rate.
+    """
+    REGISTRY.increment(f"{name}_tokens_total", tokens, labels)
+    if seconds > 0 and tokens:
+        REGISTRY.observe(f"{name}_tokens_per_second", tokens / seconds, labels, buckets=THROUGHPUT_BUCKETS)
+
+def prometheus_text():
+    return REGISTRY.prometheus_text()
+
+def to_json():
+    return json.dumps(REGISTRY.snapshot())
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = prometheus_text(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = to_json(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        payload = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port=None):
+    """
+    Serves `/metrics` (Prometheus text) and `/metrics.json` on METRICS_PORT.
+    Streamlit cannot add routes of its own, so this runs beside it on a
+    daemon thread. Does nothing when no port is configured.
+
+    Returns:
+        ThreadingHTTPServer or None
+    """
+    global _server
+    port = port if port is not None else get_secret("METRICS_PORT")
+    if port in (None, ""):
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
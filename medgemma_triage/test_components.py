@@ -1,14 +1,25 @@
 import unittest
 from unittest.mock import MagicMock, patch
+import asyncio
+import io
 import json
+import re
 import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
 
 # Add medgemma_triage to path so we can import modules
 sys.path.append(os.path.join(os.getcwd(), 'medgemma_triage'))
+sys.path.append(os.getcwd())
+# Tests that need the consultation store create their own; a shared one would leak history between tests
+os.environ.setdefault("CONSULTATION_STORE", "off")
 
 import utils
 import tools
+from medgemma_triage import api, api_client, batch, cache, consultation_store, context, embeddings, extraction, images, jobs, limits, llm, log_writer, mcp_client, pipeline, pretriage, semantic_cache, speculation, streaming, telemetry, tool_cache, uploads
 
 class TestUtils(unittest.TestCase):
     def test_extract_search_command(self):
@@ -41,6 +52,40 @@ This is a thought.
         self.assertTrue(result["is_json"])
         self.assertEqual(result["data"]["triage_level"], "STABLE")
 
+    def test_fenced_json_parses_in_linear_time(self):
+        text = "```python\nprint(1)\n```\n```JSON\n{\"triage_level\": \"URGENT\"}\n```"
+        self.assertEqual(utils.parse_medgemma_response(text)["data"], {"triage_level": "URGENT"})
+        started = time.perf_counter()
+        result = utils.parse_medgemma_response("```json\n{ " * 20000)
+        self.assertLess(time.perf_counter() - started, 1.0)  # Quadratic scanning took tens of seconds
+        self.assertFalse(result["is_json"])
+
+    def test_parse_dashboard_response_sections(self):
+        text = (
+            "<think>check vitals</think>\n"
+            "### Executive Summary\n---\nUrgent review.\n\n"
+            "### Detailed Reasoning\nBP is low.\n"
+            "### Sources & Search Data\nNone."
+        )
+        result = utils.parse_dashboard_response(text)
+        self.assertEqual(result["summary"], "Urgent review.")
+        self.assertEqual(result["reasoning"], "BP is low.")
+        self.assertEqual(result["sources"], "None.")
+
+        partial = utils.parse_dashboard_response("### Executive Summary\nStable.")
+        self.assertEqual(partial["summary"], "Stable.")
+        self.assertIn("Could not find section", partial["reasoning"])
+
+    def test_response_parser_handles_markers_split_across_chunks(self):
+        text = "<unused94>thought\nWeighing sepsis.<unused95>\n### Executive Summary\nAdmit."
+        parser = utils.ResponseParser()
+        for i in range(0, len(text), 3):
+            parser.feed(text[i:i + 3])
+        result = parser.result()
+        self.assertEqual(result["thought"], "Weighing sepsis.")
+        self.assertEqual(result["sections"], {"summary": "Admit."})
+        self.assertEqual(result, utils.parse_medgemma_response(text))
+
 class TestTools(unittest.TestCase):
     @patch('tools.Client')
     def test_list_tools(self, mock_client_cls):
@@ -61,5 +106,1352 @@ class TestTools(unittest.TestCase):
         self.assertEqual(len(tools_list), 2)
         self.assertEqual(tools_list[0]["name"], "search_pubmed")
 
+    def _mock_client(self, handler, async_=False):
+        transport = tools.httpx.MockTransport(handler)
+        cls = tools.httpx.AsyncClient if async_ else tools.httpx.Client
+        return cls(transport=transport)
+
+    def test_call_fastmcp_tool_joins_text_content(self):
+        def handler(request):
+            body = json.loads(request.content)
+            self.assertEqual(body, {"name": "search_medical_web", "arguments": {"query": "sepsis"}})
+            return tools.httpx.Response(200, json={"isError": False, "content": [
+                {"type": "text", "text": "a"}, {"type": "image", "data": ""}, {"type": "text", "text": "b"}]})
+
+        with patch.object(tools, '_HTTP_CLIENT', self._mock_client(handler)):
+            result = tools.call_fastmcp_tool("search_medical_web", {"query": "sepsis"}, base_url="http://mcp.test")
+        self.assertEqual(result, "ab")
+
+    def test_call_fastmcp_tool_retries_then_raises_on_error(self):
+        statuses = [503, 200]
+
+        def handler(request):
+            status = statuses.pop(0)
+            return tools.httpx.Response(status, json={"isError": True, "content": [{"type": "text", "text": "bad"}]})
+
+        with patch.object(tools, '_HTTP_CLIENT', self._mock_client(handler)), patch.object(tools, 'BACKOFF_SECONDS', 0):
+            with self.assertRaises(tools.ToolError):
+                tools.call_fastmcp_tool("x", {}, base_url="http://mcp.test")
+        self.assertEqual(statuses, [])
+
+    def test_call_tool_async_with_client(self):
+        async def run():
+            client = self._mock_client(lambda r: tools.httpx.Response(200, json={"result": "done"}), async_=True)
+            async with client:
+                return await tools.call_tool_async("x", {}, client, base_url="http://mcp.test")
+
+        self.assertEqual(asyncio.run(run()), "done")
+
+class FakeMCPClient:
+    """Stand-in for fastmcp.Client that counts connections."""
+    connects = 0
+
+    def __init__(self, url):
+        self.url = url
+
+    async def __aenter__(self):
+        FakeMCPClient.connects += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def call_tool(self, name, arguments=None):
+        return f"{name}:{arguments}"
+
+class TestMCPSessionManager(unittest.TestCase):
+    def setUp(self):
+        FakeMCPClient.connects = 0
+        patcher = patch.object(mcp_client, 'Client', FakeMCPClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = mcp_client.MCPSessionManager("http://mcp.test/sse", pool_size=2)
+        self.addCleanup(self.manager.close)
+
+    def test_reuses_pooled_connection(self):
+        for _ in range(3):
+            self.assertEqual(self.manager.call_tool("echo", {"a": 1}), "echo:{'a': 1}")
+        self.assertEqual(FakeMCPClient.connects, 1)
+
+    def test_reconnects_after_failure(self):
+        calls = []
+
+        async def flaky(self_, name, arguments=None):
+            calls.append(name)
+            if len(calls) == 1:
+                raise ConnectionError("dropped")
+            return "ok"
+
+        with patch.object(FakeMCPClient, 'call_tool', flaky):
+            self.assertEqual(self.manager.call_tool("echo", {}), "ok")
+        self.assertEqual(FakeMCPClient.connects, 2)
+
+    def test_tool_errors_and_write_tools_are_not_resent(self):
+        calls = []
+
+        async def failing(self_, name, arguments=None):
+            calls.append(name)
+            raise (ValueError("tool failed") if name == "echo" else ConnectionError("dropped"))
+
+        with patch.object(FakeMCPClient, 'call_tool', failing):
+            with self.assertRaises(ValueError):
+                self.manager.call_tool("echo", {})
+            with self.assertRaises(ConnectionError):
+                self.manager.call_tool("save_consultation_log", {})
+        self.assertEqual(calls, ["echo", "save_consultation_log"])
+        self.assertEqual(FakeMCPClient.connects, 1)  # The tool error left the session pooled
+
+class FakeUpload:
+    def __init__(self, name, type_, data=b""):
+        self.name = name
+        self.type = type_
+        self._data = data
+
+    def getvalue(self):
+        return self._data
+
+def make_pdf(pages):
+    """Builds a minimal text PDF with one line of text per page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+    out = "%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF"
+    return out.encode("latin-1")
+
+class TestExtraction(unittest.TestCase):
+    def test_pdf_pages_extracted_in_parallel_ranges(self):
+        data = make_pdf([f"Page {i}" for i in range(7)])
+        with patch.object(extraction, 'INLINE_MAX_BYTES', 0):
+            chunks = list(extraction.iter_pdf_text(data, pages_per_chunk=3))
+        self.addCleanup(extraction.shutdown_process_pool)
+        self.assertEqual([done for done, _, _ in chunks], [3, 6, 7])
+        text = "\n".join(t for _, _, t in chunks)
+        self.assertIn("Page 0", text)
+        self.assertIn("Page 6", text)
+        self.assertLess(text.index("Page 2"), text.index("Page 5"))
+
+    def test_docx_includes_tables(self):
+        import docx
+        document = docx.Document()
+        document.add_paragraph("Discharge summary")
+        table = document.add_table(rows=1, cols=2)
+        table.rows[0].cells[0].text = "Troponin"
+        table.rows[0].cells[1].text = "0.4 ng/mL"
+        buffer = io.BytesIO()
+        document.save(buffer)
+        upload = FakeUpload("summary.docx", extraction.DOCX_MIME, buffer.getvalue())
+        text = extraction.extract_document(upload)
+        self.assertIn("Discharge summary", text)
+        self.assertIn("Troponin | 0.4 ng/mL", text)
+
+    def test_identical_bytes_are_parsed_once(self):
+        data = make_pdf(["Cached page"])
+        calls = []
+        original = extraction.extract_pdf_pages
+
+        def counting(*args):
+            calls.append(args[1:])
+            return original(*args)
+
+        with patch.object(extraction, '_document_cache', None), \
+                patch.object(extraction, 'extract_pdf_pages', counting):
+            first = extraction.extract_document(FakeUpload("a.pdf", extraction.PDF_MIME, data))
+            second = extraction.extract_document(FakeUpload("b.pdf", extraction.PDF_MIME, data))
+            stats = extraction.document_cache_stats()
+        self.assertEqual(len(calls), 1)
+        self.assertIn("Cached page", second)
+        self.assertIn("Document: b.pdf", second)
+        self.assertEqual(first.replace("a.pdf", "b.pdf"), second)
+        self.assertEqual((stats["memory_hits"], stats["misses"]), (1, 1))
+
+    def test_size_budget(self):
+        upload = FakeUpload("huge.pdf", extraction.PDF_MIME, b"x" * 2048)
+        text = extraction.extract_document(upload, max_bytes=1024)
+        self.assertIn("Skipped", text)
+
+class TestUploads(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        patcher = patch.object(uploads, 'spool_dir', lambda: self.dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_small_upload_stays_in_memory(self):
+        budget = uploads.MemoryBudget(limit=1024)
+        ref = uploads.FileRef.from_upload(FakeUpload("a.txt", "text/plain", b"abc"), budget)
+        self.assertIsNone(ref.path)
+        self.assertEqual(budget.used, 3)
+        ref.release()
+        self.assertEqual(budget.used, 0)
+
+    def test_large_or_over_budget_upload_is_spooled(self):
+        budget = uploads.MemoryBudget(limit=4)
+        with patch.object(uploads, 'SPOOL_THRESHOLD_BYTES', 8):
+            large = uploads.FileRef.from_upload(FakeUpload("big.bin", "application/octet-stream", b"x" * 16), budget)
+            over = uploads.FileRef.from_upload(FakeUpload("b.bin", "application/octet-stream", b"yyyyyy"), budget)
+        for ref in (large, over):
+            self.assertEqual(os.path.dirname(ref.path), self.dir)
+            with ref.view() as view:
+                self.assertEqual(view.nbytes, ref.size)
+        self.assertEqual(budget.used, 0)
+        uploads.release_all([large, over])
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_spooled_pdf_is_extracted_from_its_path(self):
+        data = make_pdf(["Spooled page"])
+        with patch.object(uploads, 'SPOOL_THRESHOLD_BYTES', 0):
+            ref = uploads.FileRef.from_upload(FakeUpload("scan.pdf", extraction.PDF_MIME, data))
+        self.addCleanup(ref.release)
+        sources = []
+        original = extraction.iter_pdf_text
+
+        def recording(source, *args, **kwargs):
+            sources.append(source)
+            return original(source, *args, **kwargs)
+
+        with patch.object(extraction, '_document_cache', None), \
+                patch.object(extraction, 'iter_pdf_text', recording):
+            text = extraction.extract_document(ref)
+        self.assertEqual(sources, [ref.path])
+        self.assertIn("Spooled page", text)
+
+    def test_path_reference_is_not_deleted(self):
+        path = os.path.join(self.dir, "note.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF")
+        ref = batch.file_loader(self.dir)("note.pdf")
+        self.assertEqual((ref.type, ref.size), (extraction.PDF_MIME, 4))
+        ref.release()
+        self.assertTrue(os.path.exists(path))
+
+class TestCache(unittest.TestCase):
+    def test_lru_evicts_by_bytes(self):
+        lru = cache.LRUCache(max_bytes=10)
+        lru.put("a", "12345")
+        lru.put("b", "12345")
+        lru.get("a")
+        lru.put("c", "12345")
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), "12345")
+        self.assertEqual(lru.evictions, 1)
+
+    def test_disk_tier_promotes_hits(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            cache.TieredCache(cache.LRUCache(1024), cache.DiskCache(directory)).put("k", "text")
+            tiered = cache.TieredCache(cache.LRUCache(1024), cache.DiskCache(directory))
+            self.assertEqual(tiered.get("k"), "text")
+            self.assertEqual(tiered.get("k"), "text")
+            self.assertEqual(tiered.stats()["disk_hits"], 1)
+            self.assertEqual(tiered.stats()["memory_hits"], 1)
+
+class TestPipeline(unittest.TestCase):
+    def test_compile_runs_history_and_extraction_concurrently(self):
+        async def slow_history(tool_name, arguments):
+            await asyncio.sleep(0.2)
+            return f"history for {arguments['patient_id']}"
+
+        def slow_extract(file, on_progress=None):
+            time.sleep(0.2)
+            return f"text of {file.name}"
+
+        files = [FakeUpload(f"doc{i}.pdf", "application/pdf") for i in range(3)]
+        files.append(FakeUpload("xray.png", "image/png"))
+        with patch.object(mcp_client, 'call_backend_tool_async', slow_history), \
+                patch.object(pipeline.utils, 'extract_document_text', slow_extract):
+            start = time.perf_counter()
+            compiled = pipeline.compile_patient_data("P-1", files)
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(compiled["history"], "history for P-1")
+        self.assertIn("text of doc2.pdf", compiled["doc_texts"])
+        self.assertEqual([f.name for f in compiled["image_files"]], ["xray.png"])
+
+    def test_compile_deadline_substitutes_placeholders(self):
+        async def hung_history(tool_name, arguments):
+            await asyncio.sleep(5)
+
+        with patch.object(mcp_client, 'call_backend_tool_async', hung_history):
+            compiled = pipeline.compile_patient_data("P-1", [], deadline=0.05)
+        self.assertEqual(compiled["history"], pipeline.NO_HISTORY)
+
+class TestStreamRenderer(unittest.TestCase):
+    def test_flushes_on_cadence_and_renders_final_once(self):
+        now = [0.0]
+        placeholder = MagicMock()
+        renderer = streaming.StreamRenderer(placeholder, interval_ms=100, flush_chars=1000, clock=lambda: now[0])
+        for i in range(50):
+            now[0] = i * 0.01
+            renderer.write(f"t{i} ")
+        renderer.write(None)
+        text = renderer.close()
+
+        self.assertEqual(text, "".join(f"t{i} " for i in range(50)))
+        self.assertLessEqual(renderer.renders, 6)
+        placeholder.markdown.assert_called_with(text)
+        self.assertTrue(placeholder.markdown.call_args_list[0].args[0].endswith("..."))
+
+    def test_size_threshold_forces_flush(self):
+        placeholder = MagicMock()
+        renderer = streaming.StreamRenderer(placeholder, interval_ms=60000, flush_chars=10, clock=lambda: 0.0)
+        renderer.write("x" * 4)
+        self.assertEqual(renderer.renders, 0)
+        renderer.write("x" * 6)
+        self.assertEqual(renderer.renders, 1)
+
+class TestSearchCommandParser(unittest.TestCase):
+    def feed_all(self, parser, chunks):
+        for i, chunk in enumerate(chunks):
+            parser.feed(chunk)
+            if parser.should_stop():
+                return i
+        return None
+
+    def test_detects_command_split_across_chunks(self):
+        parser = streaming.SearchCommandParser()
+        self.assertEqual(parser.feed("<think>need data</think> [SEA"), [])
+        self.assertEqual(parser.feed("RCH: chest "), [])
+        self.assertEqual(parser.feed("pain 45M] "), ["chest pain 45M"])
+        self.assertFalse(parser.should_stop())
+
+    def test_collects_back_to_back_commands_then_stops_on_prose(self):
+        parser = streaming.SearchCommandParser()
+        chunks = ["[SEARCH: a]", "\n[search:", " b]", " Meanwhile, the patient", " is likely..."]
+        self.assertEqual(self.feed_all(parser, chunks), 3)
+        self.assertEqual(parser.queries, ["a", "b"])
+
+    def test_matches_batch_extractor(self):
+        text = "Thoughts [not a command] then [SEARCH: sepsis criteria] trailing"
+        parser = streaming.SearchCommandParser()
+        for ch in text:
+            parser.feed(ch)
+        self.assertEqual(parser.queries[0], utils.extract_search_command(text))
+
+class FakeRedis:
+    """Local stand-in for a Redis-compatible client."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class TestToolResultCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def fake_call(tool_name, arguments):
+            self.calls.append((tool_name, arguments))
+            time.sleep(0.05)
+            return f"{tool_name} result"
+
+        for target, value in (('_call_tool', fake_call), ('_semantic_cache', False),
+                              ('_tool_cache', tool_cache.ToolResultCache(tool_cache.RedisBackend(FakeRedis())))):
+            patcher = patch.object(mcp_client, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_normalized_queries_share_an_entry(self):
+        mcp_client.call_backend_tool("search_medical_web", {"query": "Differential diagnosis  chest pain"})
+        result = mcp_client.call_backend_tool("search_medical_web", {"query": "differential diagnosis chest pain?"})
+        self.assertEqual(result, "search_medical_web result")
+        self.assertEqual(len(self.calls), 1)
+
+    def test_concurrent_identical_calls_are_coalesced(self):
+        async def concurrent_calls():
+            calls = [mcp_client.call_backend_tool_async("search_medical_web", {"query": "sepsis"}) for _ in range(4)]
+            return await asyncio.gather(*calls)
+
+        with patch.object(mcp_client, '_call_tool_async', lambda name, args: asyncio.to_thread(mcp_client._call_tool, name, args)):
+            results = asyncio.run(concurrent_calls())
+        self.assertEqual(set(results), {"search_medical_web result"})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_cancelled_leader_does_not_fail_followers(self):
+        results_cache = tool_cache.ToolResultCache(tool_cache.MemoryBackend())
+        fetches = []
+
+        async def fetch():
+            fetches.append(1)
+            await asyncio.sleep(0.05)
+            return "results"
+
+        async def scenario():
+            leader = asyncio.ensure_future(results_cache.call_async("search_medical_web", {"query": "sepsis"}, fetch))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(results_cache.call_async("search_medical_web", {"query": "sepsis"}, fetch))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(scenario()), "results")
+        self.assertEqual(len(fetches), 2)  # The follower took over the fetch
+
+    def test_writes_bypass_cache_and_invalidate_history(self):
+        args = {"patient_id": "P-1"}
+        mcp_client.call_backend_tool("get_patient_history", args)
+        mcp_client.call_backend_tool("save_consultation_log", {"patient_id": "P-1", "log_entry": "x"})
+        mcp_client.call_backend_tool("save_consultation_log", {"patient_id": "P-1", "log_entry": "x"})
+        mcp_client.call_backend_tool("get_patient_history", args)
+        self.assertEqual([name for name, _ in self.calls],
+                         ["get_patient_history", "save_consultation_log", "save_consultation_log", "get_patient_history"])
+
+    def test_memory_backend_expires(self):
+        now = [0.0]
+        backend = tool_cache.MemoryBackend(clock=lambda: now[0])
+        backend.set("k", "v", ttl=10)
+        self.assertEqual(backend.get("k"), "v")
+        now[0] = 11
+        self.assertIsNone(backend.get("k"))
+
+def bag_of_words_encode(texts):
+    """Deterministic stand-in for the sentence-transformers model."""
+    import numpy as np
+    vocabulary = ["chest", "pain", "differential", "sepsis", "criteria", "pediatric", "fever"]
+    rows = []
+    for text in texts:
+        words = re.findall(r"[a-z]+", text.lower())
+        row = np.array([words.count(w) for w in vocabulary], dtype=np.float32)
+        rows.append(row / (np.linalg.norm(row) or 1.0))
+    return np.stack(rows)
+
+class TestSemanticSearchCache(unittest.TestCase):
+    def test_paraphrase_reuses_result(self):
+        semantic = semantic_cache.SemanticSearchCache(threshold=0.9, encode=bag_of_words_encode)
+        result, vector = semantic.lookup("differential chest pain")
+        self.assertIsNone(result)
+        semantic.store("differential chest pain", "MI, PE, dissection", vector)
+
+        self.assertEqual(semantic.lookup("chest pain: differential?")[0], "MI, PE, dissection")
+        self.assertIsNone(semantic.lookup("pediatric fever sepsis criteria")[0])
+        self.assertEqual(semantic.stats()["hits"], 1)
+
+    def test_disabled_without_model(self):
+        semantic = semantic_cache.SemanticSearchCache(encode=lambda texts: None)
+        semantic.store("q", "r")
+        self.assertEqual(semantic.lookup("q"), (None, None))
+        self.assertEqual(semantic.stats()["misses"], 1)
+
+    def test_cold_model_is_a_miss_without_waiting(self):
+        with patch.object(embeddings, '_model', None), patch.object(embeddings, 'warm_up') as warm_up:
+            semantic = semantic_cache.SemanticSearchCache()
+            self.assertEqual(semantic.lookup("sepsis"), (None, None))
+        warm_up.assert_called_once()
+
+    def test_index_ring_buffer_reuses_oldest_slot(self):
+        index = semantic_cache.VectorIndex(dim=2, capacity=2)
+        self.assertEqual([index.add([1, 0]), index.add([0, 1]), index.add([1, 0])], [0, 1, 0])
+        self.assertEqual(index.count, 2)
+
+class FakeStream:
+    """Stand-in for llm.ChatStream yielding the given text chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.consumed = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.consumed == len(self.chunks):
+            raise StopAsyncIteration
+        self.consumed += 1
+        return self.chunks[self.consumed - 1]
+
+    async def aclose(self):
+        self.closed = True
+
+class TestConsultationWorkflow(unittest.TestCase):
+    def test_searches_then_answers(self):
+        first = FakeStream(["<think>check</think> [SEARCH: chest", " pain] ", "and more ", "never read"])
+        second = FakeStream(["### Executive Summary\n", "EMERGENCY"])
+        streams = [first, second]
+        sent = []
+        tool_calls = []
+
+        async def fake_stream_chat(messages):
+            sent.append([m["content"] for m in messages])
+            return streams.pop(0)
+
+        async def fake_tool(tool_name, arguments):
+            tool_calls.append(tool_name)
+            return {"search_medical_web": "MI likely"}.get(tool_name)
+
+        events = []
+        writer = MagicMock()
+        with patch.object(pipeline.llm, 'stream_chat', fake_stream_chat), \
+                patch.object(mcp_client, 'call_backend_tool_async', fake_tool), \
+                patch.object(log_writer, 'get_writer', return_value=writer), \
+                patch.object(embeddings, 'encode_if_ready', lambda texts: None), \
+                patch.object(pretriage, '_classifier', pretriage.CentroidClassifier(encode=lambda texts: None)):
+            result = asyncio.run(pipeline.run_consultation_async("P-1", "chest pain", [], on_event=lambda k, p=None: events.append(k)))
+
+        self.assertTrue(first.closed)
+        self.assertEqual(first.consumed, 3)
+        self.assertIn("Search results for 'chest pain':\nMI likely", sent[1][-1])
+        self.assertEqual(result["full_response"], "### Executive Summary\nEMERGENCY")
+        # The speculative chest-pain search is too broad a match for "chest pain", so the model's query runs itself
+        self.assertEqual(tool_calls, ["search_medical_web", "get_patient_history", "search_medical_web"])
+        writer.enqueue.assert_called_once_with("P-1", "### Executive Summary\nEMERGENCY")
+        self.assertIn("result", events)
+        self.assertEqual(events[0], "pretriage")  # Before any data is compiled
+        self.assertEqual(result["pretriage"]["level"], pretriage.EMERGENCY)
+        spans = [s["span"] for s in result["timings"]]
+        self.assertEqual(spans[0], "consultation")
+        for name in ("compile_patient_data", "llm_time_to_first_token", "llm_generation", "search_wait"):
+            self.assertIn(name, spans)
+        self.assertEqual([s["turn"] for s in result["timings"] if s["span"] == "llm_generation"], [0, 1])
+
+    def test_final_turn_is_read_to_the_end(self):
+        streams = [FakeStream([f"[SEARCH: q{turn}] more"]) for turn in range(pipeline.MAX_AGENT_TURNS - 1)]
+        streams.append(FakeStream(["### Executive Summary\nPer [SEARCH: c] results ", "admit.\n",
+                                   "### Detailed Reasoning\nLow BP."]))
+
+        async def fake_stream_chat(messages):
+            return streams.pop(0)
+
+        async def fake_tool(tool_name, arguments):
+            return "found"
+
+        with patch.object(pipeline.llm, 'stream_chat', fake_stream_chat), \
+                patch.object(mcp_client, 'call_backend_tool_async', fake_tool), \
+                patch.object(log_writer, 'get_writer', return_value=MagicMock()), \
+                patch.object(embeddings, 'encode_if_ready', lambda texts: None), \
+                patch.object(pretriage, '_classifier', pretriage.CentroidClassifier(encode=lambda texts: None)):
+            result = asyncio.run(pipeline.run_consultation_async("P-1", "dizzy", []))
+
+        self.assertEqual(result["summary"], "Per [SEARCH: c] results admit.")
+        self.assertEqual(result["reasoning"], "Low BP.")
+
+    def test_matching_speculative_search_is_injected_under_its_own_query(self):
+        streams = [FakeStream(["[SEARCH: Acute chest pain evaluation, acute coronary syndrome]"]), FakeStream(["EMERGENCY"])]
+        sent = []
+        tool_calls = []
+
+        async def fake_stream_chat(messages):
+            sent.append([m["content"] for m in messages])
+            return streams.pop(0)
+
+        async def fake_tool(tool_name, arguments):
+            tool_calls.append(arguments.get("query", tool_name))
+            return "ACS workup" if tool_name == "search_medical_web" else None
+
+        with patch.object(pipeline.llm, 'stream_chat', fake_stream_chat), \
+                patch.object(mcp_client, 'call_backend_tool_async', fake_tool), \
+                patch.object(log_writer, 'get_writer', return_value=MagicMock()), \
+                patch.object(embeddings, 'encode_if_ready', lambda texts: None), \
+                patch.object(pretriage, '_classifier', pretriage.CentroidClassifier(encode=lambda texts: None)):
+            asyncio.run(pipeline.run_consultation_async("P-1", "crushing chest pain", []))
+
+        self.assertEqual(tool_calls, [speculation.FLAG_QUERIES["chest pain"], "get_patient_history"])
+        self.assertIn(f"Search results for '{speculation.FLAG_QUERIES['chest pain']}':\nACS workup", sent[1][-1])
+
+class TestPretriage(unittest.TestCase):
+    def setUp(self):
+        prototypes = {
+            pretriage.EMERGENCY: ["chest pain", "sepsis criteria"],
+            pretriage.URGENT: ["fever", "pediatric fever"],
+            pretriage.STABLE: ["differential", "criteria"],
+        }
+        self.classifier = pretriage.CentroidClassifier(prototypes, encode=bag_of_words_encode)
+        self.rules_only = pretriage.CentroidClassifier(encode=lambda texts: None)
+
+    def test_red_flags_respect_negation_and_vitals(self):
+        self.assertEqual(pretriage.red_flags("Denies chest pain. Mild cough."), [])
+        flags = pretriage.red_flags("Crushing chest pain, SpO2 86% on air, HR 120, no fever")
+        self.assertEqual(flags, [(pretriage.EMERGENCY, "chest pain"), (pretriage.EMERGENCY, "low oxygen saturation"),
+                                 (pretriage.URGENT, "tachycardia")])
+        self.assertEqual(pretriage.red_flags("Denies any chest pain or shortness of breath."), [])
+        self.assertEqual(pretriage.red_flags("denies trauma, slurred speech and facial droop"), [(pretriage.EMERGENCY, "stroke signs")])
+        self.assertEqual(pretriage.red_flags("No fever, now crushing chest pain"), [(pretriage.EMERGENCY, "chest pain")])
+        self.assertEqual(pretriage.red_flags("No cardiac history but reports chest pain"), [(pretriage.EMERGENCY, "chest pain")])
+
+    def test_hours_are_not_heart_rates(self):
+        self.assertEqual(pretriage.red_flags("Vomiting for 24 hr, 150 ml emesis"), [])
+        self.assertEqual(pretriage.red_flags("IV fluids over 2 hr 140 ml/h"), [])
+        self.assertEqual(pretriage.red_flags("Fever for 2 days, HR 150 bpm"), [(pretriage.EMERGENCY, "severe tachycardia")])
+        self.assertEqual(pretriage.red_flags("heart rate: 118"), [(pretriage.URGENT, "tachycardia")])
+
+    def test_rules_decide_without_a_model(self):
+        result = pretriage.pretriage("Sudden slurred speech and facial droop", classifier=self.rules_only)
+        self.assertEqual((result["level"], result["source"], result["scores"]), (pretriage.EMERGENCY, "rules", None))
+        self.assertEqual(pretriage.pretriage("Routine refill", classifier=self.rules_only)["level"], pretriage.STABLE)
+
+    def test_batch_uses_most_severe_signal(self):
+        results = pretriage.pretriage_batch(
+            [("Pediatric fever since yesterday", ""), ("", "Meets sepsis criteria"), ("Fracture of the wrist", "chest")],
+            classifier=self.classifier,
+        )
+        self.assertEqual([r["level"] for r in results], [pretriage.URGENT, pretriage.EMERGENCY, pretriage.EMERGENCY])
+        self.assertEqual(results[0]["source"], "embedding")
+        self.assertEqual(results[1]["source"], "rules+embedding")
+        self.assertEqual(results[2]["red_flags"], ["fracture"])
+
+    def test_batch_rows_scored_without_backend(self):
+        rows = batch.parse_batch('{"patient_id": "P-1", "notes": "BP 80/40, unresponsive"}\n{"patient_id": "P-2", "notes": "cold"}', "jsonl")
+        with patch.object(pretriage, '_classifier', self.rules_only):
+            scored = batch.pretriage_rows(rows)
+        self.assertEqual([(r["patient_id"], r["level"]) for r in scored], [("P-1", pretriage.EMERGENCY), ("P-2", pretriage.STABLE)])
+
+class TestSpeculation(unittest.TestCase):
+    def test_likely_queries_and_matching(self):
+        queries = speculation.likely_queries({"red_flags": ["chest pain", "sepsis signs", "fever"]})
+        self.assertEqual(queries, [speculation.FLAG_QUERIES["chest pain"], speculation.FLAG_QUERIES["sepsis signs"]])
+        self.assertEqual(speculation.likely_queries(None), [])
+        self.assertAlmostEqual(speculation.word_overlap("Sepsis initial management", speculation.FLAG_QUERIES["sepsis signs"]), 2 / 3)
+        for query in ("chest pain in pregnancy", "chest pain costochondritis treatment"):
+            self.assertLess(speculation.word_overlap(query, speculation.FLAG_QUERIES["chest pain"]), speculation.MATCH_OVERLAP)
+        self.assertLess(speculation.word_overlap("ankle sprain", speculation.FLAG_QUERIES["sepsis signs"]), speculation.MATCH_OVERLAP)
+
+    def test_claims_matching_search_once_and_cancels_the_rest(self):
+        calls = []
+        outcomes = speculation._Outcomes(size=4)
+
+        async def fake_call(tool_name, arguments):
+            calls.append(arguments["query"])
+            await asyncio.sleep(0 if "sepsis" in arguments["query"] else 10)
+            return f"results for {arguments['query']}"
+
+        async def scenario():
+            search = speculation.SpeculativeSearch(limit=2, encode=lambda texts: None, outcomes=outcomes)
+            search.start(speculation.likely_queries({"red_flags": ["sepsis signs", "fracture", "fever"]}))
+            claimed = await search.claim("sepsis initial management")
+            unmatched = await search.claim("ankle sprain")
+            again = await search.claim("sepsis recognition")
+            result = await claimed[1]
+            slow = search._tasks[speculation.FLAG_QUERIES["fracture"]]
+            search.finish()
+            await asyncio.sleep(0)
+            return claimed[0], result, unmatched, again, slow.cancelled()
+
+        with patch.object(mcp_client, "call_backend_tool_async", fake_call):
+            query, result, unmatched, again, cancelled = asyncio.run(scenario())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((query, result), (speculation.FLAG_QUERIES["sepsis signs"], "results for " + query))
+        self.assertEqual((unmatched, again, cancelled), (None, None, True))
+        self.assertEqual(list(outcomes._recent), [True, False])
+
+    def test_allowance_shrinks_with_waste_and_stops_on_open_breaker(self):
+        outcomes = speculation._Outcomes(size=4)
+        self.assertEqual(speculation.allowance(3, outcomes), 3)
+        for _ in range(4):
+            outcomes.record(False)
+        self.assertEqual(speculation.allowance(3, outcomes), 1)
+        breaker = limits.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        with patch.object(mcp_client, "get_breaker", return_value=breaker):
+            self.assertEqual(speculation.allowance(3, outcomes), 0)
+
+class TestBatch(unittest.TestCase):
+    def test_parse_csv_and_jsonl(self):
+        csv_rows = batch.parse_batch('patient_id,notes,files\nP-1,"Chest pain, 2h",a.pdf; b.docx\nP-2,Fever,\n', "csv")
+        self.assertEqual(csv_rows[0], {"patient_id": "P-1", "notes": "Chest pain, 2h", "files": ["a.pdf", "b.docx"]})
+        self.assertEqual(csv_rows[1]["files"], [])
+        jsonl_rows = batch.parse_batch('{"patient_id": "P-3", "notes": "SOB", "files": ["c.pdf"]}\n\n', "jsonl")
+        self.assertEqual(jsonl_rows, [{"patient_id": "P-3", "notes": "SOB", "files": ["c.pdf"]}])
+
+    def test_runs_rows_concurrently_and_streams_results(self):
+        in_flight = []
+        peak = [0]
+
+        async def runner(patient_id, notes, files):
+            in_flight.append(patient_id)
+            peak[0] = max(peak[0], len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(patient_id)
+            if patient_id == "P-3":
+                raise RuntimeError("model unavailable")
+            return {"summary": f"{patient_id}: {[f.name for f in files]}", "reasoning": "r", "full_response": "x"}
+
+        rows = [{"patient_id": f"P-{i}", "notes": "", "files": ["labs.pdf"]} for i in range(10)]
+        resolve = lambda name: pipeline.FileRef(name, "application/pdf", b"")
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "out.jsonl")
+            run = asyncio.run(batch.run_batch_async(rows, output, concurrency=3, resolve_file=resolve, runner=runner))
+            with open(output) as f:
+                results = [json.loads(line) for line in f]
+
+        self.assertEqual(peak[0], 3)
+        self.assertTrue(run.finished)
+        self.assertEqual((run.done, run.failed, run.total), (10, 1, 10))
+        self.assertEqual(sorted(r["row"] for r in results), list(range(10)))
+        failed = [r for r in results if r["status"] == "error"]
+        self.assertEqual([r["patient_id"] for r in failed], ["P-3"])
+        self.assertIn("model unavailable", failed[0]["error"])
+        self.assertIn("['labs.pdf']", results[0]["summary"])
+
+    def test_background_batch_calls_on_finish(self):
+        finished = threading.Event()
+        with tempfile.TemporaryDirectory() as directory:
+            run = batch.start_batch([], os.path.join(directory, "out.jsonl"), on_finish=finished.set)
+            self.assertTrue(finished.wait(5))
+        self.assertTrue(run.finished)
+
+def make_png(size, mode="RGB", color=(200, 30, 30)):
+    from PIL import Image
+    out = io.BytesIO()
+    Image.new(mode, size, color).save(out, format="PNG")
+    return out.getvalue()
+
+class TestImages(unittest.TestCase):
+    def decode(self, data):
+        from PIL import Image
+        return Image.open(io.BytesIO(data))
+
+    def test_prepare_image_downsizes_and_reencodes(self):
+        mime, data, size = images.prepare_image(make_png((3000, 1500)), max_side=512)
+        self.assertEqual(mime, "image/jpeg")
+        self.assertEqual(size, (512, 256))
+        self.assertEqual(self.decode(data).mode, "RGB")
+
+    def test_high_bit_depth_and_transparent_images(self):
+        _, data, _ = images.prepare_image(make_png((64, 64), mode="I;16", color=40000))
+        self.assertEqual(self.decode(data).mode, "L")
+        _, data, _ = images.prepare_image(make_png((64, 64), mode="RGBA", color=(0, 0, 0, 0)))
+        self.assertEqual(self.decode(data).getpixel((0, 0)), (255, 255, 255))
+
+    def test_prepared_images_are_cached_by_content(self):
+        png = make_png((800, 600), color=(1, 2, 3))
+        calls = []
+        original = images.prepare_image
+
+        def counting(data, *args, **kwargs):
+            calls.append(1)
+            return original(data, *args, **kwargs)
+
+        with patch.object(images, 'prepare_image', counting):
+            first = asyncio.run(images.prepare_images_async([FakeUpload("a.png", "image/png", png)]))
+            second = asyncio.run(images.prepare_images_async([FakeUpload("renamed.png", "image/png", png)]))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(first[0]["data_url"].startswith("data:image/jpeg;base64,"))
+        self.assertEqual(first[0]["data_url"], second[0]["data_url"])
+        broken = asyncio.run(images.prepare_images_async([FakeUpload("bad.png", "image/png", b"not an image")]))
+        self.assertIn("error", broken[0])
+
+    def test_spooled_images_are_decoded_from_disk_and_size_checked_first(self):
+        spooled = uploads.FileRef._spool("scan.png", "image/png", lambda out: out.write(make_png((64, 48), color=(9, 9, 9))))
+        self.addCleanup(spooled.release)
+        with patch.object(uploads.FileRef, 'getvalue', side_effect=AssertionError("read into memory")):
+            prepared = asyncio.run(images.prepare_images_async([spooled]))
+            self.assertTrue(prepared[0]["data_url"].startswith("data:image/jpeg;base64,"))
+            with patch.object(images, 'MAX_INPUT_BYTES', 10):
+                self.assertIn("image limit", asyncio.run(images.prepare_images_async([spooled]))[0]["error"])
+
+    def test_consultation_attaches_images_and_falls_back_to_text(self):
+        class Rejected(Exception):
+            status_code = 400
+
+        sent = []
+
+        async def fake_stream_chat(messages):
+            sent.append(messages)
+            if len(sent) == 1:
+                raise Rejected("model does not support images")
+            return FakeStream(["### Executive Summary\n", "Stable"])
+
+        async def fake_tool(tool_name, arguments):
+            return None
+
+        xray = FakeUpload("xray.png", "image/png", make_png((2048, 2048), mode="L", color=128))
+        with patch.object(pipeline.llm, 'stream_chat', fake_stream_chat), \
+                patch.object(mcp_client, 'call_backend_tool_async', fake_tool), \
+                patch.object(log_writer, 'get_writer', return_value=MagicMock()), \
+                patch.object(images, '_text_only_models', set()):
+            result = asyncio.run(pipeline.run_consultation_async("P-1", "fall", [xray]))
+            asyncio.run(pipeline.run_consultation_async("P-1", "fall", [xray]))
+
+        first_content = sent[0][1]["content"]
+        self.assertEqual([part["type"] for part in first_content], ["text", "image_url"])
+        self.assertIn("xray.png (attached)", first_content[0]["text"])
+        self.assertIsInstance(sent[1][1]["content"], str)
+        self.assertEqual(result["summary"], "Stable")
+        # The rejection is remembered: the next consultation goes straight to text
+        self.assertEqual(len(sent), 3)
+        self.assertIsInstance(sent[2][1]["content"], str)
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        self.registry = telemetry.REGISTRY
+        self.registry.reset()
+
+    def test_prometheus_text(self):
+        self.registry.observe("stage_seconds", 0.02, {"tool": 'say "hi"'})
+        self.registry.observe("stage_seconds", 3.0, {"tool": 'say "hi"'})
+        self.registry.increment("llm_output_tokens_total", 42)
+        text = self.registry.prometheus_text()
+        self.assertIn("# TYPE medgemma_stage_seconds histogram", text)
+        self.assertIn('medgemma_stage_seconds_bucket{tool="say \\"hi\\"",le="0.025"} 1', text)
+        self.assertIn('medgemma_stage_seconds_bucket{tool="say \\"hi\\"",le="+Inf"} 2', text)
+        self.assertIn('medgemma_stage_seconds_count{tool="say \\"hi\\""} 2', text)
+        self.assertIn("medgemma_llm_output_tokens_total 42", text)
+        self.assertEqual(json.loads(telemetry.to_json())["counters"][0]["value"], 42)
+
+    def test_spans_reach_the_trace_across_tasks_and_threads(self):
+        @telemetry.timed("step")
+        async def step():
+            await asyncio.to_thread(lambda: telemetry.record("worker", 0.01))
+
+        async def failing():
+            with telemetry.span("broken"):
+                raise ValueError("boom")
+
+        async def main():
+            trace = telemetry.start_trace()
+            await asyncio.gather(asyncio.ensure_future(step()), failing(), return_exceptions=True)
+            return trace
+
+        trace = asyncio.run(main())
+        spans = {s["span"]: s for s in trace.breakdown()}
+        self.assertEqual(set(spans), {"step", "worker", "broken"})
+        self.assertEqual(spans["broken"]["outcome"], "error")
+        names = {h["name"] for h in self.registry.snapshot()["histograms"]}
+        self.assertEqual(names, {"medgemma_step_seconds", "medgemma_worker_seconds", "medgemma_broken_seconds"})
+
+class TestContextBudget(unittest.TestCase):
+    def test_fit_documents_keeps_relevant_chunks_within_budget(self):
+        filler = "\n".join(f"Routine billing line {i} with administrative details." for i in range(400))
+        relevant = "Troponin elevated at 2.1 ng/mL with ST elevation on ECG."
+        docs = f"--- Document: discharge.pdf ---\nDischarge summary\n{filler}\n{relevant}\n{filler}\n--- End Document ---"
+
+        fitted = context.fit_documents(docs, "troponin ST elevation ECG", budget=400, encode=lambda texts: None)
+
+        self.assertLessEqual(context.estimate_tokens(fitted), 450)
+        self.assertIn(relevant, fitted)
+        self.assertIn("Discharge summary", fitted)
+        self.assertIn("less relevant section(s) omitted", fitted)
+
+    def test_small_inputs_pass_through(self):
+        self.assertEqual(context.fit_documents("short", "q", budget=100), "short")
+
+    def test_scoring_does_not_wait_for_the_model(self):
+        with patch.object(embeddings, 'encode_if_ready', return_value=None), \
+                patch.object(embeddings, 'encode', side_effect=AssertionError("waited for the model")):
+            scores = context.score_chunks(["billing codes", "troponin elevated"], "troponin")
+        self.assertEqual(scores.index(max(scores)), 1)
+
+    def test_message_tokens_counts_images(self):
+        message = {"role": "user", "content": images.user_content("abcd" * 10, [{"name": "x.png", "data_url": "data:,"}])}
+        self.assertEqual(context.message_tokens(message), 10 + images.TOKENS_PER_IMAGE)
+
+    def test_fit_messages_compacts_older_turns(self):
+        messages = [
+            {"role": "system", "content": "system"},
+            {"role": "user", "content": "case"},
+            {"role": "assistant", "content": "<think>" + "long reasoning " * 500 + "</think>[SEARCH: sepsis]"},
+            {"role": "user", "content": "Search results for 'sepsis':\n" + "result text. " * 500},
+            {"role": "assistant", "content": "[SEARCH: qsofa]"},
+            {"role": "user", "content": "Search results for 'qsofa':\nlatest"},
+        ]
+        fitted = context.fit_messages(messages, budget=300)
+        self.assertEqual(fitted[2]["content"], "[SEARCH: sepsis]")
+        self.assertIn("earlier search results", fitted[3]["content"])
+        self.assertEqual(fitted[-1], messages[-1])
+        self.assertIn("long reasoning", messages[2]["content"])
+
+class TestJobEngine(unittest.TestCase):
+    def wait_for(self, engine, job_id, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not engine.get(job_id).finished:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        return engine.get(job_id)
+
+    def test_runs_jobs_with_bounded_concurrency_and_persists(self):
+        import tempfile
+        running = []
+        peak = []
+
+        async def runner(patient_id, notes, files, on_event=None):
+            running.append(patient_id)
+            peak.append(len(running))
+            on_event("raw_data", f"prompt for {patient_id}")
+            on_event("turn", 0)
+            for token in ("Hello ", "world"):
+                on_event("token", token)
+                await asyncio.sleep(0.02)
+            running.remove(patient_id)
+            return {"summary": f"ok {patient_id}", "reasoning": ""}
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = jobs.JobEngine(concurrency=2, store=jobs.JobStore(directory), runner=runner)
+            ids = [engine.submit(f"P-{i}", "notes", [FakeUpload("a.pdf", "application/pdf", b"%PDF")]) for i in range(5)]
+            finished = [self.wait_for(engine, job_id) for job_id in ids]
+
+            self.assertEqual(max(peak), 2)
+            self.assertTrue(all(job.status == jobs.DONE for job in finished))
+            self.assertEqual(finished[3].result["summary"], "ok P-3")
+            self.assertEqual(finished[0].read_turn(None, 0), (0, "Hello world", 11))
+
+            reloaded = jobs.JobStore(directory).load(ids[4])
+            self.assertEqual((reloaded.status, reloaded.raw_data), (jobs.DONE, "prompt for P-4"))
+
+    def test_failed_job_reports_error(self):
+        async def runner(*args, **kwargs):
+            raise RuntimeError("model unavailable")
+
+        engine = jobs.JobEngine(runner=runner)
+        job = self.wait_for(engine, engine.submit("P-1", "", []))
+        self.assertEqual((job.status, job.error), (jobs.FAILED, "model unavailable"))
+
+    def test_cancelled_job_finishes_and_old_snapshots_are_purged(self):
+        import tempfile
+        async def runner(*args, **kwargs):
+            raise asyncio.CancelledError()
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = jobs.JobStore(directory)
+            old = os.path.join(directory, "old.json")
+            with open(old, "w") as f:
+                f.write("{}")
+            os.utime(old, (0, 0))
+            engine = jobs.JobEngine(store=store, runner=runner)
+            job = self.wait_for(engine, engine.submit("P-1", "", []))
+            self.assertEqual((job.status, job.stage), (jobs.FAILED, "Cancelled."))
+            self.assertEqual(store.load(job.id).status, jobs.FAILED)
+            self.assertFalse(os.path.exists(old))
+
+    def test_unfinished_snapshot_loads_as_interrupted(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            store = jobs.JobStore(directory)
+            job = jobs.Job("j1", "P-1", "", [])
+            job.status = jobs.RUNNING
+            store.save(job)
+            self.assertEqual(store.load("j1").status, jobs.INTERRUPTED)
+
+class TestConsultationAPI(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.received = []
+
+        async def runner(patient_id, notes, files, on_event=None):
+            self.received.append([(f.name, f.getvalue()) for f in files])
+            on_event("pretriage", {"level": "EMERGENCY"})
+            on_event("turn", 0)
+            for token in ("Acute ", "MI"):
+                on_event("token", token)
+                await asyncio.sleep(0.01)
+            await asyncio.to_thread(self.release.wait, 5)
+            return {"summary": "EMERGENCY", "reasoning": "", "full_response": "Acute MI"}
+
+        self.directory = tempfile.mkdtemp()
+        self.engine = jobs.JobEngine(store=jobs.JobStore(self.directory), runner=runner)
+        from starlette.testclient import TestClient
+        self.client = TestClient(api.create_app(self.engine))
+
+    def test_submit_stream_and_fetch(self):
+        response = self.client.post("/consultations", data={"patient_id": "P-1", "notes": "chest pain"},
+                                    files=[("files", ("ecg.pdf", b"%PDF-1.4", "application/pdf"))])
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["id"]
+        self.release.set()
+        with self.client.stream("GET", f"/consultations/{job_id}/events") as stream:
+            events = list(api_client.iter_sse(stream.iter_lines()))
+        kinds = [kind for kind, _ in events]
+        self.assertEqual((kinds[0], kinds[-1]), ("snapshot", "status"))
+        text = events[0][1]["turn_text"] + "".join(payload for kind, payload in events if kind == "token")
+        self.assertEqual(text, "Acute MI")
+        self.assertEqual(events[-1][1]["result"]["summary"], "EMERGENCY")
+        self.assertEqual(self.received, [[("ecg.pdf", b"%PDF-1.4")]])
+        self.assertEqual(self.client.get(f"/consultations/{job_id}").json()["status"], jobs.DONE)
+        self.assertEqual(self.client.get("/consultations/missing").status_code, 404)
+        self.assertEqual(self.client.post("/consultations", json={}).status_code, 400)
+        self.assertEqual(self.client.post("/consultations", json=[1, 2]).status_code, 400)
+
+    def test_remote_engine_mirrors_job(self):
+        remote = api_client.RemoteEngine(client=self.client)
+        job_id = remote.submit("P-2", "notes", [FakeUpload("a.txt", "text/plain", b"abc")])
+        job = remote.get(job_id)
+        self.release.set()
+        deadline = time.monotonic() + 5
+        while not job.finished:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(job.status, jobs.DONE)
+        self.assertEqual(job.read_turn(None, 0)[1], "Acute MI")
+        self.assertEqual(job.pretriage, {"level": "EMERGENCY"})
+
+    def test_token_guards_everything_but_health_and_metrics(self):
+        from starlette.testclient import TestClient
+        client = TestClient(api.create_app(self.engine, token="s3cret"))
+        for path in ("/consultations/missing", "/consultations/search?q=x", "/patients/P-1/consultations",
+                     "/patients/P-1/consultations/latest"):
+            self.assertEqual(client.get(path).status_code, 401)
+            self.assertEqual(client.get(path, headers={"Authorization": "Bearer wrong"}).status_code, 401)
+        self.assertEqual(client.post("/consultations", json={"notes": "x"}).status_code, 401)
+        self.assertEqual((client.get("/healthz").status_code, client.get("/metrics").status_code), (200, 200))
+
+        remote = api_client.RemoteEngine(client=client, token="s3cret")
+        job_id = remote.submit("P-4", "notes", [])
+        self.assertEqual(remote.get(job_id).patient_id, "P-4")
+        self.release.set()
+
+    def test_job_on_another_worker_is_served_from_shared_store(self):
+        job_id = self.engine.submit("P-3", "notes", [])
+        deadline = time.monotonic() + 5
+        while self.engine.get(job_id).read_turn(None, 0)[1] != "Acute MI":
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.engine._persist(self.engine.get(job_id))
+        other_worker = jobs.JobEngine(store=jobs.JobStore(self.directory))
+        job = other_worker.get(job_id)
+        self.assertEqual((job.status, job.read_turn(None, 0)[1]), (jobs.RUNNING, "Acute MI"))
+        self.release.set()
+
+class TestConsultationStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = consultation_store.ConsultationStore(os.path.join(self.directory, "consultations.db"))
+
+    def test_save_latest_and_search(self):
+        self.store.save("P-1", "mild cough", {"summary": "STABLE: viral URI", "reasoning": "", "timings": [1]}, created_at=100.0)
+        self.store.save("P-1", "crushing chest pain", {"summary": "EMERGENCY: suspected MI", "reasoning": "ST elevation",
+                                                       "raw_data": "ecg"}, created_at=200.0)
+        self.store.save("P-2", "ankle injury", {"summary": "", "pretriage": {"level": "URGENT"}}, created_at=150.0)
+
+        latest = self.store.latest("P-1")
+        self.assertEqual((latest["summary"], latest["raw_data"], latest["triage_level"]), ("EMERGENCY: suspected MI", "ecg", "EMERGENCY"))
+        self.assertNotIn("timings", latest)
+        self.assertIsNone(self.store.latest("P-9"))
+        self.assertEqual([c["created_at"] for c in self.store.consultations("P-1")], [200.0, 100.0])
+        self.assertEqual(self.store.consultations("P-2")[0]["triage_level"], "URGENT")
+
+        self.assertEqual([c["patient_id"] for c in self.store.search("chest pain")], ["P-1"])
+        self.assertEqual(self.store.search("ankle", patient_id="P-1"), [])
+        self.assertEqual(self.store.search('"chest" OR'), [])  # Quoted, not read as FTS syntax
+        self.assertEqual(self.store.search("  "), [])
+        self.assertEqual(os.stat(self.store.path).st_mode & 0o777, 0o600)
+
+    def test_cached_history_expires_and_includes_recent_consultations(self):
+        self.store.store_history("P-1", "Prior: asthma.")
+        self.assertEqual(self.store.cached_history("P-1"), "Prior: asthma.")
+        self.assertIsNone(self.store.cached_history("P-1", max_age=-1))
+        self.assertIsNone(self.store.cached_history("P-2"))
+        self.store.save("P-1", "wheeze", {"summary": "URGENT: asthma flare"})
+        self.assertIn("URGENT: asthma flare", self.store.cached_history("P-1"))
+
+    def test_unusable_location_disables_the_store(self):
+        with patch.object(consultation_store, "_store", None), \
+                patch.dict(os.environ, {"CONSULTATION_STORE": "on", "CONSULTATION_DB_PATH": "/dev/null/consultations.db"}), \
+                self.assertLogs(consultation_store.logger, "WARNING"):
+            self.assertIsNone(consultation_store.get_store())
+            self.assertIsNone(consultation_store.record_consultation("P-1", "notes", {"summary": "STABLE"}))
+
+    def test_history_is_read_through_the_store(self):
+        calls = []
+
+        async def fake_call(tool_name, arguments):
+            calls.append(arguments["patient_id"])
+            return "No patient history found." if arguments["patient_id"] == "P-2" else "Prior: asthma."
+
+        with patch.object(consultation_store, "_store", self.store), \
+             patch.object(mcp_client, "call_backend_tool_async", fake_call):
+            for patient_id in ("P-1", "P-1", "P-2", "P-2"):
+                asyncio.run(pipeline.fetch_patient_history_async(patient_id))
+            self.assertEqual(calls, ["P-1", "P-2", "P-2"])  # Degraded results are refetched
+
+            from starlette.testclient import TestClient
+            self.store.save("P-1", "wheeze", {"summary": "URGENT"})
+            client = TestClient(api.create_app(jobs.JobEngine(store=jobs.JobStore(self.directory))))
+            self.assertEqual(client.get("/patients/P-1/consultations/latest").json()["summary"], "URGENT")
+            self.assertEqual(client.get("/patients/P-2/consultations/latest").status_code, 404)
+            self.assertEqual(len(client.get("/consultations/search", params={"q": "wheeze"}).json()), 1)
+
+class TestConsultationLogWriter(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.wal_path = os.path.join(directory.name, "logs.wal")
+
+    def test_batches_and_retries_until_delivered(self):
+        delivered = []
+        failures = {"P-2": 1}
+
+        async def send(entry):
+            if failures.get(entry["patient_id"]):
+                failures[entry["patient_id"]] -= 1
+                raise ConnectionError("backend down")
+            delivered.append(entry["patient_id"])
+
+        writer = log_writer.ConsultationLogWriter(self.wal_path, send=send, flush_interval=0.05, retry_backoff=0.01)
+        self.addCleanup(writer.close)
+        for i in range(3):
+            self.assertTrue(writer.enqueue(f"P-{i}", "log"))
+        self.assertTrue(writer.flush())
+        self.assertEqual(sorted(delivered), ["P-0", "P-1", "P-2"])
+
+    def test_entries_out_of_attempts_are_retried_after_an_outage(self):
+        outage = {"calls": 3}
+
+        async def send(entry):
+            if outage["calls"]:
+                outage["calls"] -= 1
+                raise ConnectionError("breaker open")
+
+        writer = log_writer.ConsultationLogWriter(self.wal_path, send=send, max_attempts=1, flush_interval=0.01, park_seconds=0.05)
+        self.addCleanup(writer.close)
+        writer.enqueue("P-1", "kept")
+        deadline = time.monotonic() + 5
+        while writer.pending:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual((outage["calls"], writer.failed), (0, 0))
+        self.assertEqual(os.path.getsize(self.wal_path), 0)  # Truncated once nothing is pending
+
+    def test_unacknowledged_entries_replay_after_crash(self):
+        async def down(entry):
+            raise ConnectionError("backend down")
+
+        writer = log_writer.ConsultationLogWriter(self.wal_path, send=down, max_attempts=1, flush_interval=0.01)
+        writer.enqueue("P-1", "survives")
+        writer.flush(timeout=0.5)
+        writer.close()
+
+        delivered = []
+
+        async def send(entry):
+            delivered.append(entry["log_entry"])
+
+        replayed = log_writer.ConsultationLogWriter(self.wal_path, send=send, flush_interval=0.01)
+        self.addCleanup(replayed.close)
+        self.assertTrue(replayed.flush())
+        self.assertEqual(delivered, ["survives"])
+
+    def test_processes_keep_private_files_and_adopt_orphans(self):
+        async def down(entry):
+            raise ConnectionError("backend down")
+
+        first = log_writer.ConsultationLogWriter(self.wal_path, send=down, max_attempts=1, flush_interval=0.01)
+        second = log_writer.ConsultationLogWriter(self.wal_path, send=down, max_attempts=1, flush_interval=0.01)
+        self.assertEqual((first.wal_path, second.wal_path), (self.wal_path, self.wal_path + ".1"))
+        self.assertEqual(os.stat(second.wal_path).st_mode & 0o777, 0o600)
+        second.enqueue("P-2", "orphaned")
+        second.flush(timeout=0.5)
+        second.close()  # Exits with an undelivered entry
+        first.close()
+
+        delivered = []
+
+        async def send(entry):
+            delivered.append(entry["log_entry"])
+
+        third = log_writer.ConsultationLogWriter(self.wal_path, send=send, flush_interval=0.01)
+        self.addCleanup(third.close)
+        self.assertTrue(third.flush())
+        self.assertEqual((third.wal_path, delivered), (self.wal_path, ["orphaned"]))
+        self.assertEqual(os.path.getsize(self.wal_path + ".1"), 0)
+
+class StubCompletionHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible streaming endpoint; the model name sets the first-token delay."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        delay = {"slow": 0.5, "fast": 0.0}.get(body["model"], 0.0)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(delay)
+        for text in (body["model"], " says hi"):
+            chunk = {"id": "c", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+class TestLLMProviders(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubCompletionHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.env = patch.dict(os.environ, {"OPENAI_BASE_URL": f"http://127.0.0.1:{cls.server.server_port}/v1",
+                                          "OPENAI_API_KEY": "test"})
+        cls.env.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.env.stop()
+        cls.server.shutdown()
+
+    def collect(self, **kwargs):
+        async def run():
+            stream = await llm.stream_chat([{"role": "user", "content": "hi"}], **kwargs)
+            text = "".join([t async for t in stream])
+            await stream.aclose()
+            return stream.target.model, text
+        return asyncio.run(run())
+
+    def test_clients_are_reused(self):
+        async def run():
+            return llm.get_client("openai") is llm.get_client("openai")
+        self.assertTrue(asyncio.run(run()))
+
+    def test_streams_from_openai_compatible_endpoint(self):
+        self.assertEqual(self.collect(primary=llm.Target("openai", "fast")), ("fast", "fast says hi"))
+
+    def test_hedge_takes_secondary_when_primary_is_slow(self):
+        start = time.perf_counter()
+        model, _ = self.collect(strategy="hedge", hedge_after=0.1,
+                                primary=llm.Target("openai", "slow"), secondary=llm.Target("openai", "fast"))
+        self.assertEqual(model, "fast")
+        self.assertLess(time.perf_counter() - start, 0.45)
+
+    def test_race_returns_first_to_answer(self):
+        model, _ = self.collect(strategy="race", primary=llm.Target("openai", "slow"), secondary=llm.Target("openai", "fast"))
+        self.assertEqual(model, "fast")
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket_delays_after_burst(self):
+        now = [0.0]
+        limiter = limits.RateLimiter(rate=2, per=1.0, burst=2, clock=lambda: now[0])
+        self.assertEqual([limiter._reserve(), limiter._reserve()], [0.0, 0.0])
+        self.assertAlmostEqual(limiter._reserve(), 0.5)
+        now[0] = 2.0
+        self.assertEqual(limiter._reserve(), 0.0)
+
+class TestBackendResilience(unittest.TestCase):
+    def setUp(self):
+        for target, value in (('_tool_cache', False), ('_semantic_cache', False), ('_breakers', {}),
+                              ('_limiter', None), ('_last_good', cache.LRUCache(1024 * 1024))):
+            patcher = patch.object(mcp_client, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_breaker_opens_then_allows_one_trial(self):
+        now = [0.0]
+        breaker = limits.CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertEqual(breaker.state, limits.HALF_OPEN)
+        self.assertEqual([breaker.allow(), breaker.allow()], [True, False])
+        breaker.record_success()
+        self.assertEqual(breaker.state, limits.CLOSED)
+
+    def test_limiter_hands_slots_over_and_sheds_overload(self):
+        limiter = limits.ConcurrencyLimiter(1, max_queue_seconds=0.2)
+
+        async def scenario():
+            await limiter.acquire()
+            waiter = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0.01)
+            limiter.release()
+            await waiter  # Got the released slot
+            with self.assertRaises(limits.OverloadedError):
+                await limiter.acquire()
+            limiter.release()
+
+        asyncio.run(scenario())
+        self.assertEqual((limiter.active, limiter.queued, limiter.rejected), (0, 0, 1))
+
+    def test_slow_tool_hits_deadline_and_degrades(self):
+        async def hung(tool_name, arguments):
+            await asyncio.sleep(5)
+
+        with patch.object(mcp_client, '_call_tool_async', hung), \
+                patch.dict(mcp_client.TOOL_DEADLINES, {"get_patient_history": 0.05}):
+            started = time.perf_counter()
+            result = asyncio.run(mcp_client.call_backend_tool_async("get_patient_history", {"patient_id": "P-1"}))
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual(result, mcp_client.DEGRADED_RESULTS["get_patient_history"])
+        with self.assertRaises(TimeoutError), patch.object(mcp_client, '_call_tool_async', hung), \
+                patch.dict(mcp_client.TOOL_DEADLINES, {"save_consultation_log": 0.05}):
+            asyncio.run(mcp_client.call_backend_tool_async("save_consultation_log", {}, raise_errors=True))
+
+    def test_open_breaker_fails_fast_with_last_good_result(self):
+        calls = []
+
+        def flaky(tool_name, arguments):
+            calls.append(tool_name)
+            if len(calls) > 1:
+                raise ConnectionError("backend down")
+            return "History: asthma"
+
+        args = {"patient_id": "P-1"}
+        with patch.object(mcp_client, '_call_tool', flaky), \
+                patch.object(mcp_client, 'get_breaker', lambda name: self.breaker):
+            self.breaker = limits.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+            results = [mcp_client.call_backend_tool("get_patient_history", args) for _ in range(5)]
+        self.assertEqual(results, ["History: asthma"] * 5)
+        self.assertEqual(len(calls), 3)  # One success, two failures, then the breaker opens
+        self.assertEqual(self.breaker.state, limits.OPEN)
+
+    def test_only_backend_failures_trip_the_breaker(self):
+        errors = iter([tools.ToolError("Unknown patient id"), tools.ToolError("HTTP 422 from tool endpoint", status_code=422),
+                       tools.ToolError("HTTP 503 from tool endpoint", status_code=503), ConnectionError("backend down")])
+
+        async def failing(tool_name, arguments):
+            raise next(errors)
+
+        breaker = limits.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        with patch.object(mcp_client, '_call_tool_async', failing), patch.object(mcp_client, 'get_breaker', lambda name: breaker):
+            for expected in (limits.CLOSED, limits.CLOSED, limits.CLOSED, limits.OPEN):
+                with self.assertRaises(Exception):
+                    asyncio.run(mcp_client._guarded_call_async("get_patient_history", {"patient_id": "P-?"}))
+                self.assertEqual(breaker.state, expected)
+
+    def test_http_transport_never_resends_writes(self):
+        sent = []
+
+        def handler(request):
+            sent.append(json.loads(request.content)["name"])
+            raise mcp_client.tools.httpx.ReadTimeout("no answer", request=request)
+
+        client = mcp_client.tools.httpx.Client(transport=mcp_client.tools.httpx.MockTransport(handler))
+        with patch.object(mcp_client, 'use_http_transport', lambda: True), \
+                patch.object(mcp_client.tools, '_HTTP_CLIENT', client), patch.object(mcp_client.tools, 'BACKOFF_SECONDS', 0):
+            for tool_name in ("save_consultation_log", "get_patient_history"):
+                with self.assertRaises(mcp_client.tools.httpx.ReadTimeout):
+                    mcp_client._call_tool(tool_name, {})
+        self.assertEqual(sent, ["save_consultation_log"] + ["get_patient_history"] * (mcp_client.tools.MAX_RETRIES + 1))
+
+    def test_half_open_trial_is_not_stranded(self):
+        now = [0.0]
+        breaker = limits.CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] = 10  # Half-open: the next call is the trial
+        full = limits.ConcurrencyLimiter(1, max_queue_seconds=0.01)
+        full.acquire_sync()
+
+        async def not_configured(tool_name, arguments):
+            raise mcp_client.MCPNotConfiguredError(mcp_client.NOT_CONFIGURED)
+
+        with patch.object(mcp_client, 'get_breaker', lambda name: breaker):
+            with patch.object(mcp_client, 'get_limiter', lambda: full), self.assertRaises(limits.OverloadedError):
+                asyncio.run(mcp_client._guarded_call_async("get_patient_history", {}))
+            with patch.object(mcp_client, '_call_tool_async', not_configured), \
+                    self.assertRaises(mcp_client.MCPNotConfiguredError):
+                asyncio.run(mcp_client._guarded_call_async("get_patient_history", {}))
+        self.assertTrue(breaker.allow())  # The trial slot is still free
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future
+from .cache import LRUCache
+from .utils import get_secret
+
+# Seconds each read-only tool's results stay fresh. Tools not listed here
+# (notably save_consultation_log) are never cached.
+TOOL_TTLS = {
+    "search_medical_web": 6 * 3600,
+    "get_patient_history": 300,
+}
+
+# Tools whose writes make cached reads for the same patient stale
+INVALIDATES = {
+    "save_consultation_log": ("get_patient_history", "patient_id"),
+}
+
+def normalize_query(query):
+    """
+    Canonicalizes a free-text query so trivially different phrasings share a key.
+    """
+    query = re.sub(r"\s+", " ", str(query)).strip().lower()
+    return query.strip(" .?!,;:\"'")
+
+def cache_key(tool_name, arguments):
+    normalized = dict(arguments or {})
+    if "query" in normalized:
+        normalized["query"] = normalize_query(normalized["query"])
+    digest = hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"tool:{tool_name}:{digest}"
+
+class MemoryBackend:
+    """
+    In-process LRU backend with per-entry expiry.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, clock=time.monotonic):
+        self._lru = LRUCache(max_bytes, sizeof=lambda entry: len(entry[1].encode("utf-8")))
+        self._clock = clock
+
+    def get(self, key):
+        entry = self._lru.get(key)
+        if entry is None or entry[0] < self._clock():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        self._lru.put(key, (self._clock() + ttl, value))
+
+    def delete(self, key):
+        self._lru.pop(key)
+
+class RedisBackend:
+    """
+    Backend for any Redis-compatible client exposing `get`, `set(..., ex=)`
+    and `delete` (e.g. `upstash_redis.Redis`).
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return value
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=int(ttl))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+# Result handed to waiting callers when the leading call was cancelled; they retry
+_LEADER_GONE = object()
+
+class ToolResultCache:
+    """
+    Read-through cache for backend tool results.
+
+    Concurrent identical calls are collapsed: the first caller runs the tool
+    and everyone else waits on its result, from any thread or event loop.
+    Backend failures degrade to uncached calls rather than errors.
+    """
+
+    def __init__(self, backend, ttls=None):
+        self.backend = backend
+        self.ttls = TOOL_TTLS if ttls is None else ttls
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def cacheable(self, tool_name):
+        return tool_name in self.ttls
+
+    def _lookup(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception:
+            return None
+
+    def _store(self, key, tool_name, value):
+        if value is None:
+            return  # Failed calls are not cached
+        try:
+            self.backend.set(key, value, self.ttls[tool_name])
+        except Exception:
+            pass
+
+    def _claim(self, key):
+        """
+        Returns `(future, is_leader)` for `key`.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._inflight[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, value=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def invalidate(self, tool_name, arguments):
+        try:
+            self.backend.delete(cache_key(tool_name, arguments))
+        except Exception:
+            pass
+
+    def after_write(self, tool_name, arguments):
+        """
+        Drops cached reads made stale by a write tool call.
+        """
+        target = INVALIDATES.get(tool_name)
+        if target and arguments and target[1] in arguments:
+            self.invalidate(target[0], {target[1]: arguments[target[1]]})
+
+    def call(self, tool_name, arguments, fetch):
+        """
+        Returns the cached result or runs `fetch()` once for all concurrent callers.
+        """
+        key = cache_key(tool_name, arguments)
+        cached = self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        while True:
+            future, leader = self._claim(key)
+            if leader:
+                break
+            value = future.result()
+            if value is not _LEADER_GONE:
+                return value
+        self.misses += 1
+        try:
+            value = fetch()
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(key, future, _LEADER_GONE)
+            raise
+        self._store(key, tool_name, value)
+        self._finish(key, future, value)
+        return value
+
+    async def call_async(self, tool_name, arguments, fetch):
+        """
+        Async counterpart of `call`; `fetch` is a coroutine function.
+        """
+        key = cache_key(tool_name, arguments)
+        cached = self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        while True:
+            future, leader = self._claim(key)
+            if leader:
+                break
+            # Shielded: a cancelled follower must not cancel the shared future
+            value = await asyncio.shield(asyncio.wrap_future(future))
+            if value is not _LEADER_GONE:
+                return value
+        self.misses += 1
+        try:
+            value = await fetch()
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            # The leader was cancelled; that is not the followers' outcome, so they fetch again
+            self._finish(key, future, _LEADER_GONE)
+            raise
+        self._store(key, tool_name, value)
+        self._finish(key, future, value)
+        return value
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+def create_backend():
+    """
+    Picks the backend from TOOL_CACHE_BACKEND: `memory` (default), `redis` or `off`.
+    """
+    kind = (get_secret("TOOL_CACHE_BACKEND") or "memory").lower()
+    if kind == "off":
+        return None
+    if kind == "redis":
+        from upstash_redis import Redis
+        return RedisBackend(Redis(url=get_secret("UPSTASH_REDIS_REST_URL"), token=get_secret("UPSTASH_REDIS_REST_TOKEN")))
+    return MemoryBackend(int(float(get_secret("TOOL_CACHE_MAX_MB", 32)) * 1024 * 1024))
@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+import weakref
+import httpx
+
+try:
+    from .utils import get_secret
+except ImportError:
+    # Imported as a top-level module (tests, scripts)
+    from utils import get_secret
+
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+DEFAULT_BASE_URL = "http://localhost:8000"
+MAX_RETRIES = 2
+BACKOFF_SECONDS = 0.25
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60.0)
+
+def __getattr__(name):
+    # fastmcp takes about a second to import and is only needed for MCP sessions
+    if name == "Client":
+        from fastmcp import Client
+        globals()["Client"] = Client
+        return Client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class ToolError(Exception):
+    """Raised when the backend rejects a tool call or reports `isError`."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _new_client(**kwargs):
+    return httpx.Client(http2=_HTTP2, timeout=_TIMEOUT, limits=_LIMITS, **kwargs)
+
+def _new_async_client(**kwargs):
+    return httpx.AsyncClient(http2=_HTTP2, timeout=_TIMEOUT, limits=_LIMITS, **kwargs)
+
+# Tool calls are plain JSON POSTs to `<base>/call_tool` over shared keep-alive
+# clients; this skips the SSE session setup of a full MCP client.
+_HTTP_CLIENT = _new_client()
+
+# Async clients are bound to the event loop that created them
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_ASYNC_CLIENTS_LOCK = threading.Lock()
+
+def get_async_client():
+    """
+    Returns the shared AsyncClient for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _ASYNC_CLIENTS_LOCK:
+        client = _ASYNC_CLIENTS.get(loop)
+        if client is None or client.is_closed:
+            client = _ASYNC_CLIENTS[loop] = _new_async_client()
+        return client
+
+def get_base_url():
+    """
+    Resolves the HTTP tool endpoint base from MCP_HTTP_URL, falling back to
+    MCP_SERVER_URL without its `/sse` suffix.
+    """
+    base = get_secret("MCP_HTTP_URL")
+    if not base:
+        sse_url = get_secret("MCP_SERVER_URL")
+        base = sse_url[:-len("/sse")] if sse_url and sse_url.endswith("/sse") else sse_url
+    return (base or DEFAULT_BASE_URL).rstrip("/")
+
+def _payload(tool_name, arguments):
+    return {"name": tool_name, "arguments": arguments or {}}
+
+def _should_retry(response):
+    return response.status_code in RETRY_STATUS_CODES
+
+def _backoff(attempt):
+    return BACKOFF_SECONDS * (2 ** attempt)
+
+def parse_tool_response(response):
+    """
+    Converts a `/call_tool` HTTP response into the tool's text output.
+
+    Raises:
+        ToolError: On non-2xx status or an `isError` payload.
+    """
+    if response.status_code >= 400:
+        raise ToolError(f"HTTP {response.status_code} from tool endpoint", status_code=response.status_code)
+    data = response.json()
+    if isinstance(data, dict):
+        content = data.get("content")
+        if isinstance(content, list):
+            text = "".join(c.get("text", "") for c in content if c.get("type") == "text")
+        else:
+            text = str(data.get("result", data))
+        if data.get("isError"):
+            raise ToolError(text or "Tool reported an error")
+        return text
+    return str(data)
+
+def call_fastmcp_tool(tool_name, arguments=None, base_url=None, retries=MAX_RETRIES):
+    """
+    Calls a backend tool synchronously over the shared HTTP client.
+
+    Args:
+        tool_name (str): Name of the MCP tool.
+        arguments (dict): Tool arguments.
+        base_url (str): Overrides the resolved endpoint base.
+        retries (int): Retries on transport errors and retryable statuses.
+
+    Returns:
+        str: The tool's text output.
+    """
+    url = f"{base_url or get_base_url()}/call_tool"
+    for attempt in range(retries + 1):
+        try:
+            response = _HTTP_CLIENT.post(url, json=_payload(tool_name, arguments))
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        else:
+            if not _should_retry(response) or attempt == retries:
+                return parse_tool_response(response)
+        time.sleep(_backoff(attempt))
+
+async def call_tool_async(tool_name, arguments=None, client=None, base_url=None, retries=MAX_RETRIES):
+    """
+    Async counterpart of `call_fastmcp_tool`.
+
+    Uses `client` if given, otherwise the shared AsyncClient for the running loop.
+    """
+    client = client or get_async_client()
+    url = f"{base_url or get_base_url()}/call_tool"
+    for attempt in range(retries + 1):
+        try:
+            response = await client.post(url, json=_payload(tool_name, arguments))
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        else:
+            if not _should_retry(response) or attempt == retries:
+                return parse_tool_response(response)
+        await asyncio.sleep(_backoff(attempt))
+
+async def list_tools_async():
+    """
+    Lists the backend's tools through an MCP client session.
+    """
+    client_class = globals().get("Client") or __getattr__("Client")
+    async with client_class(get_secret("MCP_SERVER_URL")) as client:
+        return await client.list_tools()
+
+def list_tools():
+    """
+    Synchronous wrapper for `list_tools_async`.
+    """
+    return asyncio.run(list_tools_async())
@@ -0,0 +1,163 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from .utils import get_secret
+
+MB = 1024 * 1024
+# Uploads above this are kept in a temp file instead of memory
+SPOOL_THRESHOLD_BYTES = int(float(get_secret("UPLOAD_SPOOL_THRESHOLD_MB", 4)) * MB)
+# Upload bytes one session may hold in memory at once; the rest is spooled
+SESSION_MEMORY_LIMIT_BYTES = int(float(get_secret("UPLOAD_SESSION_MEMORY_MB", 64)) * MB)
+
+def spool_dir():
+    return get_secret("UPLOAD_SPOOL_DIR") or tempfile.gettempdir()
+
+class MemoryBudget:
+    """
+    Ceiling on upload bytes a session holds in memory. Files that do not fit
+    are spooled to disk instead of being rejected.
+    """
+
+    def __init__(self, limit=SESSION_MEMORY_LIMIT_BYTES):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used = max(0, self.used - size)
+
+def upload_size(file):
+    """
+    Size of an upload in bytes without copying it.
+    """
+    size = getattr(file, "size", None)
+    if size is not None:
+        return size
+    if hasattr(file, "getbuffer"):
+        with file.getbuffer() as view:
+            return view.nbytes
+    return len(file.getvalue())
+
+def data_view(file):
+    """
+    Returns a read-only memoryview of an upload's bytes without copying them:
+    the BytesIO buffer of a Streamlit upload, or a memory map of a spooled
+    file. Use it as a context manager so the view is released.
+    """
+    if isinstance(file, FileRef):
+        return file.view()
+    if hasattr(file, "getbuffer"):
+        return file.getbuffer().toreadonly()
+    return memoryview(file.getvalue())
+
+def map_file(path):
+    """
+    Maps a file read-only. Pages are shared with the OS cache and with any
+    other process mapping the same file, so large documents are never
+    copied into Python memory.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+class FileRef:
+    """
+    Detached copy of an uploaded file, safe to hand to background workers
+    after the Streamlit rerun that produced it has ended.
+
+    Small files stay in memory (charged to the session's `MemoryBudget`);
+    large ones, or ones over the budget, are streamed to a temp file and read
+    through memory maps. Call `release()` when the consultation is done.
+    """
+
+    def __init__(self, name, type, data=None, path=None, budget=None, owns_path=False):
+        self.name = name
+        self.type = type
+        self.path = path
+        self._data = data
+        self._budget = budget
+        self._owns_path = owns_path
+        self.size = len(data) if data is not None else os.path.getsize(path)
+
+    def getvalue(self):
+        """
+        Returns the bytes. Spooled files are read into memory; prefer `view()`.
+        """
+        if self._data is not None:
+            return self._data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def view(self):
+        if self._data is not None:
+            return memoryview(self._data)
+        return map_file(self.path)
+
+    def release(self):
+        """
+        Returns the memory to the budget and deletes a spooled temp file.
+        """
+        if self._budget is not None and self._data is not None:
+            self._budget.release(self.size)
+            self._budget = None
+        if self._owns_path and self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self._owns_path = False
+
+    @classmethod
+    def _spool(cls, name, type, write):
+        fd, path = tempfile.mkstemp(prefix="upload-", dir=spool_dir())
+        try:
+            with os.fdopen(fd, "wb") as out:
+                write(out)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return cls(name, type, path=path, owns_path=True)
+
+    @classmethod
+    def from_upload(cls, file, budget=None):
+        size = upload_size(file)
+        if size <= SPOOL_THRESHOLD_BYTES and (budget is None or budget.reserve(size)):
+            return cls(file.name, file.type, file.getvalue(), budget=budget)
+
+        def write(out):
+            with data_view(file) as view:
+                out.write(view)
+        return cls._spool(file.name, file.type, write)
+
+    @classmethod
+    def from_stream(cls, name, type, stream, size=None, budget=None):
+        """
+        Detaches a binary stream (e.g. a multipart upload part), copying it
+        in chunks straight to a spool file unless it is known to be small.
+        """
+        if size is not None and size <= SPOOL_THRESHOLD_BYTES and (budget is None or budget.reserve(size)):
+            return cls(name, type, stream.read(), budget=budget)
+        return cls._spool(name, type, lambda out: shutil.copyfileobj(stream, out, 1024 * 1024))
+
+    @classmethod
+    def from_path(cls, path, type):
+        """
+        References a file on disk without reading it; `release()` leaves it in place.
+        """
+        return cls(os.path.basename(path), type, path=path)
+
+def release_all(files):
+    for file in files or []:
+        if isinstance(file, FileRef):
+            file.release()
@@ -1,7 +1,60 @@
 import re
 import json
 import os
-import streamlit as st
+import sys
+import textwrap
+import threading
+
+_secrets = None
+_secrets_lock = threading.Lock()
+
+def _streamlit_secrets():
+    """
+    Returns Streamlit secrets as a plain dict, read once per process.
+
+    Every `st.secrets` lookup re-validates the secrets files (and, when there
+    is no secrets.toml, searches for them and raises again), which made
+    `get_secret` cost ~70µs per call on hot paths.
+    """
+    global _secrets
+    if _secrets is None:
+        with _secrets_lock:
+            if _secrets is None:
+                if "streamlit" not in sys.modules:
+                    # Headless (API workers, batch CLI): read the same files without importing Streamlit
+                    _secrets = _read_secrets_files()
+                else:
+                    try:
+                        import streamlit as st
+                        _secrets = dict(st.secrets)
+                    except (FileNotFoundError, AttributeError):
+                        # No secrets.toml
+                        _secrets = {}
+    return _secrets
+
+def _read_secrets_files():
+    """
+    Reads Streamlit's default secrets files; the project's file wins over
+    the user-level one.
+    """
+    import tomllib
+    secrets = {}
+    for path in (os.path.expanduser(os.path.join("~", ".streamlit", "secrets.toml")),
+                 os.path.join(os.getcwd(), ".streamlit", "secrets.toml")):
+        try:
+            with open(path, "rb") as f:
+                secrets.update(tomllib.load(f))
+        except (OSError, ValueError):
+            continue
+    return secrets
+
+def reload_secrets():
+    """
+    Drops the cached secrets so the next `get_secret` re-reads secrets.toml.
+    """
+    global _secrets
+    with _secrets_lock:
+        _secrets = None
 
 def get_secret(key, default=None):
     """
@@ -14,89 +67,258 @@ def get_secret(key, default=None):
     Returns:
         str or None: The secret value.
     """
-    try:
-        # st.secrets acts like a dictionary
-        if key in st.secrets:
-            return st.secrets[key]
-    except (FileNotFoundError, AttributeError):
-        # st.secrets might fail if not running in Streamlit or no secrets.toml
-        pass
-
+    secrets = _streamlit_secrets()
+    if key in secrets:
+        return secrets[key]
     return os.getenv(key, default)
 
+# --- Response parsing ---
+
+_THOUGHT_OPEN = ("<think>", "<unused94>")
+_THOUGHT_MARKERS = ("<think>", "</think>", "<unused94>", "<unused95>")
+_THOUGHT_MARKER = re.compile("|".join(re.escape(m) for m in _THOUGHT_MARKERS))
+_THOUGHT_LABEL = re.compile(r"^\s*thought[ \t]*\n")
+_FENCE = "```"
+_FENCE_LANGUAGE = re.compile(r"(?:json)?[ \t]*\n?\s*", re.IGNORECASE)
+_BARE_JSON_START = re.compile(r"^[ \t]*\{", re.MULTILINE)
+_SECTION_HEADING = re.compile(
+    r"^[ \t]*#{1,3}[ \t]*(Executive Summary|Detailed Reasoning|Sources & Search Data)[ \t]*$",
+    re.MULTILINE | re.IGNORECASE
+)
+_SECTION_KEYS = {
+    "executive summary": "summary",
+    "detailed reasoning": "reasoning",
+    "sources & search data": "sources",
+}
+_SECTION_HEADINGS = {
+    "summary": "### Executive Summary",
+    "reasoning": "### Detailed Reasoning",
+    "sources": "### Sources & Search Data",
+}
+_JSON_DECODER = json.JSONDecoder()
+# Bare JSON candidates tried before giving up; bounds the worst case on odd outputs
+_MAX_JSON_ATTEMPTS = 3
+
+def _fenced_json(body):
+    """
+    Returns `(start, end, data)` for the first fenced block holding a JSON
+    object, or None. Fences are paired in one scan and each block is decoded
+    on its own, so the cost stays linear however many fences are unclosed.
+    """
+    opening = body.find(_FENCE)
+    while opening != -1:
+        closing = body.find(_FENCE, opening + len(_FENCE))
+        if closing == -1:
+            return None
+        block = body[opening + len(_FENCE):closing]
+        index = _FENCE_LANGUAGE.match(block).end()
+        if block.startswith("{", index):
+            try:
+                data, end = _JSON_DECODER.raw_decode(block, index)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and not block[end:].strip():
+                return opening, closing + len(_FENCE), data
+        opening = body.find(_FENCE, closing + len(_FENCE))
+    return None
+
+def _split_json(body):
+    """
+    Finds the response's JSON object, fenced or bare.
+
+    Returns:
+        tuple: (remaining_text, json_data or None, was_fenced)
+    """
+    fenced = _fenced_json(body)
+    if fenced:
+        start, end, data = fenced
+        return body[:start] + body[end:], data, True
+    for attempt, start in enumerate(_BARE_JSON_START.finditer(body)):
+        if attempt == _MAX_JSON_ATTEMPTS:
+            break
+        index = start.end() - 1
+        try:
+            data, end = _JSON_DECODER.raw_decode(body, index)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            return body[:start.start()] + body[end:], data, False
+    return body, None, False
+
+def _split_sections(report):
+    """
+    Splits dashboard-style markdown into its known sections in one pass.
+    """
+    sections = {}
+    matches = list(_SECTION_HEADING.finditer(report))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(report)
+        content = report[match.end():end].strip()
+        if content.startswith("---"):
+            content = content[3:].strip()
+        sections[_SECTION_KEYS[match.group(1).lower()]] = content
+    return sections
+
+def _clean_block(text):
+    return textwrap.dedent(text).strip()
+
+class ResponseParser:
+    """
+    Single-pass parser for model responses that can be fed while streaming.
+
+    Recognises thought blocks (`<think>...</think>` and MedGemma's
+    `<unused94>thought ... <unused95>`), a JSON verdict (fenced or bare) and
+    the dashboard headings. Thought markers are routed as chunks arrive, so
+    `in_thought` and `thought_so_far` are live during a stream; the body is
+    split into JSON and sections once, in `result()`.
+    """
+
+    def __init__(self):
+        self._thought = []
+        self._body = []
+        self._pending = ""
+        self.in_thought = False
+        self._saw_thought = False
+
+    def _route(self, text):
+        if text:
+            (self._thought if self.in_thought else self._body).append(text)
+
+    def feed(self, chunk):
+        if not chunk:
+            return self
+        text = self._pending + chunk
+        position = 0
+        for match in _THOUGHT_MARKER.finditer(text):
+            self._route(text[position:match.start()])
+            self.in_thought = match.group(0) in _THOUGHT_OPEN
+            self._saw_thought = self._saw_thought or self.in_thought
+            position = match.end()
+        rest = text[position:]
+        # Hold back a trailing partial marker such as "</thi" until the next chunk
+        cut = rest.rfind("<")
+        if cut != -1 and any(marker.startswith(rest[cut:]) for marker in _THOUGHT_MARKERS):
+            self._pending = rest[cut:]
+            rest = rest[:cut]
+        else:
+            self._pending = ""
+        self._route(rest)
+        return self
+
+    @property
+    def thought_so_far(self):
+        return "".join(self._thought)
+
+    def result(self):
+        """
+        Returns the parsed response.
+
+        Returns:
+            dict: `thought`, `markdown_report`, `json_data` (also as `data`),
+            `is_json` and `sections` (dashboard headings that were found).
+        """
+        self._route(self._pending)
+        self._pending = ""
+        thought = _THOUGHT_LABEL.sub("", "".join(self._thought), count=1)
+        report, json_data, fenced = _split_json("".join(self._body))
+        if json_data is not None and not fenced and not self._saw_thought:
+            # Triage protocol: untagged prose before a bare JSON verdict is the reasoning
+            thought, report = report, ""
+        report = _clean_block(report)
+        return {
+            "thought": _clean_block(thought),
+            "markdown_report": report,
+            "json_data": json_data,
+            "data": json_data,
+            "is_json": json_data is not None,
+            "sections": _split_sections(report),
+        }
+
+def parse_medgemma_response(text):
+    """
+    Parses a complete model response.
+
+    Args:
+        text (str): The raw model response.
+
+    Returns:
+        dict: See `ResponseParser.result`.
+    """
+    return ResponseParser().feed(text or "").result()
+
+def dashboard_sections(parsed):
+    """
+    Maps a parsed response onto the dashboard's summary/reasoning/sources panes.
+    Handles both the heading format and the triage JSON format.
+    """
+    sections = parsed["sections"]
+    if sections:
+        return {key: sections.get(key, f"Could not find section: '{heading}'") for key, heading in _SECTION_HEADINGS.items()}
+
+    data = parsed["json_data"]
+    if data and "triage_level" in data:
+        actions = data.get("recommended_actions") or []
+        if isinstance(actions, str):
+            actions = [actions]
+        summary = f"**Triage Level:** {data['triage_level']}"
+        if actions:
+            summary += "\n\n**Recommended Actions:**\n" + "\n".join(f"- {action}" for action in actions)
+        reasoning = str(data.get("clinical_rationale") or "No specific reasoning section found.")
+        if parsed["thought"]:
+            reasoning += f"\n\n**Model Reasoning:**\n{parsed['thought']}"
+        return {"summary": summary, "reasoning": reasoning, "sources": parsed["markdown_report"] or "No specific sources section found."}
+
+    # Fallback if no sections are found
+    return {"summary": parsed["markdown_report"], "reasoning": "No specific reasoning section found.", "sources": "No specific sources section found."}
+
 def parse_dashboard_response(text):
     """
     Parses the model's markdown-based dashboard response into a dictionary.
 
     Args:
-        text (str): The raw model response, expected to contain specific headings.
+        text (str): The raw model response, expected to contain specific headings
+            or a triage JSON verdict.
 
     Returns:
         dict: A dictionary with keys 'summary', 'reasoning', and 'sources'.
     """
     if not text:
         return {"summary": "", "reasoning": "", "sources": ""}
+    return dashboard_sections(parse_medgemma_response(text))
 
-    # Clean the text by removing any thinking blocks first
-    cleaned_text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()
+def is_image_file(file):
+    return file.type.startswith("image/")
 
-    # Define the sections based on the headings
-    sections = {
-        "summary": "### Executive Summary",
-        "reasoning": "### Detailed Reasoning",
-        "sources": "### Sources & Search Data"
-    }
-
-    parsed_content = {}
-
-    # Use regex to find content between headings
-    for key, heading in sections.items():
-        pattern = re.escape(heading) + r"\s*---\s*(.*?)(?=\n### |\Z)"
-        match = re.search(cleaned_text, pattern, re.DOTALL | re.IGNORECASE)
-        if match:
-            parsed_content[key] = match.group(1).strip()
-        else:
-            parsed_content[key] = f"Could not find section: '{heading}'"
+def extract_document_text(file, on_progress=None):
+    """
+    Extracts text from a single uploaded PDF or DOCX file.
 
-    # Fallback if no sections are found
-    if not any(match for match in parsed_content.values() if "Could not find section" not in match):
-        return {"summary": cleaned_text, "reasoning": "No specific reasoning section found.", "sources": "No specific sources section found."}
+    Args:
+        file: A Streamlit UploadedFile (or anything with name, type and getvalue()).
+        on_progress (callable): Optional `on_progress(name, done, total)` page callback.
 
-    return parsed_content
+    Returns:
+        str or None: The document wrapped in document markers, or None for
+        unsupported types.
+    """
+    from .extraction import extract_document
+    return extract_document(file, on_progress=on_progress)
 
 def process_uploaded_files(uploaded_files):
     """
     Extracts text from uploaded PDF and DOCX files.
     Images are returned as is.
     """
-    import docx
-    from PyPDF2 import PdfReader
-    import io
-
     extracted_texts = []
     image_files = []
 
     for file in uploaded_files:
-        if file.type == "application/pdf":
-            try:
-                pdf_reader = PdfReader(io.BytesIO(file.getvalue()))
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text()
-                extracted_texts.append(f"--- Document: {file.name} ---\n{text}\n--- End Document ---")
-            except Exception as e:
-                extracted_texts.append(f"--- Document: {file.name} ---\nError reading PDF: {e}\n--- End Document ---")
-
-        elif file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            try:
-                doc = docx.Document(io.BytesIO(file.getvalue()))
-                text = "\n".join([para.text for para in doc.paragraphs])
-                extracted_texts.append(f"--- Document: {file.name} ---\n{text}\n--- End Document ---")
-            except Exception as e:
-                extracted_texts.append(f"--- Document: {file.name} ---\nError reading DOCX: {e}\n--- End Document ---")
-
-        elif file.type.startswith("image/"):
+        if is_image_file(file):
             image_files.append(file)
+            continue
+        text = extract_document_text(file)
+        if text is not None:
+            extracted_texts.append(text)
 
     return "\n\n".join(extracted_texts), image_files
 
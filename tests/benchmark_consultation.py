@@ -0,0 +1,290 @@
+"""
+Headless benchmark of the full consultation flow against local stand-ins.
+
+A fake MCP tool server (HTTP transport) and a fake OpenAI-compatible
+streaming LLM run in this process, so no network access or API keys are
+needed. Each scenario runs `pipeline.run_consultation_async` at a given
+concurrency and document size and reports throughput and latency
+percentiles; `--output` writes JSON and `--compare` checks a previous run.
+
+    python tests/benchmark_consultation.py --concurrency 1,8 --pages 0,50 --output bench.json
+    python tests/benchmark_consultation.py --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add repo root to path
+sys.path.append(os.getcwd())
+
+FINAL_ANSWER = (
+    "### Executive Summary\nUrgent cardiology review. "
+    "### Detailed Reasoning\nChest pain with raised troponin. "
+    "### Sources & Search Data\nLocal benchmark stand-in."
+)
+
+class FakeToolHandler(BaseHTTPRequestHandler):
+    """
+    `/call_tool` endpoint for history, search and log tools; `latency` maps
+    tool name to seconds and is set on the server.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency.get(body["name"], 0.0))
+        if body["name"] == "search_medical_web":
+            text = f"Guidelines for {body['arguments'].get('query')}: " + "evidence summary. " * 40
+        elif body["name"] == "get_patient_history":
+            text = "Prior MI in 2019. Hypertension. " * 10
+        else:
+            text = "saved"
+        payload = json.dumps({"isError": False, "content": [{"type": "text", "text": text}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI-compatible streaming chat endpoint. The first turn asks for a
+    search, the turn after search results gives the final answer. Timing
+    comes from the server's `first_token` and `token_interval` settings.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        answered_search = any("Search results for" in m["content"] for m in body["messages"] if m["role"] == "user")
+        if answered_search:
+            words = FINAL_ANSWER.split(" ")
+        else:
+            words = ["<think>", "Need", "current", "guidance.", "</think>", "[SEARCH:", "troponin", "chest", "pain]"]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(self.server.first_token)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.server.token_interval)
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            try:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return  # The client stopped reading after the search command
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+def start_server(handler, **settings):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    for name, value in settings.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_pdf(pages, seed):
+    """
+    Builds a text PDF with `pages` pages; `seed` makes each document unique
+    so the extracted-text cache does not hide extraction cost.
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = " ".join(f"({seed}-{page} Troponin 2.1 ng/mL; ECG shows ST elevation in leads II, III, aVF.) Tj 0 -14 Td" for _ in range(30))
+        stream = f"BT /F1 10 Tf 40 760 Td {lines} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of `values` (0 < q <= 100).
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "max": max(values, default=0.0),
+    }
+
+async def run_scenario(pipeline, concurrency, pages, requests, run_id):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    first_tokens = []
+    errors = []
+
+    async def one(index):
+        files = []
+        if pages:
+            files = [pipeline.FileRef(f"labs-{index}.pdf", "application/pdf", make_pdf(pages, f"{run_id}-{index}"))]
+        async with semaphore:
+            started = time.perf_counter()
+            first = []
+
+            def on_event(kind, payload=None):
+                if kind == "token" and not first:
+                    first.append(time.perf_counter() - started)
+
+            try:
+                await pipeline.run_consultation_async(f"BENCH-{index}", "Chest pain, raised troponin.", files, on_event=on_event)
+            except Exception as e:
+                errors.append(repr(e))
+                return
+            latencies.append(time.perf_counter() - started)
+            first_tokens.extend(first)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    wall = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "pages": pages,
+        "requests": requests,
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "wall_seconds": wall,
+        "throughput_per_second": len(latencies) / wall if wall else 0.0,
+        "latency_seconds": summarize(latencies),
+        "time_to_first_token_seconds": summarize(first_tokens),
+    }
+
+def configure_environment(args, tool_server, llm_server, work_dir):
+    """
+    Points the app at the stand-ins. Must run before medgemma_triage is imported.
+    """
+    os.environ.update({
+        "MCP_TRANSPORT": "http",
+        "MCP_HTTP_URL": f"http://127.0.0.1:{tool_server.server_port}",
+        "LLM_PRIMARY": "openai:bench",
+        "LLM_STRATEGY": "single",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{llm_server.server_port}/v1",
+        "OPENAI_API_KEY": "bench",
+        "LLM_RPM_OPENAI": "1000000",
+        "TOOL_CACHE_BACKEND": "memory" if args.cache else "off",
+        "SEMANTIC_CACHE": "on" if args.cache else "off",
+        "DOC_CACHE_DIR": "",
+        "LOG_WAL_PATH": os.path.join(work_dir, "consultation_logs.wal"),
+        "JOBS_DIR": os.path.join(work_dir, "jobs"),
+        "CONSULTATION_STORE": "on" if args.cache else "off",
+        "CONSULTATION_DB_PATH": os.path.join(work_dir, "consultations.db"),
+    })
+
+def compare(results, baseline_path, tolerance):
+    """
+    Prints p95 latency changes against a previous run; returns the regressions.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(s["concurrency"], s["pages"]): s for s in json.load(f)["scenarios"]}
+    regressions = []
+    for scenario in results["scenarios"]:
+        previous = baseline.get((scenario["concurrency"], scenario["pages"]))
+        if previous is None:
+            continue
+        before = previous["latency_seconds"]["p95"]
+        after = scenario["latency_seconds"]["p95"]
+        change = (after - before) / before if before else 0.0
+        flag = "REGRESSION" if change > tolerance else ""
+        print(f"  c={scenario['concurrency']:<3} pages={scenario['pages']:<4} p95 {before:.3f}s -> {after:.3f}s ({change:+.1%}) {flag}")
+        if flag:
+            regressions.append(scenario)
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--pages", default="0,20,100", help="Comma-separated PDF sizes in pages (0 = no document)")
+    parser.add_argument("--requests", type=int, default=32, help="Consultations per scenario")
+    parser.add_argument("--history-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--log-latency", type=float, default=0.05)
+    parser.add_argument("--first-token", type=float, default=0.3, help="Seconds before the model's first token")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Seconds between streamed tokens")
+    parser.add_argument("--cache", action="store_true", help="Keep the tool result caches enabled")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Compare p95 latency with a previous JSON result")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown before --compare fails")
+    return parser.parse_args(argv)
+
+def run_benchmarks(argv=None):
+    args = parse_args(argv)
+    tool_server = start_server(FakeToolHandler, latency={
+        "get_patient_history": args.history_latency,
+        "search_medical_web": args.search_latency,
+        "save_consultation_log": args.log_latency,
+    })
+    llm_server = start_server(FakeLLMHandler, first_token=args.first_token, token_interval=args.token_interval)
+    work_dir = tempfile.mkdtemp(prefix="medgemma_bench_")
+    configure_environment(args, tool_server, llm_server, work_dir)
+
+    from medgemma_triage import log_writer, pipeline
+
+    async def run_all():
+        # Start the extraction pool, clients and connections outside the measurements
+        await run_scenario(pipeline, 1, 1, 1, run_id="warm-up")
+        scenarios = []
+        for pages in [int(p) for p in args.pages.split(",")]:
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                scenario = await run_scenario(pipeline, concurrency, pages, args.requests, run_id=len(scenarios))
+                latency = scenario["latency_seconds"]
+                print(f"c={concurrency:<3} pages={pages:<4} {scenario['throughput_per_second']:7.2f} req/s  "
+                      f"p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s  "
+                      f"ttft p50 {scenario['time_to_first_token_seconds']['p50']:.3f}s  errors {scenario['errors']}")
+                scenarios.append(scenario)
+        return scenarios
+
+    print(f"Running {args.requests} consultations per scenario...")
+    results = {
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "scenarios": asyncio.run(run_all()),
+    }
+    log_writer.get_writer().flush()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        print(f"Compared with {args.compare}:")
+        if compare(results, args.compare, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks())
@@ -0,0 +1,74 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Add repo root to path
+sys.path.append(os.getcwd())
+
+APP_PATH = os.path.abspath(os.path.join("medgemma_triage", "app.py"))
+
+def cold_import_time(statement, runs=5):
+    """
+    Median wall time of `statement` in a fresh interpreter, i.e. what a new
+    container or Streamlit worker pays before the first render.
+    """
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.getcwd())
+        samples.append(float(output.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+def top_imports(statement, n=8):
+    """
+    The slowest cumulative imports reported by `python -X importtime`.
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, cwd=os.getcwd())
+    rows = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+def rerun_time(runs=20):
+    """
+    Mean time of a Streamlit script rerun of the dashboard, after a warm-up run.
+    """
+    from streamlit.testing.v1 import AppTest
+    app = AppTest.from_file(APP_PATH, default_timeout=60)
+    app.run()
+    start = time.perf_counter()
+    for _ in range(runs):
+        app.run()
+    return (time.perf_counter() - start) / runs
+
+def get_secret_time(n=10000):
+    from medgemma_triage import utils
+    utils.get_secret("MCP_SERVER_URL")
+    start = time.perf_counter()
+    for _ in range(n):
+        utils.get_secret("MCP_SERVER_URL")
+    return (time.perf_counter() - start) / n
+
+def run_benchmarks():
+    print("Cold start (median of 5 fresh interpreters):")
+    for label, statement in [
+        ("streamlit", "import streamlit"),
+        ("app modules", "import streamlit; from medgemma_triage import jobs, streaming"),
+        ("fastmcp (deferred)", "import fastmcp"),
+    ]:
+        print(f"  {label:<20} {cold_import_time(statement) * 1000:8.1f} ms")
+
+    print("Slowest imports on the app path (cumulative):")
+    for cumulative, name in top_imports("import streamlit; from medgemma_triage import jobs, streaming"):
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    print(f"Rerun overhead:      {rerun_time() * 1000:.1f} ms per rerun")
+    print(f"get_secret lookup:   {get_secret_time() * 1e6:.2f} us per call")
+
+if __name__ == "__main__":
+    run_benchmarks()